@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the notebook's hot paths: SQL fetch, record-to-DataFrame conversion, HTML table
+rendering, figure PNG encoding and file-tree scanning. No network is needed: by default queries
+are served by an in-memory stand-in for the asyncpg pool; pass --dsn to run against a local
+PostgreSQL instead.
+
+Run:      python benchmarks.py --sizes 10k,1m --output bench_results.json
+Compare:  python benchmarks.py --sizes 10k,1m --compare bench_baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from notebook_app import NotebookApp, metrics, pd, AsyncpgDriver, create_file_tree
+
+SIZE_ALIASES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000, '10m': 10_000_000}
+SYNTHETIC_COLUMNS = ['id', 'customer', 'status', 'amount', 'created_at']
+STATUSES = ['new', 'paid', 'shipped', 'cancelled', 'refunded']
+BENCH_PROFILE = 'benchmark'
+
+notebook = NotebookApp() # A session of its own, outside any page
+
+
+class SyntheticRecord:
+    """Minimal asyncpg.Record stand-in: keys(), values() and item access."""
+    __slots__ = ('_values',)
+
+    def __init__(self, values):
+        self._values = values
+
+    def keys(self):
+        return SYNTHETIC_COLUMNS
+
+    def values(self):
+        return self._values
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._values[key]
+        return self._values[SYNTHETIC_COLUMNS.index(key)]
+
+
+class SyntheticPool:
+    """Serves `SELECT ... FROM synthetic_<rows>` from pre-generated records, like asyncpg.Pool.fetch."""
+
+    def __init__(self):
+        self.tables = {}
+
+    def add_table(self, rows: int):
+        start = datetime(2024, 1, 1)
+        self.tables[f'synthetic_{rows}'] = [
+            SyntheticRecord((i, f'customer_{i % 5000}', STATUSES[i % len(STATUSES)],
+                             round((i * 7919) % 100000 / 100, 2), start + timedelta(seconds=i)))
+            for i in range(rows)
+        ]
+
+    async def fetch(self, query: str):
+        for name, records in self.tables.items():
+            if name in query:
+                limit = query.rsplit('LIMIT', 1)[1].strip() if 'LIMIT' in query else None
+                return records[:int(limit)] if limit else records
+        return []
+
+    async def close(self):
+        pass
+
+
+async def setup_stand_in(sizes):
+    pool = SyntheticPool()
+    for rows in sizes:
+        pool.add_table(rows)
+    driver = AsyncpgDriver()
+    driver.pool = pool
+    register_driver(driver)
+    return pool
+
+
+async def setup_postgres(dsn: str, sizes):
+    import asyncpg
+    driver = AsyncpgDriver()
+    driver.pool = await asyncpg.create_pool(dsn, min_size=1, max_size=2)
+    for rows in sizes:
+        await driver.pool.execute(f"""
+            CREATE TABLE IF NOT EXISTS synthetic_{rows} AS
+            SELECT i AS id,
+                   'customer_' || (i % 5000) AS customer,
+                   (ARRAY['new','paid','shipped','cancelled','refunded'])[1 + i % 5] AS status,
+                   round(((i * 7919) % 100000) / 100.0, 2) AS amount,
+                   timestamp '2024-01-01' + i * interval '1 second' AS created_at
+            FROM generate_series(0, {rows - 1}) AS i
+        """)
+    register_driver(driver)
+    return driver.pool
+
+
+def register_driver(driver):
+    notebook.connections.profiles[BENCH_PROFILE] = {'driver': 'postgres'}
+    notebook.connections.drivers[BENCH_PROFILE] = driver
+    notebook.active_profile = BENCH_PROFILE
+
+
+async def measure(func, repeats: int):
+    """Runs an async callable `repeats` times and returns timing statistics plus the median stage breakdown."""
+    durations, stage_runs = [], []
+    for _ in range(repeats):
+        run_metrics, token = metrics.begin('benchmark', func.__name__)
+        start = time.perf_counter()
+        await func()
+        durations.append(time.perf_counter() - start)
+        metrics.finish(run_metrics, token)
+        stage_runs.append(run_metrics.stages)
+    stages = {stage: statistics.median(run.get(stage, 0.0) for run in stage_runs)
+              for stage in sorted({stage for run in stage_runs for stage in run})}
+    return {'median': statistics.median(durations), 'min': min(durations), 'max': max(durations),
+            'repeats': repeats, 'stages': stages}
+
+
+async def run_benchmarks(sizes, repeats: int, tree_files: int):
+    results = {}
+    for rows in sizes:
+        table = f'synthetic_{rows}'
+        print(f"Benchmarking {rows:,} rows...")
+
+        async def execute_sql():
+            df, message, _ = await notebook.execute_sql(f'SELECT * FROM {table}')
+            if df is None:
+                raise RuntimeError(message)
+        results[f'execute_sql[{rows}]'] = await measure(execute_sql, repeats)
+
+        records = await notebook.db_connection.pool.fetch(f'SELECT * FROM {table}')
+
+        async def records_to_dataframe():
+            columns = list(records[0].keys())
+            pd.DataFrame([tuple(record.values()) for record in records], columns=columns)
+        results[f'records_to_dataframe[{rows}]'] = await measure(records_to_dataframe, repeats)
+
+        df, _, _ = await notebook.execute_sql(f'SELECT * FROM {table}')
+        for max_rows in (20, 200):
+            async def to_html():
+                df.to_html(classes='dataframe', border=0, max_rows=max_rows, escape=False)
+            to_html.__name__ = f'to_html_{max_rows}'
+            results[f'to_html[{rows},max_rows={max_rows}]'] = await measure(to_html, repeats)
+
+        notebook.python_globals['bench_df'] = df
+        async def display_figure():
+            success, outputs, _ = await notebook.execute_python(
+                "fig, ax = plt.subplots()\nax.plot(bench_df['amount'].values)\ndisplay(fig)", False)
+            if not success:
+                raise RuntimeError(outputs[-1].data)
+        results[f'display_figure_png[{rows}]'] = await measure(display_figure, repeats)
+        notebook.python_globals.clear()
+
+    tree_root = Path(tempfile.mkdtemp(prefix='dnb_bench_tree_'))
+    try:
+        files_per_dir = 100
+        for i in range(tree_files):
+            directory = tree_root / f'dir_{i // (files_per_dir * 10)}' / f'sub_{(i // files_per_dir) % 10}'
+            directory.mkdir(parents=True, exist_ok=True)
+            (directory / f'file_{i}.csv').touch()
+
+        async def file_tree():
+            create_file_tree(path=tree_root, max_depth=3)
+        results[f'create_file_tree[{tree_files}]'] = await measure(file_tree, repeats)
+    finally:
+        shutil.rmtree(tree_root, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline_path: Path, threshold: float) -> bool:
+    """Prints median ratios against a stored baseline. Returns False if any benchmark regressed."""
+    baseline = json.loads(baseline_path.read_text())['results']
+    ok = True
+    print(f"\n{'benchmark':<45} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<45} {'-':>10} {result['median']:>9.4f}s {'new':>7}")
+            continue
+        ratio = result['median'] / baseline[name]['median'] if baseline[name]['median'] else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  REGRESSION'
+            ok = False
+        print(f"{name:<45} {baseline[name]['median']:>9.4f}s {result['median']:>9.4f}s {ratio:>6.2f}x{flag}")
+    return ok
+
+
+def parse_sizes(value: str):
+    return [SIZE_ALIASES.get(size.strip().lower()) or int(size) for size in value.split(',') if size.strip()]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Benchmark the notebook hot paths.')
+    parser.add_argument('--sizes', default='10k,1m', help='Comma-separated row counts (10k, 100k, 1m, 10m or integers).')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--tree-files', type=int, default=20_000, help='Files in the synthetic directory tree.')
+    parser.add_argument('--dsn', help='Benchmark against a local PostgreSQL (e.g. postgresql://postgres@localhost/bench) instead of the stand-in.')
+    parser.add_argument('--output', type=Path, help='Write results to this JSON file.')
+    parser.add_argument('--compare', type=Path, help='Baseline JSON to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown before a benchmark counts as a regression.')
+    args = parser.parse_args()
+
+    sizes = parse_sizes(args.sizes)
+    pool = await (setup_postgres(args.dsn, sizes) if args.dsn else setup_stand_in(sizes))
+    try:
+        results = await run_benchmarks(sizes, args.repeats, args.tree_files)
+    finally:
+        await pool.close()
+
+    report = {
+        'meta': {'recorded_at': datetime.now().isoformat(), 'python': sys.version.split()[0],
+                 'platform': platform.platform(), 'pandas': pd.__version__,
+                 'backend': 'postgres' if args.dsn else 'stand-in', 'repeats': args.repeats},
+        'results': results,
+    }
+    for name, result in results.items():
+        stages = ', '.join(f'{stage}={seconds * 1000:.1f}ms' for stage, seconds in result['stages'].items())
+        print(f"{name:<45} median {result['median'] * 1000:9.1f} ms  {stages}")
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f"\nResults written to {args.output}")
+    if args.compare and not compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,34 +1,102 @@
+from __future__ import annotations # Annotations mention pandas/sshtunnel types that are imported lazily
+import time
+_PROCESS_START = time.perf_counter()
 import asyncio
-from nicegui import ui, app
+import ast
+import contextlib
+import importlib
+import importlib.util
+import threading
+import types
 import json
-import asyncpg
-import pandas as pd
-from sshtunnel import SSHTunnelForwarder
 import traceback
 import logging
-from typing import Dict, Any, Optional, Tuple, List
+from typing import Dict, Any, Optional, Tuple, List, TYPE_CHECKING
 import uuid
 from datetime import datetime
 import sys
-from io import StringIO
 import os
 from pathlib import Path
-import numpy as np
-import time
 import functools
-import matplotlib
-matplotlib.use('Agg') # Use 'Agg' for PNG output (non-interactive)
-import matplotlib.pyplot as plt
+import hashlib
 import io
 import base64
+import builtins
+import html
+import reprlib
+import linecache
+import re
+import contextvars
+import abc
+import shutil
+import tempfile
+from collections import deque, defaultdict
+
+if TYPE_CHECKING: # Only for annotations; sshtunnel is imported when a tunnel is opened
+    from sshtunnel import SSHTunnelForwarder
+
+# --- Startup Timing ---
+STARTUP_TIMINGS: List[Tuple[str, float]] = []
+STARTUP_WARN_SECONDS = 2.0
+
+@contextlib.contextmanager
+def startup_phase(label: str):
+    """Records how long a startup step (usually an import) takes, for the startup timing report."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS.append((label, time.perf_counter() - start))
+
+with startup_phase('import nicegui'):
+    from nicegui import ui, app, context, Client
+    from fastapi import Request
+    from fastapi.responses import PlainTextResponse
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a heavy module that performs the real import on first attribute access."""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    with startup_phase(f'import {self.__name__} (deferred)'):
+                        module = importlib.import_module(self.__name__)
+                    install_cell_path_hooks() # The first access may come from inside a running cell
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+# matplotlib reads the backend from the environment when it is first imported
+os.environ['MPLBACKEND'] = 'Agg' # Use 'Agg' for PNG output (non-interactive)
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+plt = LazyModule('matplotlib.pyplot')
+PRELOAD_MODULES = (pd, np) # Imported in a background thread once the server is up
+
+def is_module_loaded(name: str) -> bool:
+    return name in sys.modules
 
 # Attempt to import tkinter for native directory picker
-try:
-    import tkinter
-    from tkinter import filedialog
-    TKINTER_AVAILABLE = True
-except ImportError:
-    TKINTER_AVAILABLE = False
+with startup_phase('import tkinter'):
+    try:
+        import tkinter
+        from tkinter import filedialog
+        TKINTER_AVAILABLE = True
+    except ImportError:
+        TKINTER_AVAILABLE = False
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -37,6 +105,12 @@ logger = logging.getLogger(__name__)
 if not TKINTER_AVAILABLE:
     logger.warning("tkinter module not found. Native directory picker will be disabled.")
 
+# Optional database backends, imported when a connection is made
+DUCKDB_AVAILABLE = importlib.util.find_spec('duckdb') is not None
+PSYCOPG2_AVAILABLE = importlib.util.find_spec('psycopg2') is not None
+BOTO3_AVAILABLE = importlib.util.find_spec('boto3') is not None
+PYARROW_AVAILABLE = importlib.util.find_spec('pyarrow') is not None # Parquet engine for spilling DataFrames
+
 
 # --- START: New JavaScript/CSS for DB Explorer ---
 DB_EXPLORER_CSS = """
@@ -626,6 +700,12 @@ body {
     overflow-x: auto;
 }
 
+.output-area-content pre {
+    margin: 0;
+    white-space: pre-wrap;
+    font-family: monospace;
+}
+
 
 .q-tabs {
     background-color: var(--bg-tertiary) !important;
@@ -860,6 +940,25 @@ body {
     min-height: 36px !important;
 }
 
+/* Stands in for the editor of cells away from the viewport (see LazyCodeEditor) */
+.code-editor-placeholder {
+    min-height: 100px;
+    overflow: hidden;
+    cursor: text;
+    background-color: var(--input-bg);
+    color: var(--text-primary);
+    border-bottom-left-radius: 16px;
+    border-bottom-right-radius: 16px;
+}
+
+.code-editor-placeholder pre {
+    margin: 0;
+    padding: 4px 8px 4px 36px; /* Roughly where the editor's text starts after the gutter */
+    font-family: 'Monaco', 'Menlo', 'Ubuntu Mono', monospace;
+    font-size: 16px;
+    line-height: 24px;
+}
+
 .dataframe {
     border-collapse: collapse;
     margin: 10px 0;
@@ -1369,110 +1468,135 @@ document.addEventListener('DOMContentLoaded', function() {
 });
 
 // --- File Tree Colorization (.dnb files) ---
-function colorizeDnbFiles() {
-    setTimeout(() => {
-        document.querySelectorAll('.q-tree__node').forEach(node => {
-            const labelElement = node.querySelector('.q-tree__node-header-content > div:last-child');
-            if (labelElement && labelElement.textContent.endsWith('.dnb')) {
-                const headerElement = node.querySelector('.q-tree__node-header');
-                if (headerElement) {
-                    headerElement.classList.add('dnb-file-node');
-                }
-            }
-        });
-    }, 100);
-}
-
-document.addEventListener('DOMContentLoaded', colorizeDnbFiles);
-
-const treeObserver = new MutationObserver((mutations) => {
-    let treeChanged = false;
-    mutations.forEach((mutation) => {
-        if (mutation.type === 'childList' && mutation.target.classList.contains('q-tree')) {
-            treeChanged = true;
+// Scoped to the file tree's container, so cell output updates and other DOM changes don't trigger it.
+function colorizeDnbFiles(root) {
+    root.querySelectorAll('.q-tree__node-header:not(.dnb-file-node)').forEach(headerElement => {
+        const labelElement = headerElement.querySelector('.q-tree__node-header-content > div:last-child');
+        if (labelElement && labelElement.textContent.endsWith('.dnb')) {
+            headerElement.classList.add('dnb-file-node');
         }
-        mutation.addedNodes.forEach((node) => {
-            if (node.nodeType === 1 &&
-                (node.classList?.contains('q-tree__node') ||
-                 node.querySelector?.('.q-tree__node'))) {
-                treeChanged = true;
-            }
-        });
     });
-    if (treeChanged) {
-        colorizeDnbFiles();
-    }
-});
+}
 
-treeObserver.observe(document.body, { childList: true, subtree: true });
+function dnbWatchFileTree(containerId) {
+    const container = document.getElementById(containerId);
+    if (!container || container._dnbTreeWatched) return;
+    container._dnbTreeWatched = true;
+    let scheduled = false;
+    new MutationObserver(() => {
+        if (scheduled) return;
+        scheduled = true;
+        requestAnimationFrame(() => {
+            scheduled = false;
+            colorizeDnbFiles(container);
+        });
+    }).observe(container, { childList: true, subtree: true });
+    colorizeDnbFiles(container);
+}
 
 // --- CodeMirror Auto-Expand ---
-function setupAutoExpand() {
-    setTimeout(() => {
-        document.querySelectorAll('.cm-editor').forEach(editor => {
-            if (editor._autoExpandSetup) return;
+// Called by the server for each editor it mounts (see LazyCodeEditor.mount); the editor may take a few
+// frames to appear after the element is created.
+function setupAutoExpand(editor) {
+    if (editor._autoExpandSetup) return;
 
-            const view = editor.CodeMirror;
-            if (!view) return;
+    const view = editor.CodeMirror;
+    if (!view) return;
 
-            function updateHeight() {
-                const lineHeight = 24;
-                const padding = 16;
-                const minLines = 4;
-                const maxLines = 25;
+    function updateHeight() {
+        const lineHeight = 24;
+        const padding = 16;
+        const minLines = 4;
+        const maxLines = 25;
 
-                const lineCount = Math.max(1, view.state.doc.lines);
-                const targetLines = Math.max(minLines, Math.min(maxLines, lineCount + 1));
-                const newHeight = (targetLines * lineHeight) + padding;
+        const lineCount = Math.max(1, view.state.doc.lines);
+        const targetLines = Math.max(minLines, Math.min(maxLines, lineCount + 1));
+        const newHeight = (targetLines * lineHeight) + padding;
 
-                editor.style.height = newHeight + 'px';
+        editor.style.height = newHeight + 'px';
 
-                setTimeout(() => {
-                    if (view.requestMeasure) {
-                        view.requestMeasure();
-                    }
-                }, 0);
+        setTimeout(() => {
+            if (view.requestMeasure) {
+                view.requestMeasure();
             }
+        }, 0);
+    }
 
-            if (view.updateListener) {
-                const extension = view.updateListener.of((update) => {
-                    if (update.docChanged || update.geometryChanged) {
-                        setTimeout(updateHeight, 10);
-                    }
-                });
-                view.dispatch({
-                    effects: view.state.reconfigure.of([
-                        ...view.state.extensions,
-                        extension
-                    ])
-                });
+    if (view.updateListener) {
+        const extension = view.updateListener.of((update) => {
+            if (update.docChanged || update.geometryChanged) {
+                setTimeout(updateHeight, 10);
             }
-
-            updateHeight();
-            editor._autoExpandSetup = true;
         });
-    }, 100);
+        view.dispatch({
+            effects: view.state.reconfigure.of([
+                ...view.state.extensions,
+                extension
+            ])
+        });
+    }
+
+    updateHeight();
+    editor._autoExpandSetup = true;
 }
 
-document.addEventListener('DOMContentLoaded', setupAutoExpand);
+function dnbSetupEditor(elementId, attempts = 20) {
+    const editor = document.querySelector(`#${elementId} .cm-editor`);
+    if (editor) {
+        setupAutoExpand(editor);
+    } else if (attempts > 0) {
+        setTimeout(() => dnbSetupEditor(elementId, attempts - 1), 50);
+    }
+}
 
-const observer = new MutationObserver((mutations) => {
-    let hasNewEditor = false;
-    mutations.forEach((mutation) => {
-        mutation.addedNodes.forEach((node) => {
-            if (node.nodeType === 1 &&
-                (node.classList?.contains('cm-editor') ||
-                 node.querySelector?.('.cm-editor'))) {
-                hasNewEditor = true;
-            }
+// --- Cell Virtualization ---
+// Tells the server which cells are near the viewport, so it mounts their editors and outputs and drops
+// them for cells far away. New cells are picked up by a childList-only observer on the cell container.
+function dnbVirtualizeCells(containerId) {
+    const container = document.getElementById(containerId);
+    if (!container || container._dnbVirtualized) return;
+    container._dnbVirtualized = true;
+
+    const visibility = new IntersectionObserver((entries) => {
+        entries.forEach((entry) => {
+            const output = entry.target.querySelector('.output-area-content');
+            emitEvent('dnb_cell_visibility', {
+                id: entry.target.dataset.cellId,
+                visible: entry.isIntersecting,
+                output_height: output ? output.clientHeight : 0,
+            });
         });
+    }, { rootMargin: '1000px 0px' });
+
+    const observeCells = (nodes) => nodes.forEach((node) => {
+        if (node.nodeType === 1 && node.classList.contains('code-cell')) {
+            visibility.observe(node);
+        }
     });
-    if (hasNewEditor) {
-        setTimeout(setupAutoExpand, 100);
+    observeCells(Array.from(container.children));
+    new MutationObserver((mutations) => mutations.forEach((mutation) => {
+        observeCells(Array.from(mutation.addedNodes));
+        mutation.removedNodes.forEach((node) => node.nodeType === 1 && visibility.unobserve(node));
+    })).observe(container, { childList: true });
+}
+
+// --- Client-side Charts ---
+// Decodes chart columns sent by the server (see encode_chart_column): base64 float64 buffers become
+// numbers, NaN becomes a gap; category columns are already plain lists.
+function dnbColumns(columns) {
+    const decoded = {};
+    for (const [name, column] of Object.entries(columns)) {
+        if (typeof column !== 'string') {
+            decoded[name] = column;
+            continue;
+        }
+        const binary = atob(column);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+        decoded[name] = Array.from(new Float64Array(bytes.buffer), (value) => Number.isNaN(value) ? null : value);
     }
-});
-
-observer.observe(document.body, { childList: true, subtree: true });
+    return decoded;
+}
 </script>
 """
 
@@ -1535,12 +1659,1467 @@ def get_file_icon(file_extension):
     }
     return icons.get(file_extension.lower(), 'description')
 
-async def get_all_schema_data_optimized():
-    """Fetches all schema, table, and column info in a single, efficient query."""
-    if not notebook.db_connection:
-        return {"error": "Not connected to database"}
+# --- Execution Metrics ---
+RUN_HISTORY_SIZE = 200
+METRIC_STAGES = ['queue_wait', 'connect', 'db_roundtrip', 'conversion', 'python_exec', 'render', 'scan']
+
+
+class RunMetrics:
+    """Stage timings and output size for one cell run, schema load or file-tree refresh."""
+
+    def __init__(self, kind: str, label: str):
+        self.kind = kind
+        self.label = label
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.payload_bytes = 0
+        self.total = 0.0
+        self.status = 'ok'
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def as_row(self) -> Dict[str, Any]:
+        row = {'time': self.started_at.strftime('%H:%M:%S'), 'kind': self.kind, 'label': self.label,
+               'status': self.status, 'total': f'{self.total * 1000:.0f}',
+               'payload': f'{self.payload_bytes / 1024:.1f}'}
+        row.update({stage: f'{self.stages[stage] * 1000:.0f}' if stage in self.stages else '' for stage in METRIC_STAGES})
+        return row
+
+_current_run_metrics: contextvars.ContextVar[Optional[RunMetrics]] = contextvars.ContextVar('current_run_metrics', default=None)
+
+
+class MetricsRegistry:
+    """Process-wide aggregates of run stages, exported in Prometheus text format on /metrics.
+
+    The RunMetrics being recorded is kept in a context variable, so drivers and helpers that run
+    inside a cell (including worker threads started with asyncio.to_thread) attribute time to it.
+    """
+
+    def __init__(self):
+        self.stage_totals: Dict[Tuple[str, str], List[float]] = {} # (kind, stage) -> [count, sum, max]
+        self.payload_totals: Dict[str, List[float]] = {} # kind -> [count, sum]
+        self.run_counts: Dict[Tuple[str, str], int] = {} # (kind, status) -> runs
+        self.lock = threading.Lock()
+
+    def begin(self, kind: str, label: str) -> Tuple[RunMetrics, contextvars.Token]:
+        run_metrics = RunMetrics(kind, label)
+        return run_metrics, _current_run_metrics.set(run_metrics)
+
+    def finish(self, run_metrics: RunMetrics, token: contextvars.Token, history: Optional[deque] = None):
+        _current_run_metrics.reset(token)
+        run_metrics.total = time.perf_counter() - run_metrics.start
+        with self.lock:
+            for stage, seconds in list(run_metrics.stages.items()) + [('total', run_metrics.total)]:
+                totals = self.stage_totals.setdefault((run_metrics.kind, stage), [0, 0.0, 0.0])
+                totals[0] += 1
+                totals[1] += seconds
+                totals[2] = max(totals[2], seconds)
+            payload = self.payload_totals.setdefault(run_metrics.kind, [0, 0.0])
+            payload[0] += 1
+            payload[1] += run_metrics.payload_bytes
+            key = (run_metrics.kind, run_metrics.status)
+            self.run_counts[key] = self.run_counts.get(key, 0) + 1
+        if history is not None:
+            history.append(run_metrics)
+
+    @contextlib.contextmanager
+    def stage(self, name: str, exclude: Tuple[str, ...] = ()):
+        """Times a block as `name`, minus time recorded for the `exclude` stages while it ran."""
+        run_metrics = _current_run_metrics.get()
+        excluded_before = sum(run_metrics.stages.get(excluded, 0.0) for excluded in exclude) if run_metrics else 0.0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if run_metrics is not None:
+                elapsed -= sum(run_metrics.stages.get(excluded, 0.0) for excluded in exclude) - excluded_before
+            self.record_stage(name, elapsed)
+
+    def record_stage(self, name: str, seconds: float):
+        run_metrics = _current_run_metrics.get()
+        if run_metrics is not None:
+            run_metrics.add(name, seconds)
+
+    def record_payload(self, payload: str):
+        self.record_payload_size(len(payload.encode('utf-8')))
+
+    def record_payload_size(self, size: int):
+        run_metrics = _current_run_metrics.get()
+        if run_metrics is not None:
+            run_metrics.payload_bytes += size
+
+    def render_prometheus(self) -> str:
+        lines = ['# HELP dnb_stage_seconds Time spent per stage of cell runs, schema loads and file-tree refreshes.',
+                 '# TYPE dnb_stage_seconds summary']
+        with self.lock:
+            for (kind, stage), (count, total, _) in sorted(self.stage_totals.items()):
+                lines.append(f'dnb_stage_seconds_count{{kind="{kind}",stage="{stage}"}} {count}')
+                lines.append(f'dnb_stage_seconds_sum{{kind="{kind}",stage="{stage}"}} {total:.6f}')
+            lines += ['# HELP dnb_stage_seconds_max Slowest observation per stage since startup.',
+                      '# TYPE dnb_stage_seconds_max gauge']
+            for (kind, stage), (_, _, maximum) in sorted(self.stage_totals.items()):
+                lines.append(f'dnb_stage_seconds_max{{kind="{kind}",stage="{stage}"}} {maximum:.6f}')
+            lines += ['# HELP dnb_output_payload_bytes Size of the output sent to the browser.',
+                      '# TYPE dnb_output_payload_bytes summary']
+            for kind, (count, total) in sorted(self.payload_totals.items()):
+                lines.append(f'dnb_output_payload_bytes_count{{kind="{kind}"}} {count}')
+                lines.append(f'dnb_output_payload_bytes_sum{{kind="{kind}"}} {total:.0f}')
+            lines += ['# HELP dnb_runs_total Completed runs by kind and status.',
+                      '# TYPE dnb_runs_total counter']
+            for (kind, status), count in sorted(self.run_counts.items()):
+                lines.append(f'dnb_runs_total{{kind="{kind}",status="{status}"}} {count}')
+        lines += ['# HELP dnb_startup_phase_seconds Duration of each startup phase.',
+                  '# TYPE dnb_startup_phase_seconds gauge']
+        for label, duration in STARTUP_TIMINGS:
+            lines.append(f'dnb_startup_phase_seconds{{phase="{label}"}} {duration:.6f}')
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+# --- DataFrame Memory Manager ---
+DATAFRAME_MEMORY_BUDGET_MB = 2048
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_]\w*')
+
+def referenced_names(code: str) -> set:
+    """Identifiers that appear in a cell's code. A superset of the names it reads, which is all the spill logic needs."""
+    return set(IDENTIFIER_PATTERN.findall(code))
+
+def dataframe_memory_bytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+def measure_frames(frames: Dict[int, pd.DataFrame]) -> Dict[int, int]:
+    """Deep sizes by frame id. Slow on large string frames, so callers run it in a worker thread."""
+    return {frame_id: dataframe_memory_bytes(df) for frame_id, df in frames.items()}
+
+class SpilledFrame:
+    """Placeholder left in the notebook namespace for a DataFrame that was written to Parquet to free memory."""
+
+    def __init__(self, name: str, path: Path, nbytes: int, shape: Tuple[int, int]):
+        self.name = name
+        self.path = path
+        self.nbytes = nbytes
+        self.shape = shape
+
+    def load(self) -> pd.DataFrame:
+        return pd.read_parquet(self.path)
+
+    def __repr__(self):
+        return f"<DataFrame '{self.name}' {self.shape[0]}x{self.shape[1]}, spilled to disk; reference it by name in a cell to reload>"
+
+class DataFrameMemoryManager:
+    """Accounts the deep memory of the notebook's DataFrames and spills the least recently used ones to Parquet when over budget."""
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self.spill_dir: Optional[Path] = None
+        self.sizes: Dict[int, int] = {} # id(df) -> deep bytes; memory_usage(deep=True) walks every string, so it is cached
+        self.last_used: Dict[str, int] = {}
+        self.use_counter = 0
+        self.unspillable: set = set() # ids of frames Parquet cannot represent
+        self.frame_names: Dict[int, str] = {} # id(frame or SpilledFrame) -> first name bound to it, refreshed by account()
+
+    def touch(self, names):
+        for name in names:
+            self.use_counter += 1
+            self.last_used[name] = self.use_counter
+
+    def unmeasured(self, namespace: Dict[str, Any], refresh_names=()) -> Dict[int, pd.DataFrame]:
+        """Frames whose deep size is not cached yet, plus those bound to `refresh_names`, keyed by id."""
+        return {id(value): value for name, value in namespace.items()
+                if isinstance(value, pd.DataFrame) and (name in refresh_names or id(value) not in self.sizes)}
+
+    def size_of(self, df: pd.DataFrame, refresh: bool = False) -> int:
+        if refresh or id(df) not in self.sizes:
+            self.sizes[id(df)] = dataframe_memory_bytes(df)
+        return self.sizes[id(df)]
+
+    def account(self, namespace: Dict[str, Any], refresh_names=()) -> Dict[str, int]:
+        """Deep bytes of every in-memory DataFrame in the namespace. Frames bound to several names are counted once."""
+        frames = {name: value for name, value in namespace.items() if isinstance(value, pd.DataFrame)}
+        self.frame_names = {}
+        for name, value in namespace.items():
+            if isinstance(value, (pd.DataFrame, SpilledFrame)):
+                self.frame_names.setdefault(id(value), name)
+        live_ids = {id(df) for df in frames.values()}
+        self.sizes = {frame_id: size for frame_id, size in self.sizes.items() if frame_id in live_ids}
+        self.unspillable &= live_ids
+        self.last_used = {name: tick for name, tick in self.last_used.items() if name in namespace}
+        for name in refresh_names:
+            if name in frames:
+                self.size_of(frames[name], refresh=True)
+        return {name: self.size_of(df) for name, df in frames.items()}
+
+    def select_victims(self, namespace: Dict[str, Any], protected=()) -> List[str]:
+        """Least recently used frames to spill until the rest fits in the budget."""
+        sizes = self.account(namespace)
+        seen, total = set(), 0
+        for name, size in sizes.items():
+            if id(namespace[name]) not in seen:
+                seen.add(id(namespace[name]))
+                total += size
+        victims = []
+        for name in sorted(sizes, key=lambda n: self.last_used.get(n, 0)):
+            if total <= self.budget_bytes:
+                break
+            df = namespace[name]
+            if name in protected or id(df) in self.unspillable or any(namespace[v] is df for v in victims):
+                continue
+            victims.append(name)
+            total -= sizes[name]
+        return victims
+
+    def spill(self, name: str, df: pd.DataFrame) -> Optional[SpilledFrame]:
+        """Writes the frame to Parquet. Returns None if Parquet cannot represent it (e.g. mixed object columns)."""
+        if self.spill_dir is None:
+            self.spill_dir = Path(tempfile.mkdtemp(prefix='dnb_spill_'))
+        path = self.spill_dir / f"{uuid.uuid4().hex}.parquet"
+        try:
+            df.to_parquet(path)
+        except Exception as e:
+            logger.warning(f"Could not spill DataFrame '{name}' to disk: {e}")
+            path.unlink(missing_ok=True)
+            self.unspillable.add(id(df))
+            return None
+        logger.info(f"Spilled DataFrame '{name}' ({self.size_of(df) / 1e6:.1f} MB) to {path}")
+        return SpilledFrame(name, path, self.size_of(df), df.shape)
+
+    def restore(self, spilled: SpilledFrame) -> pd.DataFrame:
+        df = spilled.load()
+        spilled.path.unlink(missing_ok=True)
+        self.sizes[id(df)] = spilled.nbytes
+        logger.info(f"Reloaded spilled DataFrame '{spilled.name}'")
+        return df
+
+    def clear(self):
+        """Forgets all accounting and deletes the spill files."""
+        self.sizes.clear()
+        self.last_used.clear()
+        self.unspillable.clear()
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+# --- DataFrame Compaction ---
+COMPACT_CATEGORY_MAX_UNIQUE = 1000 # Strings with at most this many distinct values become categoricals
+COMPACT_CATEGORY_MAX_RATIO = 0.5 # ...as long as values repeat on average at least twice
+
+def compact_series(col: pd.Series) -> pd.Series:
+    kind = col.dtype.kind
+    if kind in 'iu':
+        return pd.to_numeric(col, downcast='integer' if kind == 'i' else 'unsigned')
+    if kind == 'f':
+        narrowed = col.astype('float32')
+        if ((narrowed.astype(col.dtype) == col) | col.isna()).all(): # Only when no precision is lost
+            return narrowed
+        return col
+    if kind == 'O' and pd.api.types.infer_dtype(col, skipna=True) == 'string':
+        unique = col.nunique(dropna=True)
+        if unique <= COMPACT_CATEGORY_MAX_UNIQUE and unique <= len(col) * COMPACT_CATEGORY_MAX_RATIO:
+            return col.astype('category')
+        if PYARROW_AVAILABLE:
+            return col.astype('string[pyarrow]')
+    return col
+
+def compact_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    """Returns a copy with downcast numerics and categorical or Arrow-backed strings.
+    The before/after deep memory is recorded in attrs['dnb_compaction']."""
+    before = dataframe_memory_bytes(df)
+    compacted = df.copy(deep=False)
+    for position in range(df.shape[1]):
+        compacted.isetitem(position, compact_series(df.iloc[:, position]))
+    compacted.attrs['dnb_compaction'] = (before, dataframe_memory_bytes(compacted))
+    return compacted
+
+def describe_compaction(df: pd.DataFrame) -> Optional[str]:
+    if 'dnb_compaction' not in df.attrs:
+        return None
+    before, after = df.attrs['dnb_compaction']
+    saved = 100 * (1 - after / before) if before else 0
+    return f"Compacted from {before / 1e6:,.1f} MB to {after / 1e6:,.1f} MB ({saved:.0f}% saved)."
+
+# --- Variable Explorer ---
+VARIABLE_STATS_SAMPLE_ROWS = 100_000 # Column statistics of larger frames are computed on a sample of this size
+
+def variable_shape(value: Any) -> str:
+    shape = getattr(value, 'shape', None)
+    if isinstance(shape, tuple):
+        return ' x '.join(f"{dim:,}" for dim in shape)
+    if isinstance(value, (list, tuple, dict, set, str, bytes)):
+        return f"len {len(value):,}"
+    return ''
+
+def variable_memory_bytes(value: Any) -> int:
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True, index=True))
+    if isinstance(value, SpilledFrame):
+        return value.nbytes
+    nbytes = getattr(value, 'nbytes', None) # numpy arrays
+    if isinstance(nbytes, int):
+        return nbytes
+    return sys.getsizeof(value)
+
+def compute_column_stats(df: pd.DataFrame) -> List[Dict[str, Any]]:
+    """Per-column dtype, null share, distinct count and range. Large frames are sampled, so counts are approximate."""
+    sampled = len(df) > VARIABLE_STATS_SAMPLE_ROWS
+    data = df.sample(n=VARIABLE_STATS_SAMPLE_ROWS, random_state=0) if sampled else df
+    rows = []
+    for position, column in enumerate(data.columns):
+        col = data.iloc[:, position]
+        row = {'column': str(column), 'dtype': str(col.dtype), 'non_null': f"{col.notna().mean() * 100:.1f}%" if len(col) else '',
+               'unique': '', 'min': '', 'max': '', 'mean': '', 'top': ''}
+        try:
+            unique = col.nunique(dropna=True)
+            row['unique'] = f"~{unique:,}" if sampled else f"{unique:,}"
+            if pd.api.types.is_numeric_dtype(col) and not pd.api.types.is_bool_dtype(col):
+                row.update(min=f"{col.min():.6g}", max=f"{col.max():.6g}", mean=f"{col.mean():.6g}")
+            elif pd.api.types.is_datetime64_any_dtype(col):
+                row.update(min=str(col.min()), max=str(col.max()))
+            else:
+                counts = col.value_counts(dropna=True)
+                if len(counts):
+                    row['top'] = f"{str(counts.index[0])[:40]} ({counts.iloc[0]:,})"
+        except (TypeError, ValueError): # Unhashable or unorderable values, e.g. lists in an object column
+            pass
+        rows.append(row)
+    return rows
+
+class VariableExplorer:
+    """Summaries of the notebook namespace, cached per name until the object changes.
+    A name's version is bumped whenever a cell that mentions it runs, since the cell may have mutated it in place."""
+
+    def __init__(self):
+        self.versions: Dict[str, int] = {}
+        self.summaries: Dict[str, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+        self.column_stats: Dict[str, Tuple[Tuple[int, int], List[Dict[str, Any]]]] = {}
+
+    def bump(self, names):
+        for name in names:
+            self.versions[name] = self.versions.get(name, 0) + 1
+
+    def _key(self, name: str, value: Any) -> Tuple[int, int]:
+        return id(value), self.versions.get(name, 0)
+
+    def summarize(self, namespace: Dict[str, Any], frame_sizes: Dict[str, int]) -> List[Dict[str, Any]]:
+        """One row per variable: type, shape and memory. DataFrame sizes come from the memory manager's accounting."""
+        self.summaries = {name: entry for name, entry in self.summaries.items() if name in namespace}
+        self.column_stats = {name: entry for name, entry in self.column_stats.items() if name in namespace}
+        rows = []
+        for name, value in namespace.items():
+            if isinstance(value, types.ModuleType):
+                continue
+            key = self._key(name, value)
+            cached = self.summaries.get(name)
+            if cached is None or cached[0] != key:
+                memory_bytes = frame_sizes[name] if name in frame_sizes else variable_memory_bytes(value)
+                cached = (key, {'name': name, 'type': 'DataFrame (spilled)' if isinstance(value, SpilledFrame) else type(value).__name__,
+                                'shape': variable_shape(value), 'memory': round(memory_bytes / 1e6, 3)})
+                self.summaries[name] = cached
+            rows.append(cached[1])
+        return rows
+
+    async def get_column_stats(self, name: str, df: pd.DataFrame) -> List[Dict[str, Any]]:
+        key = self._key(name, df)
+        cached = self.column_stats.get(name)
+        if cached is None or cached[0] != key:
+            cached = (key, await asyncio.to_thread(compute_column_stats, df))
+            self.column_stats[name] = cached
+        return cached[1]
+
+    def clear(self):
+        self.versions.clear()
+        self.summaries.clear()
+        self.column_stats.clear()
+
+# --- Result Profiling ---
+# Mergeable sketches, so a profile is built batch by batch and can be shown while it grows.
+PROFILE_BATCH_ROWS = 1_000_000
+PROFILE_HLL_PRECISION = 14 # 16,384 registers, about 0.8% standard error
+PROFILE_TDIGEST_COMPRESSION = 200
+PROFILE_TOP_K = 5
+PROFILE_HEAVY_HITTER_CAPACITY = 64 # Counters kept per column; items above rows/64 are never missed
+
+class HyperLogLog:
+    """Distinct count estimate from 64-bit hashes."""
+
+    def __init__(self, precision: int = PROFILE_HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add_hashes(self, hashes: np.ndarray):
+        if not len(hashes):
+            return
+        suffix_bits = 64 - self.precision
+        buckets = (hashes >> np.uint64(suffix_bits)).astype(np.int64)
+        suffix = (hashes & np.uint64((1 << suffix_bits) - 1)).astype(np.float64)
+        bit_length = np.where(suffix > 0, np.frexp(suffix)[1], 0)
+        ranks = (suffix_bits - bit_length + 1).astype(np.uint8) # Leading zeros + 1
+        np.maximum.at(self.registers, buckets, ranks)
+
+    def estimate(self) -> float:
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros) # Linear counting for small cardinalities
+        return float(estimate)
+
+class TDigest:
+    """Merging t-digest (k1 scale function) for quantiles. Compression bins the sorted centroids by
+    floor(k(q)), so every centroid spans at most one unit of k and merging stays vectorized."""
+
+    def __init__(self, compression: int = PROFILE_TDIGEST_COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values: np.ndarray):
+        if not len(values):
+            return
+        self.min, self.max = min(self.min, float(values.min())), max(self.max, float(values.max()))
+        means = np.concatenate([self.means, values])
+        weights = np.concatenate([self.weights, np.ones(len(values))])
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        cumulative = np.cumsum(weights)
+        q = (cumulative - weights / 2) / cumulative[-1]
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        bins = np.floor(k - k.min()).astype(np.int64)
+        bin_weights = np.bincount(bins, weights=weights)
+        filled = bin_weights > 0
+        self.means = np.bincount(bins, weights=means * weights)[filled] / bin_weights[filled]
+        self.weights = bin_weights[filled]
+
+    def quantile(self, q: float) -> float:
+        if not len(self.means):
+            return float('nan')
+        cumulative = np.cumsum(self.weights)
+        centers = (cumulative - self.weights / 2) / cumulative[-1]
+        return float(np.interp(q, np.concatenate([[0.0], centers, [1.0]]),
+                               np.concatenate([[self.min], self.means, [self.max]])))
+
+class HeavyHitters:
+    """Misra-Gries summary for the most frequent values; counts are lower bounds. Each batch is counted exactly,
+    reduced to a summary of its own and merged. Reducing subtracts the (capacity+1)-th largest count from all."""
+
+    def __init__(self, capacity: int = PROFILE_HEAVY_HITTER_CAPACITY):
+        self.capacity = capacity
+        self.counts: Dict[Any, int] = {}
+
+    def _reduce(self, counts: Dict[Any, int]) -> Dict[Any, int]:
+        if len(counts) <= self.capacity:
+            return counts
+        threshold = sorted(counts.values(), reverse=True)[self.capacity]
+        return {value: count - threshold for value, count in counts.items() if count > threshold}
+
+    def add(self, values: pd.Series):
+        batch_counts = values.value_counts() # Sorted, so the batch's own summary is its head
+        if len(batch_counts) > self.capacity:
+            batch_counts = batch_counts.iloc[:self.capacity] - batch_counts.iloc[self.capacity]
+            batch_counts = batch_counts[batch_counts > 0]
+        merged = dict(self.counts)
+        for value, count in batch_counts.items():
+            merged[value] = merged.get(value, 0) + int(count)
+        self.counts = self._reduce(merged)
+
+    def top(self, k: int) -> List[Tuple[Any, int]]:
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)[:k]
+
+class ColumnProfile:
+    """Null rate, distinct count, quantiles and frequent values of one column, updated batch by batch."""
+
+    def __init__(self, name: str, dtype):
+        self.name = name
+        self.dtype = str(dtype)
+        self.datetime = pd.api.types.is_datetime64_any_dtype(dtype)
+        numeric = pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+        self.rows = 0
+        self.nulls = 0
+        self.distinct: Optional[HyperLogLog] = HyperLogLog()
+        self.quantiles = TDigest() if numeric or self.datetime else None # Datetimes as epoch nanoseconds
+        self.frequent: Optional[HeavyHitters] = HeavyHitters()
+
+    def update(self, column: pd.Series):
+        self.rows += len(column)
+        values = column.dropna()
+        self.nulls += len(column) - len(values)
+        if self.distinct is not None:
+            try:
+                self.distinct.add_hashes(pd.util.hash_pandas_object(values, index=False).to_numpy())
+            except TypeError: # Unhashable values, e.g. lists from JSON columns
+                self.distinct = None
+        if self.quantiles is not None:
+            if self.datetime:
+                if isinstance(values.dtype, pd.DatetimeTZDtype):
+                    values = values.dt.tz_localize(None) # Wall-clock time
+                numbers = values.to_numpy(dtype='datetime64[ns]').astype('int64').astype('float64')
+            else:
+                numbers = values.to_numpy(dtype='float64', na_value=np.nan)
+            self.quantiles.add(numbers[np.isfinite(numbers)])
+        if self.frequent is not None:
+            try:
+                self.frequent.add(values)
+            except TypeError:
+                self.frequent = None
+
+    def summary(self) -> Dict[str, Any]:
+        def number(value: float) -> str:
+            if np.isnan(value):
+                return ''
+            return str(pd.Timestamp(int(value)).round('s')) if self.datetime else f'{value:,.4g}'
+        row = {'column': self.name, 'dtype': self.dtype,
+               'nulls': f'{self.nulls / self.rows:.1%}' if self.rows else '',
+               'distinct': f'≈{min(self.distinct.estimate(), self.rows - self.nulls):,.0f}' if self.distinct is not None else 'n/a',
+               'min': '', 'p25': '', 'p50': '', 'p75': '', 'p99': '', 'max': '', 'top': ''}
+        if self.quantiles is not None and len(self.quantiles.means):
+            row.update(min=number(self.quantiles.min), max=number(self.quantiles.max),
+                       **{f'p{int(q * 100)}': number(self.quantiles.quantile(q)) for q in (0.25, 0.5, 0.75, 0.99)})
+        if self.frequent is not None: # Only values frequent enough for the summary to be reliable about
+            min_count = (self.rows - self.nulls) / self.frequent.capacity
+            row['top'] = ', '.join(f'{str(value)[:30]} ({count:,}+)' for value, count in self.frequent.top(PROFILE_TOP_K)
+                                   if count >= min_count)
+        return row
+
+class ResultProfile:
+    """Sketch-based profile of a result DataFrame. update() takes one batch of rows and is meant to run in
+    a worker thread; rows_profiled tells how far a profile built batch by batch has got."""
+
+    def __init__(self, df: pd.DataFrame):
+        self.total_rows = len(df)
+        self.rows_profiled = 0
+        self.columns = [ColumnProfile(str(name), dtype) for name, dtype in df.dtypes.items()]
+
+    @property
+    def complete(self) -> bool:
+        return self.rows_profiled >= self.total_rows
+
+    def update(self, batch: pd.DataFrame):
+        for position, column in enumerate(self.columns):
+            column.update(batch.iloc[:, position])
+        self.rows_profiled += len(batch)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        return [column.summary() for column in self.columns]
+
+# --- Cell Dataflow ---
+class _PythonNameCollector(ast.NodeVisitor):
+    """Collects the names a cell reads and the module-level names it binds or mutates. Assigning to an item or
+    attribute (`df['x'] = ...`, `obj.attr = ...`) counts as a write of the base name, and augmented assignment
+    (`total += 1`) as a read and a write. Names bound inside functions, classes, lambdas and comprehensions are
+    local to them and are not counted as writes."""
+
+    def __init__(self):
+        self.reads: set = set()
+        self.writes: set = set()
+        self.depth = 0
+
+    def _bind(self, name: str):
+        if self.depth == 0:
+            self.writes.add(name)
+
+    def _visit_scope(self, node):
+        self.depth += 1
+        self.generic_visit(node)
+        self.depth -= 1
+
+    visit_Lambda = visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _visit_scope
+
+    def visit_FunctionDef(self, node):
+        self._bind(node.name)
+        self._visit_scope(node)
+
+    visit_AsyncFunctionDef = visit_ClassDef = visit_FunctionDef
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name != '*':
+                self._bind((alias.asname or alias.name).split('.')[0])
+
+    visit_ImportFrom = visit_Import
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.reads.add(node.id)
+        else:
+            self._bind(node.id)
+
+    def visit_Subscript(self, node):
+        if isinstance(node.ctx, (ast.Store, ast.Del)):
+            base = node.value
+            while isinstance(base, (ast.Subscript, ast.Attribute)):
+                base = base.value
+            if isinstance(base, ast.Name): # The base itself is a Load, so it is also recorded as a read
+                self._bind(base.id)
+        self.generic_visit(node)
+
+    visit_Attribute = visit_Subscript
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self.reads.add(node.target.id)
+        self.generic_visit(node)
+
+def cell_dataflow_names(cell_type: str, code: str, df_name: str = '') -> Tuple[set, set]:
+    """Static (reads, writes) of a cell. Item and attribute assignments count as writes of the base name;
+    mutations through method calls (df.drop(..., inplace=True), lst.append(x)) are not visible."""
+    writes = {df_name} if df_name and cell_type in SQL_CELL_TYPES else set()
+    if cell_type == 'SQL':
+        return set(), writes # Reads only from the database
+    if cell_type == 'Local SQL':
+        return referenced_names(code), writes
+    try:
+        collector = _PythonNameCollector()
+        collector.visit(ast.parse(code))
+        return collector.reads, collector.writes
+    except SyntaxError:
+        names = referenced_names(code)
+        return names, names
+
+class CellDataflow:
+    """Write versions of notebook variables and the inputs each cell last ran with, so 'Run stale' can skip
+    cells whose code and inputs are unchanged."""
+
+    def __init__(self):
+        self.write_versions: Dict[str, int] = {}
+        self.cell_states: Dict[str, Dict[str, Any]] = {} # cell id -> {'fingerprint', 'inputs': {name: version}}
+
+    def record_write(self, names):
+        for name in names:
+            self.write_versions[name] = self.write_versions.get(name, 0) + 1
+
+    def record_run(self, cell_id: str, fingerprint: str, reads, writes):
+        # Inputs are captured after the cell's own writes, so a cell like `x = x + 1` is not stale because of itself
+        self.record_write(writes)
+        self.cell_states[cell_id] = {'fingerprint': fingerprint,
+                                     'inputs': {name: self.write_versions.get(name, 0) for name in reads}}
+
+    def forget(self, cell_id: str):
+        self.cell_states.pop(cell_id, None)
+
+    def is_stale(self, cell_id: str, fingerprint: str) -> bool:
+        state = self.cell_states.get(cell_id)
+        if state is None or state['fingerprint'] != fingerprint:
+            return True
+        return any(self.write_versions.get(name, 0) != version for name, version in state['inputs'].items())
+
+    @staticmethod
+    def execution_order(cell_ids: List[str], names: Dict[str, Tuple[set, set]]) -> List[str]:
+        """Topological order of cells, where a cell depends on the nearest earlier cell that writes a name it reads
+        (or the last writer anywhere, for notebooks written out of order). Ties and cycles keep document order."""
+        position = {cell_id: index for index, cell_id in enumerate(cell_ids)}
+        writers: Dict[str, List[str]] = {}
+        for cell_id in cell_ids:
+            for name in names[cell_id][1]:
+                writers.setdefault(name, []).append(cell_id)
+        upstream: Dict[str, set] = {cell_id: set() for cell_id in cell_ids}
+        for cell_id in cell_ids:
+            for name in names[cell_id][0]:
+                candidates = [writer for writer in writers.get(name, []) if writer != cell_id]
+                if not candidates:
+                    continue
+                earlier = [writer for writer in candidates if position[writer] < position[cell_id]]
+                upstream[cell_id].add(earlier[-1] if earlier else candidates[-1])
+
+        order, done = [], set()
+        while len(order) < len(cell_ids):
+            ready = [cell_id for cell_id in cell_ids if cell_id not in done and upstream[cell_id] <= done]
+            next_id = ready[0] if ready else next(cell_id for cell_id in cell_ids if cell_id not in done) # Break cycles
+            order.append(next_id)
+            done.add(next_id)
+        return order
+
+    def clear(self):
+        self.write_versions.clear()
+        self.cell_states.clear()
+
+# --- Cell Outputs ---
+class CellOutput:
+    """One typed piece of a cell's output. Pages render 'html', 'text', 'image' and 'table' outputs with
+    elements that send the payload as-is; only 'markdown' (short notes and error headings) is converted.
+    'repr' is a truncated text repr whose handle lets the page fetch a longer one."""
+    __slots__ = ('kind', 'data')
+
+    def __init__(self, kind: str, data: Any):
+        self.kind = kind # html | text | image (src) | table ({'html', 'shape'}) | repr ({'text', 'handle', 'level'}) | chart (ChartSpec) | markdown
+        self.data = data
+
+    def size(self) -> int:
+        if self.kind == 'table':
+            return len(self.data['html'])
+        if self.kind == 'repr':
+            return len(self.data['text'])
+        if self.kind == 'chart':
+            return self.data.payload_size
+        return len(self.data)
+
+    def __repr__(self):
+        return f"CellOutput({self.kind!r}, {self.size():,} chars)"
+
+def table_output(df: pd.DataFrame, max_rows: int) -> CellOutput:
+    with metrics.stage('render'):
+        html_table = df.to_html(classes='dataframe', border=0, max_rows=max_rows, escape=False)
+    return CellOutput('table', {'html': html_table, 'shape': df.shape})
+
+def row_limit_note(rows: int, show_all_rows: bool) -> Optional[CellOutput]:
+    if not show_all_rows and rows > 20:
+        return CellOutput('markdown', f"*Showing first 20 of {rows} rows. To see 200 rows, toggle 'Show all rows' in this cell's header.*")
+    if show_all_rows and rows > 200:
+        return CellOutput('markdown', f"*Showing first 200 of {rows} rows due to display limit. Full DataFrame is available in memory.*")
+    if show_all_rows and rows > 20:
+        return CellOutput('markdown', f"*Showing all {rows} rows.*")
+    return None
+
+REPR_MAX_ITEMS = int(os.environ.get('DNB_REPR_MAX_ITEMS', '50')) # Per container, Series or array
+REPR_MAX_CHARS = int(os.environ.get('DNB_REPR_MAX_CHARS', '10000'))
+REPR_MAX_RICH_CHARS = 1_000_000 # Larger _repr_html_ / _repr_markdown_ results fall back to the bounded repr
+REPR_EXPAND_FACTOR = 10 # Each "Show more" multiplies the limits
+REPR_MAX_LEVEL = 3
+REPR_HANDLES_PER_SESSION = 50
+RICH_REPR_METHODS = (('_repr_html_', 'html'), ('_repr_svg_', 'html'), ('_repr_markdown_', 'markdown'), ('_repr_png_', 'image'))
+
+def _call_repr_method(obj, name: str):
+    method = getattr(obj, name, None)
+    if not callable(method):
+        return None
     try:
-        rows = await notebook.db_connection.fetch("""
+        return method()
+    except Exception:
+        return None
+
+class _BoundedRepr(reprlib.Repr):
+    """reprlib.Repr that sets `truncated` when it elides items, characters or nesting levels. Subclasses of the
+    builtin containers (OrderedDict, Counter, defaultdict, namedtuples...) are bounded like their base type;
+    reprlib alone would build their full repr first."""
+    CONTAINER_LIMITS = {'tuple': 'maxtuple', 'list': 'maxlist', 'array': 'maxarray', 'set': 'maxset',
+                        'frozenset': 'maxfrozenset', 'deque': 'maxdeque', 'dict': 'maxdict'}
+    CONTAINER_TYPES = ((dict, 'dict'), (list, 'list'), (tuple, 'tuple'), (set, 'set'), (frozenset, 'frozenset'),
+                       (deque, 'deque'))
+
+    def __init__(self, max_items: int, max_chars: int):
+        super().__init__()
+        self.maxlevel = 4
+        for limit in self.CONTAINER_LIMITS.values():
+            setattr(self, limit, max_items)
+        self.maxstring = self.maxlong = self.maxother = max_chars
+        self.truncated = False
+
+    def repr1(self, x, level):
+        kind = type(x).__name__
+        if kind not in self.CONTAINER_LIMITS:
+            kind = next((name for base, name in self.CONTAINER_TYPES if isinstance(x, base)), None)
+        if kind is None:
+            return super().repr1(x, level)
+        if len(x) > getattr(self, self.CONTAINER_LIMITS[kind]) or (level <= 0 and len(x)):
+            self.truncated = True
+        if kind == type(x).__name__:
+            return super().repr1(x, level)
+        return self._repr_subclass(x, level, kind)
+
+    def _repr_subclass(self, x, level, kind: str) -> str:
+        name = type(x).__name__
+        if kind == 'tuple' and hasattr(x, '_fields'): # namedtuple
+            if level <= 0:
+                return f"{name}(...)"
+            fields = [f"{field}={self.repr1(value, level - 1)}" for field, value in zip(x._fields[:self.maxtuple], x)]
+            return f"{name}({', '.join(fields)}{', ...' if len(x) > self.maxtuple else ''})"
+        inner = getattr(self, 'repr_' + kind)(x, level)
+        if isinstance(x, defaultdict):
+            return f"{name}({self.repr1(x.default_factory, level - 1)}, {inner})"
+        return f"{name}({inner})"
+
+    def repr_str(self, x, level):
+        if len(builtins.repr(x[:self.maxstring])) > self.maxstring: # The condition reprlib elides on
+            self.truncated = True
+        return super().repr_str(x, level)
+
+    def repr_int(self, x, level):
+        text = super().repr_int(x, level)
+        self.truncated |= '...' in text # Digits never contain it
+        return text
+
+    def repr_instance(self, x, level):
+        try:
+            text = builtins.repr(x)
+        except Exception:
+            return super().repr_instance(x, level)
+        if len(text) <= self.maxother:
+            return text
+        self.truncated = True
+        head = max(0, (self.maxother - 3) // 2)
+        return text[:head] + '...' + text[len(text) - max(0, self.maxother - 3 - head):]
+
+def bounded_repr(obj, level: int = 1) -> Tuple[str, bool]:
+    """repr limited to REPR_MAX_ITEMS entries per container and REPR_MAX_CHARS overall, scaled up by `level`.
+    Series and arrays are summarized by pandas and numpy themselves. Returns the text and whether it was shortened."""
+    scale = REPR_EXPAND_FACTOR ** (level - 1)
+    max_items, max_chars = REPR_MAX_ITEMS * scale, REPR_MAX_CHARS * scale
+    if is_module_loaded('pandas') and isinstance(obj, pd.Series):
+        text, truncated = obj.to_string(max_rows=max_items, length=True, dtype=True, name=True), len(obj) > max_items
+    elif is_module_loaded('numpy') and isinstance(obj, np.ndarray):
+        with np.printoptions(threshold=max_items, edgeitems=max(3, max_items // 2)):
+            text = repr(obj)
+        truncated = obj.size > max_items
+    else:
+        limits = _BoundedRepr(max_items, max_chars)
+        text = limits.repr(obj)
+        truncated = limits.truncated
+    if len(text) > max_chars:
+        text, truncated = text[:max_chars] + '...', True
+    return text, truncated
+
+def rich_output(obj, level: int = 1) -> Tuple[CellOutput, bool]:
+    """Display protocol for Python objects: _repr_html_ and similar methods first, then the bounded repr."""
+    if level == 1:
+        for method, kind in RICH_REPR_METHODS:
+            value = _call_repr_method(obj, method)
+            if kind == 'image' and isinstance(value, bytes):
+                return CellOutput('image', f"data:image/png;base64,{base64.b64encode(value).decode('utf-8')}"), False
+            if isinstance(value, str) and len(value) <= REPR_MAX_RICH_CHARS:
+                return CellOutput(kind, value), False
+    text, truncated = bounded_repr(obj, level)
+    return CellOutput('text', text), truncated and level < REPR_MAX_LEVEL
+
+# --- Client-side Charts ---
+CHART_KINDS = ('line', 'scatter', 'bar')
+CHART_HEIGHT_PX = 360
+
+def chart_column(values) -> Tuple[np.ndarray, str]:
+    """A column as float64 (datetimes as epoch milliseconds, NaN for missing values) with its axis type,
+    or as an object array for a category axis."""
+    series = pd.Series(values)
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        series = series.dt.tz_localize(None) # Wall-clock time
+    if pd.api.types.is_datetime64_dtype(series):
+        array = series.to_numpy()
+        milliseconds = array.astype('datetime64[ms]').astype('int64').astype('float64')
+        return np.where(np.isnat(array), np.nan, milliseconds), 'time'
+    if pd.api.types.is_numeric_dtype(series):
+        return series.to_numpy(dtype='float64', na_value=np.nan), 'value'
+    return series.to_numpy(dtype=object), 'category'
+
+def encode_chart_column(array: np.ndarray) -> Any:
+    """float64 columns become a base64 little-endian buffer that the page decodes with dnbColumns;
+    category columns are sent as JSON lists of strings."""
+    if array.dtype.kind == 'f':
+        return base64.b64encode(array.astype('<f8').tobytes()).decode('ascii')
+    return [None if value is None else str(value) for value in array.tolist()]
+
+class ChartSpec:
+    """What chart() returns: ECharts options with encoded columns, displayed as a 'chart' output."""
+
+    def __init__(self, options: Dict[str, Any], points: int, payload_size: int, note: Optional[str] = None):
+        self.options = options
+        self.points = points
+        self.payload_size = payload_size
+        self.note = note # Shown under the chart, e.g. the downsampling ratio
+
+    def __repr__(self):
+        return f"<chart: {self.points:,} points>"
+
+def chart_frame(data, x: Optional[str], y) -> Tuple[pd.DataFrame, str, List[Any]]:
+    """Normalizes chart input to a DataFrame, the x axis name and the y columns (default: all numeric ones)."""
+    if isinstance(data, pd.Series):
+        frame = data.to_frame(name=data.name if data.name is not None else 'value')
+    elif isinstance(data, pd.DataFrame):
+        frame = data
+    else:
+        frame = pd.DataFrame(data)
+    x_name = str(x if x is not None else (frame.index.name or 'index'))
+    if y is None:
+        y_names = [name for name in frame.columns if name != x and pd.api.types.is_numeric_dtype(frame[name])]
+    else:
+        y_names = [y] if isinstance(y, str) else list(y)
+    missing = [name for name in ([x] if x is not None else []) + y_names if name not in frame.columns]
+    if missing:
+        raise KeyError(f"Columns not found: {', '.join(map(str, missing))}")
+    return frame, x_name, y_names
+
+def check_chart_kind(kind: str):
+    if kind not in CHART_KINDS:
+        raise ValueError(f"kind must be one of {', '.join(CHART_KINDS)}")
+
+def build_chart(x_name: str, x_array: np.ndarray, x_axis_type: str, y_arrays: Dict[str, np.ndarray],
+                kind: str, title: Optional[str], note: Optional[str] = None) -> ChartSpec:
+    check_chart_kind(kind)
+    if kind == 'bar' and x_axis_type == 'value':
+        x_axis_type = 'category'
+    # Dataset keys are positional so that an index and a column with the same name (e.g. 'index') stay apart
+    y_keys = {name: f'y{position}' for position, name in enumerate(y_arrays)}
+    with metrics.stage('render'):
+        columns = {'x': encode_chart_column(x_array)}
+        for name, array in y_arrays.items():
+            columns[y_keys[name]] = encode_chart_column(array)
+        columns_json = json.dumps(columns)
+    dimensions = [{'name': 'x', 'displayName': x_name}] + [{'name': key, 'displayName': name} for name, key in y_keys.items()]
+
+    options = {
+        'animation': False,
+        'title': {'text': title or '', 'left': 'center', 'textStyle': {'fontSize': 14}},
+        'tooltip': {'trigger': 'axis' if kind != 'scatter' else 'item'},
+        'legend': {'show': len(y_arrays) > 1, 'top': 24},
+        'grid': {'left': 60, 'right': 24, 'top': 56, 'bottom': 64},
+        'dataset': {'dimensions': dimensions, ':source': f'dnbColumns({columns_json})'}, # Evaluated in the browser
+        'xAxis': {'type': x_axis_type, 'name': x_name},
+        'yAxis': {'type': 'value', 'scale': True},
+        'dataZoom': [{'type': 'inside'}, {'type': 'slider'}],
+        'series': [{'type': kind, 'name': name, 'encode': {'x': 'x', 'y': key},
+                    'showSymbol': kind == 'scatter', 'symbolSize': 4} for name, key in y_keys.items()],
+    }
+    return ChartSpec(options, len(x_array) * len(y_arrays), len(columns_json), note)
+
+def chart(data, x: Optional[str] = None, y=None, kind: str = 'line', title: Optional[str] = None) -> ChartSpec:
+    """Interactive chart drawn in the browser with ECharts; pan and zoom don't re-run the cell.
+    `data` is a DataFrame, Series or dict of columns. `x` defaults to the index, `y` to every numeric column.
+    Use plot_series() for series too long to send whole."""
+    frame, x_name, y_names = chart_frame(data, x, y)
+    x_array, x_axis_type = chart_column(frame.index if x is None else frame[x])
+    y_arrays = {str(name): chart_column(frame[name])[0] for name in y_names}
+    return build_chart(x_name, x_array, x_axis_type, y_arrays, kind, title)
+
+# --- Plot Downsampling ---
+CHART_DEFAULT_WIDTH_PX = 1200 # Typical cell output width; charts are drawn in the browser so the real width is unknown
+DOWNSAMPLE_POINTS_PER_PIXEL = 2
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+def minmax_indices(y: np.ndarray, buckets: int) -> np.ndarray:
+    """Sorted indices of the first and last point and of the minimum and maximum of each of `buckets`
+    equal-count buckets. Vectorized: the buckets are rows of a reshaped view."""
+    n = len(y)
+    if n <= 2 * buckets + 2:
+        return np.arange(n)
+    size = n // buckets
+    rows = y[:size * buckets].reshape(buckets, size)
+    offsets = np.arange(buckets) * size
+    picks = [np.array([0, n - 1]), offsets + rows.argmin(axis=1), offsets + rows.argmax(axis=1)]
+    if size * buckets < n: # Remainder after the last full bucket
+        tail = y[size * buckets:]
+        picks.append(np.array([size * buckets + tail.argmin(), size * buckets + tail.argmax()]))
+    return np.unique(np.concatenate(picks))
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets: keeps the first and last point and, per bucket, the point forming the
+    largest triangle with the previously kept point and the next bucket's average. The loop runs over
+    buckets only; each bucket is a vectorized numpy step."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64) # n_out - 2 buckets between the end points
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        average_x, average_y = x[end:next_end].mean(), y[end:next_end].mean()
+        areas = np.abs((x[previous] - average_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (average_y - y[previous]))
+        previous = start + int(areas.argmax())
+        selected[bucket + 1] = previous
+    return selected
+
+def downsample_indices(x: np.ndarray, y: np.ndarray, n_out: int, method: str = 'lttb') -> np.ndarray:
+    """Indices of at most about n_out points that keep the series' shape. LTTB runs on a min/max preselection
+    of four points per output point, so its per-bucket loop stays short on very long series."""
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"method must be one of {', '.join(DOWNSAMPLE_METHODS)}")
+    if len(y) <= n_out:
+        return np.arange(len(y))
+    if method == 'minmax':
+        return minmax_indices(y, max(1, n_out // 2))
+    candidates = minmax_indices(y, 2 * n_out)
+    return candidates[lttb_indices(x[candidates], y[candidates], n_out)]
+
+def plot_series(data, x: Optional[str] = None, y=None, kind: str = 'line', width: Optional[int] = None,
+                method: str = 'lttb', backend: str = 'matplotlib', title: Optional[str] = None):
+    """Plots long series after downsampling them to what `width` pixels can show (LTTB or min/max buckets).
+    backend='matplotlib' returns a Figure, backend='chart' an interactive chart; both show the reduction."""
+    check_chart_kind(kind)
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"method must be one of {', '.join(DOWNSAMPLE_METHODS)}")
+    if backend not in ('matplotlib', 'chart'):
+        raise ValueError("backend must be 'matplotlib' or 'chart'")
+    frame, x_name, y_names = chart_frame(data, x, y)
+    x_array, x_axis_type = chart_column(frame.index if x is None else frame[x])
+    positions = x_array if x_axis_type != 'category' else np.arange(len(x_array), dtype='float64')
+    order = None
+    if x_axis_type != 'category' and len(positions) > 1 and np.any(np.diff(positions) < 0):
+        order = np.argsort(positions, kind='stable') # LTTB and buckets assume x in order
+        positions, x_array = positions[order], x_array[order]
+
+    if backend == 'matplotlib': # The figure is only created once the data is ready, so errors leave none behind
+        width = width or int(plt.rcParams['figure.figsize'][0] * plt.rcParams['figure.dpi'])
+    else:
+        width = width or CHART_DEFAULT_WIDTH_PX
+    n_out = width * DOWNSAMPLE_POINTS_PER_PIXEL
+
+    with metrics.stage('render'):
+        y_arrays, keep, finite, reduced = {}, [], [], False
+        for name in y_names:
+            values = chart_column(frame[name])[0]
+            values = values[order] if order is not None else values
+            y_arrays[str(name)] = values
+            valid = np.flatnonzero(np.isfinite(values) & np.isfinite(positions))
+            selected = downsample_indices(positions[valid], values[valid], n_out, method)
+            reduced = reduced or len(selected) < len(valid)
+            keep.append(valid[selected])
+            finite.append(valid)
+        kept = np.unique(np.concatenate(keep)) if keep else np.arange(0)
+        plotted = len(np.unique(np.concatenate(finite))) if finite else 0
+
+    notes = []
+    if reduced:
+        notes.append(f"Downsampled {plotted:,} to {len(kept):,} points ({plotted / max(1, len(kept)):,.0f}x fewer) "
+                     f"with {method} for {width}px.")
+    dropped = len(x_array) - plotted
+    if dropped and y_names:
+        notes.append(f"Left out {dropped:,} {'row' if dropped == 1 else 'rows'} with missing or infinite values.")
+    note = f"*{' '.join(notes)}*" if notes else None
+
+    if backend == 'chart':
+        return build_chart(x_name, x_array[kept], x_axis_type, {name: values[kept] for name, values in y_arrays.items()},
+                           kind, title, note)
+    x_plot = x_array[kept]
+    if x_axis_type == 'time':
+        x_plot = x_plot.astype('int64').astype('datetime64[ms]')
+    figure, axes = plt.subplots()
+    try:
+        for name, values in y_arrays.items():
+            if kind == 'scatter':
+                axes.scatter(x_plot, values[kept], s=4, label=name)
+            elif kind == 'bar':
+                axes.bar(x_plot, values[kept], label=name)
+            else:
+                axes.plot(x_plot, values[kept], label=name)
+        axes.set_xlabel(x_name)
+        if len(y_arrays) > 1:
+            axes.legend()
+        if title:
+            axes.set_title(title)
+    except Exception:
+        plt.close(figure)
+        raise
+    figure.dnb_note = note # Shown under the image by display
+    return figure
+
+# --- Background Jobs ---
+class CellJob:
+    """One execution of a cell. It is owned by the server, so it keeps running and keeps its result
+    when the page that started it goes away."""
+
+    def __init__(self, cell_id: str):
+        self.id = uuid.uuid4().hex[:8]
+        self.cell_id = cell_id
+        self.status = 'running' # running | finished | failed | cancelled
+        self.submitted_at = time.perf_counter()
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.result: Dict[str, Any] = {}
+        self.task: Optional[asyncio.Task] = None
+        self.stdout: Optional[StreamingOutput] = None
+        self.done = asyncio.Event()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.time()) - self.started_at
+
+class JobRunner:
+    """Runs cell jobs as server-side tasks and keeps the latest job per cell, running or finished."""
+
+    def __init__(self, max_concurrent: int):
+        self.jobs: Dict[str, CellJob] = {}
+        self.slots = asyncio.Semaphore(max_concurrent) # Jobs beyond the limit wait, which shows up as queue_wait
+
+    def submit(self, cell_id: str, work) -> CellJob:
+        """Starts `work(job)`, a coroutine function returning the result dict, and supersedes the cell's finished jobs."""
+        for job_id, job in list(self.jobs.items()):
+            if job.cell_id == cell_id and job.done.is_set():
+                del self.jobs[job_id]
+        job = CellJob(cell_id)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, work))
+        return job
+
+    async def _run(self, job: CellJob, work):
+        try:
+            async with self.slots:
+                job.result = await work(job)
+            job.status = 'finished' if job.result.get('success') else 'failed'
+        except asyncio.CancelledError:
+            self._mark_cancelled(job)
+        except Exception as e:
+            logger.error(f"Job {job.id} for cell {job.cell_id} failed: {e}", exc_info=True)
+            job.status = 'failed'
+            job.result = {'success': False, 'error': 'Unexpected',
+                          'outputs': [CellOutput('markdown', f"**Unexpected Error:** {str(e)}"), CellOutput('text', traceback.format_exc())]}
+        finally:
+            job.finished_at = time.time()
+            job.done.set()
+
+    @staticmethod
+    def _mark_cancelled(job: CellJob):
+        job.status = 'cancelled'
+        job.result = {'success': False, 'outputs': [CellOutput('text', 'Execution was cancelled.')]}
+        job.finished_at = time.time()
+        job.done.set()
+
+    def latest_for_cell(self, cell_id: str) -> Optional[CellJob]:
+        jobs = [job for job in self.jobs.values() if job.cell_id == cell_id]
+        return jobs[-1] if jobs else None
+
+    def discard_cell(self, cell_id: str):
+        for job_id, job in list(self.jobs.items()):
+            if job.cell_id == cell_id:
+                if job.task and not job.task.done():
+                    job.task.cancel()
+                    self._mark_cancelled(job) # A task cancelled before it starts never runs _run
+                del self.jobs[job_id]
+
+    def clear(self):
+        for cell_id in {job.cell_id for job in self.jobs.values()}:
+            self.discard_cell(cell_id)
+
+# --- Cell Execution Context ---
+# Python cells run concurrently with each other and with the server, so neither stdout nor the working
+# directory can be swapped process-wide. Both are looked up through context variables instead, which
+# asyncio tasks and asyncio.to_thread inherit.
+_cell_stdout: contextvars.ContextVar[Optional[io.TextIOBase]] = contextvars.ContextVar('cell_stdout', default=None)
+_cell_working_directory: contextvars.ContextVar[Optional[Path]] = contextvars.ContextVar('cell_working_directory', default=None)
+
+class ContextStdout(io.TextIOBase):
+    """sys.stdout replacement that sends writes to the running cell's buffer, and everything else to the real stdout."""
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def _target(self):
+        return _cell_stdout.get() or self.fallback
+
+    def write(self, text: str) -> int:
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def isatty(self) -> bool:
+        return self.fallback.isatty()
+
+    def fileno(self) -> int:
+        return self.fallback.fileno()
+
+    @property
+    def encoding(self):
+        return getattr(self.fallback, 'encoding', 'utf-8')
+
+if not isinstance(sys.stdout, ContextStdout):
+    sys.stdout = ContextStdout(sys.stdout)
+
+STDOUT_HEAD_CHARS = 20_000
+STDOUT_TAIL_CHARS = 20_000
+STDOUT_LOG_DIR = '.dnb_output' # Under the working directory
+STDOUT_LOG_KEEP = 50 # Older logs are deleted when a new one is started
+STDOUT_STREAM_INTERVAL_SECONDS = 0.5
+
+def prune_output_logs(log_dir: Path, keep: int):
+    """Deletes all but the `keep` most recently modified output logs in the directory."""
+    logs = []
+    for item in log_dir.glob('*.log'):
+        try:
+            logs.append((item.stat().st_mtime, item))
+        except OSError: # Removed by a concurrent prune
+            pass
+    for _, item in sorted(logs, reverse=True)[keep:]:
+        item.unlink(missing_ok=True)
+
+class StreamingOutput(io.TextIOBase):
+    """Bounded stdout capture for one cell run: keeps the first and the last characters in memory and, once
+    output outgrows them, writes the full log to a file in the working directory. `version` changes on
+    every write so pages can poll it to stream progress."""
+
+    def __init__(self, log_dir: Optional[Path] = None, name: str = 'cell',
+                 head_limit: int = STDOUT_HEAD_CHARS, tail_limit: int = STDOUT_TAIL_CHARS):
+        self.log_dir = log_dir
+        self.name = name
+        self.head_limit = head_limit
+        self.tail_limit = tail_limit
+        self.head: List[str] = []
+        self.head_size = 0
+        self.tail: deque = deque()
+        self.tail_size = 0
+        self.total_size = 0
+        self.version = 0
+        self.log_path: Optional[Path] = None
+        self.log_file = None
+        self.lock = threading.Lock() # Cells may print from asyncio.to_thread workers
+
+    def write(self, text: str) -> int:
+        written = len(text)
+        if not text:
+            return 0
+        with self.lock:
+            self.total_size += written
+            self.version += 1
+            if self.head_size < self.head_limit:
+                room = self.head_limit - self.head_size
+                self.head.append(text[:room])
+                self.head_size += len(text[:room])
+                text = text[room:]
+                if not text:
+                    return written
+            if self.log_file is None:
+                self._open_log()
+            if self.log_file is not None:
+                self.log_file.write(text)
+            text = text[-self.tail_limit:] # Anything before is only in the log
+            self.tail.append(text)
+            self.tail_size += len(text)
+            while self.tail_size > self.tail_limit:
+                excess = self.tail_size - self.tail_limit
+                if len(self.tail[0]) <= excess:
+                    self.tail_size -= len(self.tail.popleft())
+                else:
+                    self.tail[0] = self.tail[0][excess:]
+                    self.tail_size -= excess
+        return written
+
+    def _open_log(self):
+        """Starts the full log with everything kept so far. Without a usable directory only head and tail survive."""
+        if self.log_dir is None:
+            return
+        try:
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+            prune_output_logs(self.log_dir, STDOUT_LOG_KEEP - 1)
+            self.log_path = self.log_dir / f"{self.name}-{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}.log"
+            self.log_file = open(self.log_path, 'x', encoding='utf-8')
+            self.log_file.write(''.join(self.head))
+        except OSError as e:
+            logger.warning(f"Could not write the output log to {self.log_dir}: {e}")
+            self.log_dir = None
+
+    def getvalue(self) -> str:
+        with self.lock:
+            head = ''.join(self.head)
+            if not self.tail:
+                return head
+            tail = ''.join(self.tail)
+            omitted = self.total_size - self.head_size - len(tail)
+            if omitted <= 0:
+                return head + tail
+            head = head[:head.rfind('\n') + 1] or head # Cut at line boundaries
+            tail = tail[-self.tail_limit:].partition('\n')[2] or tail[-self.tail_limit:]
+            omitted = self.total_size - len(head) - len(tail)
+            location = f"full output in {self.log_path}" if self.log_path else "full output was not saved"
+        return f"{head}... {omitted:,} characters omitted ({location}) ...\n{tail}"
+
+    def flush(self):
+        if self.log_file is not None:
+            self.log_file.flush()
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+PATH_KEYWORDS = ('filepath_or_buffer', 'path', 'path_or_buf', 'path_or_buffer', 'io', 'excel_writer', 'fname', 'file',
+                 'src', 'dst')
+DIR_FD_KEYWORDS = ('dir_fd', 'src_dir_fd', 'dst_dir_fd') # Paths relative to a directory descriptor are left alone
+
+def resolve_cell_path(value: Any) -> Any:
+    """Resolves a relative path against the running cell's working directory. Other values pass through."""
+    base = _cell_working_directory.get()
+    if base is None or not isinstance(value, (str, os.PathLike)):
+        return value
+    path_text = os.fspath(value)
+    if not isinstance(path_text, str) or '://' in path_text or os.path.isabs(path_text):
+        return value
+    resolved = base / path_text
+    return str(resolved) if isinstance(value, str) else resolved
+
+def _with_cell_paths(func, positions=0):
+    """Wraps a file function so its path arguments (positional `positions` or known keywords) are resolved per cell.
+    Called without a path, directory listings default to the cell's working directory like os.listdir() to the CWD."""
+    positions = (positions,) if isinstance(positions, int) else positions
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        base = _cell_working_directory.get()
+        if base is not None and not any(kwargs.get(keyword) is not None for keyword in DIR_FD_KEYWORDS):
+            if not args and not kwargs and func.__name__ in ('listdir', 'scandir'):
+                args = (str(base),)
+            args = tuple(resolve_cell_path(arg) if index in positions else arg for index, arg in enumerate(args))
+            for keyword in PATH_KEYWORDS:
+                if keyword in kwargs:
+                    kwargs[keyword] = resolve_cell_path(kwargs[keyword])
+        return func(*args, **kwargs)
+    wrapper._dnb_cell_paths = True
+    return wrapper
+
+def _cell_getcwd(func):
+    """os.getcwd that returns the cell's working directory, so Path.cwd(), os.path.abspath and Path.resolve agree with it."""
+    @functools.wraps(func)
+    def wrapper():
+        base = _cell_working_directory.get()
+        return str(base) if base is not None else func()
+    wrapper._dnb_cell_paths = True
+    return wrapper
+
+# File entry points of the libraries cells use most; (module, attribute owner path, names, path argument positions).
+# pathlib, glob, os.path and os.walk go through the os and io functions, so they are covered as well.
+CELL_PATH_HOOKS = [
+    ('os', '', ('stat', 'lstat', 'listdir', 'scandir', 'open', 'access', 'chmod', 'utime', 'mkdir', 'makedirs',
+                'rmdir', 'removedirs', 'remove', 'unlink'), 0),
+    ('os', '', ('rename', 'replace', 'link'), (0, 1)),
+    ('io', '', ('open',), 0),
+    ('shutil', '', ('copyfile', 'copy', 'copy2', 'copytree', 'move'), (0, 1)),
+    ('shutil', '', ('rmtree',), 0),
+    ('pandas', '', ('read_csv', 'read_table', 'read_fwf', 'read_parquet', 'read_excel', 'read_json', 'read_pickle',
+                    'read_feather', 'read_orc', 'read_stata', 'read_sas', 'read_spss', 'read_xml', 'read_hdf'), 0),
+    ('pandas', 'DataFrame', ('to_csv', 'to_parquet', 'to_excel', 'to_json', 'to_pickle', 'to_feather', 'to_orc',
+                             'to_stata', 'to_xml', 'to_hdf'), 1),
+    ('pandas', 'Series', ('to_csv', 'to_json', 'to_pickle', 'to_excel', 'to_hdf'), 1),
+    ('numpy', '', ('load', 'save', 'savez', 'savez_compressed', 'loadtxt', 'savetxt', 'genfromtxt'), 0),
+    ('matplotlib.figure', 'Figure', ('savefig',), 1),
+]
+
+CELL_PATH_ROOT_MODULES = {module_name.partition('.')[0] for module_name, _, _, _ in CELL_PATH_HOOKS}
+
+def install_cell_path_hooks():
+    """Wraps the file functions of already imported libraries. Idempotent; outside a cell the wrappers change nothing."""
+    for module_name, owner_path, names, position in CELL_PATH_HOOKS:
+        module = sys.modules.get(module_name)
+        if module is None:
+            continue
+        owner = getattr(module, owner_path) if owner_path else module
+        for name in names:
+            func = getattr(owner, name, None)
+            if func is not None and not getattr(func, '_dnb_cell_paths', False):
+                setattr(owner, name, _with_cell_paths(func, position))
+    if not getattr(os.getcwd, '_dnb_cell_paths', False):
+        os.getcwd = _cell_getcwd(os.getcwd)
+
+def cell_import(name, *args, **kwargs):
+    """__import__ for cell code, wrapping the file functions of libraries the cell imports itself."""
+    module = builtins.__import__(name, *args, **kwargs)
+    if name.partition('.')[0] in CELL_PATH_ROOT_MODULES:
+        install_cell_path_hooks()
+    return module
+
+def cell_open(file, *args, **kwargs):
+    """open() for cell code, resolving relative paths against the working directory."""
+    return open(resolve_cell_path(file), *args, **kwargs)
+
+# --- Python Cell Compiler ---
+PYTHON_COMPILE_CACHE_SIZE = 256
+LAST_VALUE_NAME = '__dnb_last_value__'
+
+class _SleepToAsyncioSleep(ast.NodeTransformer):
+    """Rewrites `time.sleep(x)` to `await asyncio.sleep(x)` where awaiting is allowed, so a sleeping cell
+    doesn't block the event loop. Bodies of plain functions, lambdas and generator expressions are left alone."""
+
+    def visit_Call(self, node: ast.Call):
+        self.generic_visit(node)
+        func = node.func
+        if (isinstance(func, ast.Attribute) and func.attr == 'sleep'
+                and isinstance(func.value, ast.Name) and func.value.id == 'time'):
+            sleep = ast.Attribute(value=ast.Name(id='asyncio', ctx=ast.Load()), attr='sleep', ctx=ast.Load())
+            return ast.Await(value=ast.Call(func=sleep, args=node.args, keywords=node.keywords))
+        return node
+
+    def visit_FunctionDef(self, node):
+        return node
+
+    visit_Lambda = visit_GeneratorExp = visit_ClassDef = visit_FunctionDef
+
+class PythonCellCompiler:
+    """Parses and compiles Python cells once per distinct source. Cells may use top-level `await`; they run
+    directly in the notebook namespace, so assignments land in python_globals whether or not they await.
+    A trailing expression statement is rewritten into an assignment so its value is captured by the one run."""
+
+    def __init__(self, max_entries: int = PYTHON_COMPILE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.cache: Dict[str, types.CodeType] = {} # source hash -> code object, oldest first
+
+    def compile(self, code: str) -> types.CodeType:
+        key = hashlib.sha256(code.encode('utf-8')).hexdigest()
+        code_obj = self.cache.pop(key, None)
+        if code_obj is None:
+            filename = f'<cell-{key[:12]}>'
+            tree = _SleepToAsyncioSleep().visit(ast.parse(code, filename=filename))
+            if tree.body and isinstance(tree.body[-1], ast.Expr):
+                last = tree.body[-1]
+                tree.body[-1] = ast.copy_location(
+                    ast.Assign(targets=[ast.Name(id=LAST_VALUE_NAME, ctx=ast.Store())], value=last.value), last)
+            ast.fix_missing_locations(tree)
+            code_obj = compile(tree, filename, 'exec', flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
+            linecache.cache[filename] = (len(code), None, code.splitlines(True), filename) # Source lines in tracebacks
+            while len(self.cache) >= self.max_entries:
+                linecache.cache.pop(f'<cell-{next(iter(self.cache))[:12]}>', None)
+                del self.cache[next(iter(self.cache))]
+        self.cache[key] = code_obj # Re-insert as most recently used
+        return code_obj
+
+    async def run(self, code: str, namespace: Dict[str, Any]) -> Any:
+        """Executes a cell in `namespace`, awaiting it when it uses top-level await. Returns the value of the
+        cell's last expression, or None."""
+        namespace.pop(LAST_VALUE_NAME, None)
+        result = eval(self.compile(code), namespace)
+        if asyncio.iscoroutine(result):
+            await result
+        return namespace.pop(LAST_VALUE_NAME, None)
+
+python_compiler = PythonCellCompiler()
+
+# --- Cell Types ---
+CELL_TYPE_OPTIONS = ['SQL', 'Local SQL', 'Python']
+CELL_TYPE_LANGUAGES = {'SQL': 'sql', 'Local SQL': 'sql', 'Python': 'python'}
+SQL_CELL_TYPES = ('SQL', 'Local SQL')
+
+def normalize_cell_type(cell_type: str) -> str:
+    """Maps a stored or lower-case cell type ('sql', 'local sql', 'python') to its select label."""
+    for option in CELL_TYPE_OPTIONS:
+        if option.lower() == cell_type.lower():
+            return option
+    return 'SQL'
+
+# --- SQL Preview Helpers ---
+PREVIEW_ROW_LIMIT = 20
+PREVIEW_ROW_LIMIT_ALL_ROWS = 200
+PREVIEWABLE_SQL_KEYWORDS = ('select', 'with', 'values', 'table')
+_SQL_LEADING_COMMENTS_RE = re.compile(r'^\s*(?:(?:--[^\n]*(?:\n|$))|(?:/\*.*?\*/)|\s+)*', re.DOTALL)
+_EXPLAIN_ROWS_RE = re.compile(r'rows=(\d+)')
+
+def strip_sql_statement(query: str) -> str:
+    """Removes leading comments and trailing semicolons from a single SQL statement."""
+    stripped = _SQL_LEADING_COMMENTS_RE.sub('', query, count=1).strip()
+    while stripped.endswith(';'):
+        stripped = stripped[:-1].rstrip()
+    return stripped
+
+def is_previewable_query(query: str) -> bool:
+    """A query can be previewed if it is a single read-only statement that can be wrapped as a subquery."""
+    statement = strip_sql_statement(query)
+    if not statement or ';' in statement:
+        return False
+    first_word = statement.split(None, 1)[0].lower()
+    return first_word in PREVIEWABLE_SQL_KEYWORDS
+
+def build_preview_query(query: str, limit: int) -> str:
+    """Wraps the query as a subquery so the server stops after `limit` rows."""
+    statement = strip_sql_statement(query)
+    return f"SELECT * FROM (\n{statement}\n) AS _dnb_preview LIMIT {int(limit)}"
+
+def parse_explain_row_estimate(plan_lines: List[str]) -> Optional[int]:
+    """Reads the planner's row estimate from the top node of an EXPLAIN plan."""
+    for line in plan_lines:
+        match = _EXPLAIN_ROWS_RE.search(line)
+        if match:
+            return int(match.group(1))
+    return None
+
+# --- START: Database Driver Layer ---
+POSTGRES_SCHEMA_QUERY = """
             SELECT
                 c.table_schema,
                 c.table_name,
@@ -1563,15 +3142,582 @@ async def get_all_schema_data_optimized():
                  AND c.column_name = pk.column_name
             WHERE c.table_schema NOT IN ('information_schema', 'pg_catalog', 'pg_toast')
             ORDER BY c.table_schema, c.table_name, c.ordinal_position
-        """)
-        schema_data = {}
-        for row in rows:
-            schema, table, column, dtype, is_pk = row['table_schema'], row['table_name'], row['column_name'], row['data_type'], row['is_primary_key']
-            if schema not in schema_data:
-                schema_data[schema] = {}
-            if table not in schema_data[schema]:
-                schema_data[schema][table] = []
-            schema_data[schema][table].append((column, dtype, is_pk))
+"""
+
+# Redshift's information_schema views are evaluated on the leader node and get very slow on large
+# clusters; svv_columns is the system view Redshift recommends for catalog browsing.
+REDSHIFT_SCHEMA_QUERY = """
+            SELECT
+                table_schema,
+                table_name,
+                column_name,
+                data_type,
+                'NO' AS is_primary_key
+            FROM svv_columns
+            WHERE table_schema NOT IN ('information_schema', 'pg_catalog', 'pg_internal')
+            ORDER BY table_schema, table_name, ordinal_position
+"""
+
+DUCKDB_SCHEMA_QUERY = """
+            SELECT
+                table_schema,
+                table_name,
+                column_name,
+                data_type,
+                'NO' AS is_primary_key
+            FROM information_schema.columns
+            WHERE table_schema NOT IN ('information_schema', 'pg_catalog')
+            ORDER BY table_schema, table_name, ordinal_position
+"""
+
+DUCKDB_FILE_READERS = {'.csv': 'read_csv_auto', '.parquet': 'read_parquet'}
+DB_POOL_MAX_SIZE = 4
+DEFAULT_PROFILE_NAME = 'default'
+CONNECTION_IDLE_TIMEOUT_SECONDS = 900
+SSH_KEEPALIVE_SECONDS = 30.0
+
+
+class DatabaseDriver(abc.ABC):
+    """Base class for the database backends used by execute_sql and the schema loader."""
+    name = 'base'
+    label = 'Base'
+    required_fields: List[str] = []
+    supports_ssh = True
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return True
+
+    @abc.abstractmethod
+    async def connect(self, config: Dict[str, Any], host: Optional[str] = None, port: Optional[int] = None):
+        """Opens the connection or pool, through the tunnel's local host and port when given."""
+
+    @abc.abstractmethod
+    async def close(self):
+        """Releases the connection or pool."""
+
+    @abc.abstractmethod
+    async def fetch_dataframe(self, query: str) -> pd.DataFrame:
+        """Runs a query and returns its result as a DataFrame."""
+
+    @abc.abstractmethod
+    async def fetch_values(self, query: str) -> List[tuple]:
+        """Runs a query and returns its rows as tuples."""
+
+    async def fetch_schema_rows(self) -> List[tuple]:
+        """Returns (schema, table, column, data_type, is_primary_key) rows for the schema explorer."""
+        return await self.fetch_values(POSTGRES_SCHEMA_QUERY)
+
+    async def on_working_directory_change(self, directory: Path):
+        pass
+
+
+class AsyncpgDriver(DatabaseDriver):
+    """PostgreSQL/Redshift over an asyncpg connection pool with password authentication."""
+    name = 'postgres'
+    label = 'PostgreSQL / Redshift'
+    required_fields = ['db_host', 'db_name', 'db_user', 'db_password']
+
+    def __init__(self):
+        self.pool = None
+
+    async def _resolve_credentials(self, config: Dict[str, Any]) -> Tuple[str, str]:
+        return config['db_user'], config['db_password']
+
+    async def connect(self, config: Dict[str, Any], host: Optional[str] = None, port: Optional[int] = None):
+        import asyncpg
+        user, password = await self._resolve_credentials(config)
+        self.pool = await asyncpg.create_pool(
+            host=host or config['db_host'],
+            port=port or int(config['db_port']),
+            database=config['db_name'],
+            user=user,
+            password=password,
+            min_size=1,
+            max_size=int(config.get('pool_max_size') or DB_POOL_MAX_SIZE))
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    async def fetch_dataframe(self, query: str) -> pd.DataFrame:
+        with metrics.stage('db_roundtrip'):
+            records = await self.pool.fetch(query)
+        with metrics.stage('conversion'):
+            if not records:
+                return pd.DataFrame()
+            columns = list(records[0].keys())
+            data = [tuple(record.values()) for record in records]
+            return pd.DataFrame(data, columns=columns)
+
+    async def fetch_values(self, query: str) -> List[tuple]:
+        with metrics.stage('db_roundtrip'):
+            records = await self.pool.fetch(query)
+        with metrics.stage('conversion'):
+            return [tuple(record.values()) for record in records]
+
+
+class RedshiftIAMDriver(AsyncpgDriver):
+    """Redshift with temporary credentials from IAM (GetClusterCredentials) instead of a stored password."""
+    name = 'redshift_iam'
+    label = 'Redshift (IAM auth)'
+    required_fields = ['db_host', 'db_name', 'db_user', 'redshift_cluster_id', 'aws_region']
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return BOTO3_AVAILABLE
+
+    async def _resolve_credentials(self, config: Dict[str, Any]) -> Tuple[str, str]:
+        def _get_cluster_credentials():
+            import boto3
+            session = boto3.Session(profile_name=config.get('aws_profile') or None,
+                                    region_name=config['aws_region'])
+            return session.client('redshift').get_cluster_credentials(
+                DbUser=config['db_user'],
+                DbName=config['db_name'],
+                ClusterIdentifier=config['redshift_cluster_id'],
+                DurationSeconds=3600,
+                AutoCreate=False)
+
+        credentials = await asyncio.to_thread(_get_cluster_credentials)
+        return credentials['DbUser'], credentials['DbPassword']
+
+    async def fetch_schema_rows(self) -> List[tuple]:
+        return await self.fetch_values(REDSHIFT_SCHEMA_QUERY)
+
+
+class Psycopg2Driver(DatabaseDriver):
+    """PostgreSQL over psycopg2. Blocking calls run in a worker thread."""
+    name = 'psycopg'
+    label = 'PostgreSQL (psycopg2)'
+    required_fields = ['db_host', 'db_name', 'db_user', 'db_password']
+
+    def __init__(self):
+        self.connection = None
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return PSYCOPG2_AVAILABLE
+
+    async def connect(self, config: Dict[str, Any], host: Optional[str] = None, port: Optional[int] = None):
+        import psycopg2
+        self.connection = await asyncio.to_thread(
+            psycopg2.connect,
+            host=host or config['db_host'],
+            port=port or int(config['db_port']),
+            dbname=config['db_name'],
+            user=config['db_user'],
+            password=config['db_password'])
+        self.connection.autocommit = True
+
+    async def close(self):
+        if self.connection:
+            await asyncio.to_thread(self.connection.close)
+            self.connection = None
+
+    def _execute(self, query: str) -> Tuple[List[str], List[tuple]]:
+        with metrics.stage('db_roundtrip'), self.connection.cursor() as cursor:
+            cursor.execute(query)
+            if cursor.description is None:
+                return [], []
+            return [col[0] for col in cursor.description], cursor.fetchall()
+
+    async def fetch_dataframe(self, query: str) -> pd.DataFrame:
+        columns, rows = await asyncio.to_thread(self._execute, query)
+        with metrics.stage('conversion'):
+            if not rows:
+                return pd.DataFrame()
+            return pd.DataFrame(rows, columns=columns)
+
+    async def fetch_values(self, query: str) -> List[tuple]:
+        _, rows = await asyncio.to_thread(self._execute, query)
+        return rows
+
+
+class DuckDBDriver(DatabaseDriver):
+    """In-process DuckDB. CSV and Parquet files in the working directory are exposed as temporary views,
+    so a database file's own views are never replaced and nothing is written back to it."""
+    name = 'duckdb'
+    label = 'DuckDB (local files)'
+    required_fields = []
+    supports_ssh = False
+
+    def __init__(self, working_directory: Path):
+        self.connection = None
+        self.working_directory = working_directory
+        self.file_views: List[str] = []
+        self.file_view_state: Optional[List[Tuple[str, float]]] = None
+        self.registered_frames: Dict[str, int] = {}
+        # Temporary views live on one connection (a cursor would not see them), so all access is serialized
+        self.connection_lock = threading.Lock()
+
+    @classmethod
+    def is_available(cls) -> bool:
+        return DUCKDB_AVAILABLE
+
+    async def connect(self, config: Dict[str, Any], host: Optional[str] = None, port: Optional[int] = None):
+        import duckdb
+        database = config.get('db_name') or ':memory:'
+        self.connection = await asyncio.to_thread(duckdb.connect, database)
+        await self.on_working_directory_change(self.working_directory)
+
+    async def close(self):
+        if self.connection:
+            await asyncio.to_thread(self.connection.close)
+            self.connection = None
+
+    def _register_file_views(self, directory: Path):
+        data_files = sorted(item for item in directory.iterdir()
+                            if item.suffix.lower() in DUCKDB_FILE_READERS and item.is_file())
+        state = [(str(item), item.stat().st_mtime) for item in data_files]
+        if state == self.file_view_state:
+            return
+        self.file_view_state = state
+
+        with self.connection_lock:
+            self._replace_file_views(data_files)
+
+    def _replace_file_views(self, data_files: List[Path]):
+        for view_name in self.file_views:
+            self.connection.execute(f'DROP VIEW IF EXISTS temp.main."{view_name}"')
+        self.file_views = []
+        database_names = {row[0].lower() for row in self.connection.execute(
+            "SELECT table_name FROM information_schema.tables WHERE table_catalog <> 'temp'").fetchall()}
+        for view_name, item in file_view_names(data_files).items():
+            if view_name.lower() in database_names:
+                logger.info(f"Not exposing {item.name} as '{view_name}': the database has its own object of that name.")
+                continue
+            reader = DUCKDB_FILE_READERS[item.suffix.lower()]
+            file_path = str(item).replace("'", "''")
+            try:
+                self.connection.execute(f"CREATE OR REPLACE TEMP VIEW \"{view_name}\" AS SELECT * FROM {reader}('{file_path}')")
+                self.file_views.append(view_name)
+            except Exception as e:
+                logger.warning(f"Could not register {item.name} with DuckDB: {e}")
+
+    async def on_working_directory_change(self, directory: Path):
+        self.working_directory = directory
+        if self.connection and directory.is_dir():
+            await asyncio.to_thread(self._register_file_views, directory)
+
+    def _execute(self, query: str, fetch: str):
+        with self.connection_lock:
+            result = self.connection.execute(query)
+            return result.df() if fetch == 'df' else result.fetchall()
+
+    async def fetch_dataframe(self, query: str) -> pd.DataFrame:
+        # DuckDB executes and converts to pandas in one columnar step, so it all counts as the round trip.
+        with metrics.stage('db_roundtrip'):
+            return await asyncio.to_thread(self._execute, query, 'df')
+
+    async def fetch_values(self, query: str) -> List[tuple]:
+        with metrics.stage('db_roundtrip'):
+            return await asyncio.to_thread(self._execute, query, 'values')
+
+    async def fetch_schema_rows(self) -> List[tuple]:
+        return await self.fetch_values(DUCKDB_SCHEMA_QUERY)
+
+    def unregister_dataframe(self, df: pd.DataFrame):
+        """Drops every table name registered for this frame, releasing DuckDB's reference to it."""
+        with self.connection_lock:
+            for name, frame_id in list(self.registered_frames.items()):
+                if frame_id == id(df):
+                    self.connection.unregister(name)
+                    del self.registered_frames[name]
+
+    def register_dataframes(self, frames: Dict[str, pd.DataFrame]):
+        """Exposes in-memory DataFrames as tables. DuckDB scans them in place, without copying."""
+        with self.connection_lock:
+            for name in list(self.registered_frames):
+                if name not in frames:
+                    self.connection.unregister(name)
+                    del self.registered_frames[name]
+            for name, df in frames.items():
+                if self.registered_frames.get(name) != id(df):
+                    self.connection.register(name, df)
+                    self.registered_frames[name] = id(df)
+
+
+def file_view_names(data_files: List[Path]) -> Dict[str, Path]:
+    """Maps view names to files: the file stem, or stem_extension for files whose stems collide (a.csv and a.parquet)."""
+    by_stem: Dict[str, List[Path]] = {}
+    for item in data_files:
+        by_stem.setdefault(re.sub(r'\W', '_', item.stem), []).append(item)
+    views = {}
+    for stem, items in by_stem.items():
+        if len(items) == 1:
+            views[stem] = items[0]
+            continue
+        qualified = {re.sub(r'\W', '_', item.name): item for item in items}
+        logger.info(f"Files {', '.join(item.name for item in items)} share the view name '{stem}'; "
+                    f"registered them as {', '.join(qualified)}.")
+        views.update(qualified)
+    return views
+
+
+DATABASE_DRIVERS = {driver.name: driver for driver in (AsyncpgDriver, RedshiftIAMDriver, Psycopg2Driver, DuckDBDriver)}
+
+def create_database_driver(config: Dict[str, Any], working_directory: Path) -> DatabaseDriver:
+    driver_cls = DATABASE_DRIVERS.get(config.get('driver') or 'postgres')
+    if driver_cls is None:
+        raise ValueError(f"Unknown database driver: {config.get('driver')}")
+    if not driver_cls.is_available():
+        raise RuntimeError(f"The '{driver_cls.label}' driver is not installed. Check requirements.txt.")
+    if driver_cls is DuckDBDriver:
+        return DuckDBDriver(working_directory)
+    return driver_cls()
+
+def has_ssh_config(config: Dict[str, Any]) -> bool:
+    ssh_fields = ['ssh_host', 'ssh_username', 'ssh_private_key']
+    return all(config.get(field, '').strip() for field in ssh_fields)
+
+class SSHTunnelManager:
+    """Shared SSH tunnels keyed by bastion and remote address.
+
+    Tunnels bind to an ephemeral local port, send keepalives, and are reference counted so
+    reconnects and profiles behind the same bastion reuse an open transport instead of paying
+    a new SSH handshake. Unused tunnels stay up for `idle_timeout` seconds; dead ones are restarted.
+    """
+
+    def __init__(self, idle_timeout: float = CONNECTION_IDLE_TIMEOUT_SECONDS):
+        self.idle_timeout = idle_timeout
+        self.tunnels: Dict[tuple, SSHTunnelForwarder] = {}
+        self.ref_counts: Dict[tuple, int] = {}
+        self.released_at: Dict[tuple, float] = {}
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def tunnel_key(config: Dict[str, Any]) -> tuple:
+        return (config['ssh_host'], int(config.get('ssh_port') or 22), config['ssh_username'],
+                config['ssh_private_key'], config['db_host'], int(config['db_port']))
+
+    @staticmethod
+    def _is_healthy(tunnel: SSHTunnelForwarder) -> bool:
+        if not tunnel.is_active:
+            return False
+        tunnel.check_tunnels()
+        return all(tunnel.tunnel_is_up.values())
+
+    def _start_tunnel(self, key: tuple, local_port: int = 0) -> SSHTunnelForwarder:
+        from sshtunnel import SSHTunnelForwarder
+        ssh_host, ssh_port, ssh_username, ssh_private_key, db_host, db_port = key
+        tunnel = SSHTunnelForwarder(
+            (ssh_host, ssh_port),
+            ssh_username=ssh_username,
+            ssh_pkey=ssh_private_key,
+            remote_bind_address=(db_host, db_port),
+            local_bind_address=('127.0.0.1', local_port), # Port 0 is ephemeral, so instances and profiles never collide
+            set_keepalive=SSH_KEEPALIVE_SECONDS)
+        tunnel.start()
+        return tunnel
+
+    def _ensure_tunnel(self, key: tuple) -> SSHTunnelForwarder:
+        tunnel = self.tunnels.get(key)
+        if tunnel is not None:
+            try:
+                if self._is_healthy(tunnel):
+                    return tunnel
+            except Exception as e:
+                logger.warning(f"SSH tunnel health check failed: {e}")
+            logger.info(f"SSH tunnel to {key[0]} is down. Restarting...")
+            previous_port = tunnel.local_bind_port
+            self._stop_tunnel(tunnel)
+            try:
+                # Keep the old port so pooled connections reconnect to the same address
+                tunnel = self._start_tunnel(key, previous_port)
+                self.tunnels[key] = tunnel
+                return tunnel
+            except Exception as e:
+                logger.warning(f"Could not rebind SSH tunnel to port {previous_port}: {e}")
+        tunnel = self._start_tunnel(key)
+        self.tunnels[key] = tunnel
+        return tunnel
+
+    @staticmethod
+    def _stop_tunnel(tunnel: SSHTunnelForwarder):
+        try:
+            tunnel.stop()
+        except Exception:
+            pass
+
+    async def acquire(self, config: Dict[str, Any]) -> Tuple[str, int]:
+        """Returns the local (host, port) forwarding to the config's database."""
+        key = self.tunnel_key(config)
+        async with self.lock:
+            tunnel = await asyncio.to_thread(self._ensure_tunnel, key)
+            self.ref_counts[key] = self.ref_counts.get(key, 0) + 1
+            self.released_at.pop(key, None)
+            return tunnel.local_bind_host, tunnel.local_bind_port
+
+    async def release(self, config: Dict[str, Any]):
+        key = self.tunnel_key(config)
+        async with self.lock:
+            self.ref_counts[key] = max(0, self.ref_counts.get(key, 0) - 1)
+            if self.ref_counts[key] == 0:
+                self.released_at[key] = time.monotonic()
+
+    async def maintain(self):
+        """Stops tunnels unused for longer than the idle timeout and restarts dead tunnels still in use."""
+        async with self.lock:
+            now = time.monotonic()
+            for key in list(self.tunnels):
+                if self.ref_counts.get(key, 0) == 0 and now - self.released_at.get(key, now) > self.idle_timeout:
+                    logger.info(f"Closing idle SSH tunnel to {key[0]}")
+                    await asyncio.to_thread(self._stop_tunnel, self.tunnels.pop(key))
+                    self.ref_counts.pop(key, None)
+                    self.released_at.pop(key, None)
+                elif self.ref_counts.get(key, 0) > 0:
+                    try:
+                        await asyncio.to_thread(self._ensure_tunnel, key)
+                    except Exception as e:
+                        logger.error(f"Could not restart SSH tunnel to {key[0]}: {e}")
+
+    async def close_all(self):
+        async with self.lock:
+            for tunnel in self.tunnels.values():
+                await asyncio.to_thread(self._stop_tunnel, tunnel)
+            self.tunnels.clear()
+            self.ref_counts.clear()
+            self.released_at.clear()
+
+class ConnectionRegistry:
+    """Named connection profiles, each with its own driver (pool) and SSH tunnel from the shared tunnel manager.
+
+    Connections are opened on first use and kept warm between cells. Profiles other than the
+    active one are closed after `idle_timeout` seconds without a query and reopened on demand.
+    """
+
+    def __init__(self, profiles_file: Path, working_directory: Path, idle_timeout: float = CONNECTION_IDLE_TIMEOUT_SECONDS):
+        self.profiles_file = profiles_file
+        self.working_directory = working_directory
+        self.idle_timeout = idle_timeout
+        self.profiles: Dict[str, Dict[str, Any]] = {}
+        self.drivers: Dict[str, DatabaseDriver] = {}
+        self.tunnel_manager = SSHTunnelManager(idle_timeout)
+        self.tunneled: Dict[str, Dict[str, Any]] = {} # profile name -> config its tunnel was acquired with
+        self.last_used: Dict[str, float] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.load_profiles()
+
+    def load_profiles(self):
+        try:
+            if self.profiles_file.exists():
+                with open(self.profiles_file, 'r') as f:
+                    self.profiles.update(json.load(f))
+        except Exception as e:
+            logger.error(f"Failed to load connection profiles: {e}", exc_info=True)
+
+    def save_profiles(self, exclude: Optional[str] = None) -> bool:
+        """Persists profiles (including passwords) to the app config directory, optionally leaving one out."""
+        try:
+            self.profiles_file.parent.mkdir(parents=True, exist_ok=True)
+            stored = {name: config for name, config in self.profiles.items() if name != exclude}
+            with open(self.profiles_file, 'w') as f:
+                json.dump(stored, f, indent=2)
+            return True
+        except Exception as e:
+            logger.error(f"Failed to save connection profiles: {e}", exc_info=True)
+            return False
+
+    def profile_names(self) -> List[str]:
+        return sorted(self.profiles.keys())
+
+    def is_connected(self, name: str) -> bool:
+        return name in self.drivers
+
+    async def connect(self, name: str) -> DatabaseDriver:
+        """(Re)opens the connection for a profile, replacing any existing one."""
+        async with self.locks.setdefault(name, asyncio.Lock()):
+            await self._close(name)
+            return await self._open(name)
+
+    async def get(self, name: str) -> DatabaseDriver:
+        """Returns the warm connection for a profile, connecting on first use."""
+        async with self.locks.setdefault(name, asyncio.Lock()):
+            driver = self.drivers.get(name) or await self._open(name)
+            self.last_used[name] = time.monotonic()
+            return driver
+
+    async def disconnect(self, name: str):
+        async with self.locks.setdefault(name, asyncio.Lock()):
+            await self._close(name)
+
+    async def close_all(self):
+        for name in list(self.drivers):
+            await self.disconnect(name)
+        await self.tunnel_manager.close_all()
+
+    async def close_idle(self, keep: Optional[str] = None):
+        now = time.monotonic()
+        for name in list(self.drivers):
+            if name != keep and now - self.last_used.get(name, now) > self.idle_timeout:
+                logger.info(f"Closing idle connection for profile '{name}'")
+                await self.disconnect(name)
+        await self.tunnel_manager.maintain()
+
+    async def _open(self, name: str) -> DatabaseDriver:
+        config = self.profiles.get(name)
+        if config is None:
+            raise KeyError(f"Unknown connection profile: {name}")
+
+        driver = create_database_driver(config, self.working_directory)
+        use_ssh = driver.supports_ssh and has_ssh_config(config)
+        try:
+            if use_ssh:
+                logger.info(f"[{name}] SSH configuration detected. Acquiring SSH tunnel...")
+                host, port = await self.tunnel_manager.acquire(config)
+                self.tunneled[name] = config
+                logger.info(f"[{name}] Connecting to database through SSH tunnel on port {port} ({driver.label})...")
+                await driver.connect(config, host=host, port=port)
+            else:
+                logger.info(f"[{name}] Connecting directly to database ({driver.label})...")
+                await driver.connect(config)
+        except Exception:
+            try:
+                await driver.close()
+            except Exception:
+                pass
+            if use_ssh and self.tunneled.pop(name, None) is not None:
+                await self.tunnel_manager.release(config)
+            raise
+
+        self.drivers[name] = driver
+        self.last_used[name] = time.monotonic()
+        return driver
+
+    async def _close(self, name: str):
+        driver = self.drivers.pop(name, None)
+        if driver:
+            try:
+                await driver.close()
+            except Exception:
+                pass
+        tunnel_config = self.tunneled.pop(name, None)
+        if tunnel_config is not None:
+            await self.tunnel_manager.release(tunnel_config)
+        self.last_used.pop(name, None)
+
+    async def on_working_directory_change(self, directory: Path):
+        self.working_directory = directory
+        for driver in self.drivers.values():
+            await driver.on_working_directory_change(directory)
+# --- END: Database Driver Layer ---
+
+async def get_all_schema_data_optimized():
+    """Fetches all schema, table, and column info in a single, efficient query."""
+    if not notebook.db_connection:
+        return {"error": "Not connected to database"}
+    try:
+        rows = await notebook.db_connection.fetch_schema_rows()
+        with metrics.stage('conversion'):
+            schema_data = {}
+            for schema, table, column, dtype, is_pk in rows:
+                if schema not in schema_data:
+                    schema_data[schema] = {}
+                if table not in schema_data[schema]:
+                    schema_data[schema][table] = []
+                schema_data[schema][table].append((column, dtype, is_pk))
         return schema_data
     except Exception as e:
         logger.error(f"Error fetching database schema: {e}", exc_info=True)
@@ -1579,40 +3725,84 @@ async def get_all_schema_data_optimized():
 
 # --- API Endpoints for the new JavaScript DB Explorer ---
 @app.get('/api/schema/tables/{schema}')
-async def get_tables_for_schema_api(schema: str):
-    if not notebook.db_connection or not notebook.db_schema_data:
+async def get_tables_for_schema_api(schema: str, request: Request):
+    session_notebook = notebook_for_request(request)
+    if not session_notebook or not session_notebook.db_connection or not session_notebook.db_schema_data:
         return {'success': False, 'error': 'Not connected or schema not loaded.'}
-    tables = sorted(list(notebook.db_schema_data.get(schema, {}).keys()))
+    tables = sorted(list(session_notebook.db_schema_data.get(schema, {}).keys()))
     return {'success': True, 'tables': tables}
 
+@app.get('/metrics')
+async def metrics_api(request: Request):
+    """Prometheus scrape endpoint. Only answers local clients."""
+    if request.client is None or request.client.host not in ('127.0.0.1', '::1', 'localhost'):
+        return PlainTextResponse('Forbidden\n', status_code=403)
+    return PlainTextResponse(metrics.render_prometheus(), media_type='text/plain; version=0.0.4')
+
 @app.get('/api/schema/columns/{schema}/{table}')
-async def get_columns_for_table_api(schema: str, table: str):
-    if not notebook.db_connection or not notebook.db_schema_data:
+async def get_columns_for_table_api(schema: str, table: str, request: Request):
+    session_notebook = notebook_for_request(request)
+    if not session_notebook or not session_notebook.db_connection or not session_notebook.db_schema_data:
         return {'success': False, 'error': 'Not connected or schema not loaded.'}
-    columns = notebook.db_schema_data.get(schema, {}).get(table, [])
+    columns = session_notebook.db_schema_data.get(schema, {}).get(table, [])
     return {'success': True, 'columns': columns}
 
 
+USER_DATA_PATH = Path.home() / "DataNotebookRoot"
+APP_CONFIG_DIR = USER_DATA_PATH / ".app_config" # Shared by all sessions: saved credentials, profiles and settings
+
 class NotebookApp:
     def __init__(self):
         self.cells = []
         self.dataframes = {}
-        self.db_connection = None
-        self.ssh_tunnel = None
+        self.active_profile: Optional[str] = None
         self.connection_config = {}
         self.last_successful_config = {}
         self.python_globals = {}
+        self.compact_results = False # Notebook default for compacting SQL results; cells can override it
         self.is_dark_mode = True
-        self.user_data_path = Path.home() / "DataNotebookRoot"
+        self.user_data_path = USER_DATA_PATH
         self.user_data_path.mkdir(parents=True, exist_ok=True)
-        self.app_config_dir = self.user_data_path / ".app_config"
+        self.app_config_dir = APP_CONFIG_DIR
         self.app_config_dir.mkdir(parents=True, exist_ok=True)
         self.credentials_file = self.app_config_dir / 'credentials.json'
+        self.settings_file = self.app_config_dir / 'settings.json'
+        self.settings: Dict[str, Any] = self.load_settings()
         self.working_directory: Path = self.user_data_path.resolve()
+        self.connections = ConnectionRegistry(self.app_config_dir / 'profiles.json', self.working_directory)
         self.current_filename = None
         self.is_modified = False
         self.last_tree_state: Optional[List[Tuple[str, bool, float]]] = None
         self.db_schema_data: Dict[str, Any] = {} # Cache for the new DB explorer
+        self.local_sql_engine: Optional[DuckDBDriver] = None # In-process engine for Local SQL cells
+        self.run_history: deque = deque(maxlen=RUN_HISTORY_SIZE) # RunMetrics for the performance panel
+        self.variables = VariableExplorer()
+        self.dataflow = CellDataflow()
+        self.jobs = JobRunner(SESSION_MAX_CONCURRENT_JOBS)
+        self.repr_handles: Dict[str, Any] = {} # Objects behind truncated reprs, oldest first
+        # Elements of the page currently showing this notebook, set when the page is built
+        self.title_label: Optional[ui.label] = None
+        self.dark_mode_btn: Optional[ui.button] = None
+        self.left_drawer_instance: Optional[ui.left_drawer] = None
+        self.right_drawer_instance: Optional[ui.right_drawer] = None
+        self.file_tree: Optional[ui.tree] = None
+        self.tree_container: Optional[ui.scroll_area] = None
+        self.cell_container: Optional[ui.column] = None
+        self.status_indicator: Optional[ui.html] = None
+        self.status_label: Optional[ui.label] = None
+        self.reconnect_btn: Optional[ui.button] = None
+        self.working_dir_input: Optional[ui.input] = None
+        self.working_dir_display: Optional[ui.label] = None
+        self.schema_container: Optional[ui.scroll_area] = None
+        self.active_tab: Optional[ui.tabs] = None
+        self.memory = DataFrameMemoryManager(int(self.settings.get('memory_budget_mb', DATAFRAME_MEMORY_BUDGET_MB) * 1024 * 1024))
+
+    @property
+    def db_connection(self) -> Optional[DatabaseDriver]:
+        """Driver of the active connection profile, used by the schema explorer and unqualified SQL cells."""
+        if self.active_profile is None:
+            return None
+        return self.connections.drivers.get(self.active_profile)
 
     def generate_cell_id(self):
         return str(uuid.uuid4())[:8]
@@ -1638,96 +3828,284 @@ class NotebookApp:
             logger.error(f"Failed to load credentials: {e}", exc_info=True)
             return {}
 
-    def _has_ssh_config(self, config: Dict[str, Any]) -> bool:
-        ssh_fields = ['ssh_host', 'ssh_username', 'ssh_private_key']
-        return all(config.get(field, '').strip() for field in ssh_fields)
+    def load_settings(self) -> Dict[str, Any]:
+        try:
+            if self.settings_file.exists():
+                with open(self.settings_file, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load settings: {e}", exc_info=True)
+        return {}
 
-    async def connect_to_database(self, config: Dict[str, Any]):
-        self.connection_config = config
-        if self.db_connection:
-            try:
-                await self.db_connection.close()  # asyncpg close is async
-            except Exception:
-                pass
-            finally:
-                self.db_connection = None
-        if self.ssh_tunnel:
-            try:
-                await asyncio.to_thread(self.ssh_tunnel.stop)
-            except Exception:
-                pass
-            finally:
-                self.ssh_tunnel = None
+    def save_settings(self):
+        try:
+            with open(self.settings_file, 'w') as f:
+                json.dump(self.settings, f, indent=2)
+        except Exception as e:
+            logger.error(f"Failed to save settings: {e}", exc_info=True)
+
+    def set_memory_budget(self, budget_mb: float):
+        self.memory.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.settings['memory_budget_mb'] = budget_mb
+        self.save_settings()
+
+    def _replace_frame(self, old: Any, new: Any):
+        """Rebinds every notebook reference to `old` (names and cell download targets) to `new`."""
+        for namespace in (self.python_globals, self.dataframes):
+            for name, value in namespace.items():
+                if value is old:
+                    namespace[name] = new
+        for cell_data in self.cells:
+            if cell_data.get('df_to_download') is old:
+                cell_data['df_to_download'] = new
+        for job in self.jobs.jobs.values():
+            if job.result.get('df') is old:
+                job.result['df'] = new
+
+    async def account_memory(self, refresh_names=()) -> Dict[str, int]:
+        """memory.account() with the deep size walks done in a worker thread instead of on the event loop."""
+        frames = self.memory.unmeasured(self.python_globals, refresh_names)
+        if frames:
+            self.memory.sizes.update(await asyncio.to_thread(measure_frames, frames))
+        return self.memory.account(self.python_globals)
+
+    async def compact_stored_dataframe(self, name: str) -> pd.DataFrame:
+        """Compacts a DataFrame already in the notebook and rebinds every reference to the compact copy."""
+        await self.restore_spilled(name)
+        df = self.python_globals[name]
+        compacted = await asyncio.to_thread(compact_dataframe, df)
+        self._replace_frame(df, compacted)
+        self.variables.bump([name])
+        self.dataflow.record_write([name])
+        await self.account_memory(refresh_names=[name])
+        return compacted
+
+    def cell_snapshot(self, cell_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Plain values of a cell's editor and settings, so it can run without the page that shows it."""
+        return {'id': cell_data['id'], 'type': cell_data['type'].value, 'code': cell_data['code'].value,
+                'df_name': cell_data['df_name'].value.strip(), 'connection_profile': cell_data['connection_profile'],
+                'show_all_rows': cell_data['show_all_rows'], 'preview_mode': cell_data['preview_mode'],
+                'compact_results': self.compact_results if cell_data['compact_results'] is None else cell_data['compact_results']}
+
+    def cell_fingerprint(self, cell: Dict[str, Any]) -> str:
+        """Hash of everything besides its inputs that determines a cell's result."""
+        key = json.dumps([cell['type'], cell['code'], cell['df_name'], cell['connection_profile'], cell['preview_mode'], cell['compact_results']])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def is_cell_stale(self, cell_data: Dict[str, Any]) -> bool:
+        cell = self.cell_snapshot(cell_data)
+        if not cell['code'].strip():
+            return False
+        return self.dataflow.is_stale(cell['id'], self.cell_fingerprint(cell))
 
+    def record_cell_run(self, cell: Dict[str, Any], success: bool):
+        if not success:
+            self.dataflow.forget(cell['id'])
+            return
+        reads, writes = cell_dataflow_names(cell['type'], cell['code'], cell['df_name'])
+        # Builtins and names that never existed can't change; only track inputs that are variables
+        reads = {name for name in reads if name in self.python_globals or name in self.dataflow.write_versions}
+        self.dataflow.record_run(cell['id'], self.cell_fingerprint(cell), reads, writes)
+
+    def stale_execution_order(self) -> List[Dict[str, Any]]:
+        cells_by_id = {cell_data['id']: cell_data for cell_data in self.cells}
+        names = {cell_id: cell_dataflow_names(cell_data['type'].value, cell_data['code'].value, cell_data['df_name'].value.strip())
+                 for cell_id, cell_data in cells_by_id.items()}
+        return [cells_by_id[cell_id] for cell_id in CellDataflow.execution_order(list(cells_by_id), names)]
+
+    async def execute_cell(self, cell: Dict[str, Any], force_full: bool = False, job: Optional[CellJob] = None) -> Dict[str, Any]:
+        """Runs a cell snapshot and returns what a page needs to render it. Touches no UI elements,
+        so it can run as a background job that outlives the page."""
+        code, cell_type, show_all_rows = cell['code'], cell['type'], cell['show_all_rows']
+        result = {'success': False, 'outputs': [], 'df': None, 'materializable': False, 'error': None}
+        run_metrics, metrics_token = metrics.begin(cell_type.lower().replace(' ', '_'), cell['id'])
+        if job is not None:
+            run_metrics.add('queue_wait', time.perf_counter() - job.submitted_at)
         try:
-            use_ssh = self._has_ssh_config(config)
-            if use_ssh:
-                logger.info("SSH configuration detected. Establishing SSH tunnel...")
-                self.ssh_tunnel = SSHTunnelForwarder(
-                    (config['ssh_host'], int(config.get('ssh_port', 22))),
-                    ssh_username=config['ssh_username'],
-                    ssh_pkey=config['ssh_private_key'],
-                    remote_bind_address=(config['db_host'], int(config['db_port'])),
-                    local_bind_address=('localhost', 6543))
-
-                await asyncio.to_thread(self.ssh_tunnel.start)
-
-                logger.info("Connecting to database through SSH tunnel...")
-                # asyncpg connection - note the different parameter names
-                self.db_connection = await asyncpg.connect(
-                    host=self.ssh_tunnel.local_bind_host,
-                    port=self.ssh_tunnel.local_bind_port,
-                    database=config['db_name'],
-                    user=config['db_user'],
-                    password=config['db_password'])
-                logger.info("Database connection established via SSH tunnel")
-            else:
-                logger.info("No SSH configuration provided. Connecting directly to database...")
-                # asyncpg connection
-                self.db_connection = await asyncpg.connect(
-                    host=config['db_host'],
-                    port=int(config['db_port']),
-                    database=config['db_name'],
-                    user=config['db_user'],
-                    password=config['db_password'])
-                logger.info("Direct database connection established")
+            if cell_type == 'SQL' and cell['preview_mode'] and not force_full:
+                preview_limit = PREVIEW_ROW_LIMIT_ALL_ROWS if show_all_rows else PREVIEW_ROW_LIMIT
+                result_df, message, estimated_rows = await self.preview_sql(code, preview_limit, cell['connection_profile'] or None)
+                if result_df is not None:
+                    result['success'] = True
+                    estimate_text = f"~{estimated_rows:,}" if estimated_rows is not None else "unknown"
+                    outputs = [CellOutput('text', f"Preview: {len(result_df)} rows, {result_df.shape[1]} columns (estimated total: {estimate_text} rows)"),
+                               table_output(result_df, preview_limit),
+                               CellOutput('markdown', "*Preview mode: only the displayed rows were fetched. Click 'Materialize Full Result' to load the complete result into the DataFrame.*")]
+                    result.update(outputs=outputs, materializable=True) # Only full results are downloadable
+                else:
+                    result.update(outputs=[CellOutput('markdown', f"**SQL Error:** {message}")], error='SQL')
+
+            elif cell_type in SQL_CELL_TYPES:
+                df_name = cell['df_name']
+                if cell_type == 'Local SQL':
+                    result_df, message, saved_name = await self.execute_local_sql(code, df_name or None, cell['compact_results'])
+                else:
+                    result_df, message, saved_name = await self.execute_sql(code, df_name or None, cell['connection_profile'] or None, cell['compact_results'])
+                if result_df is not None:
+                    result['success'] = True
+                    if show_all_rows: max_rows_to_display = 200
+                    else: max_rows_to_display = 20
+
+                    shape_text = f"Shape: {result_df.shape}"
+                    compaction_note = describe_compaction(result_df)
+                    if compaction_note:
+                        shape_text = f"Shape: {result_df.shape}. {compaction_note}"
+                    outputs = [CellOutput('text', shape_text), table_output(result_df, max_rows_to_display)]
+                    note = row_limit_note(len(result_df), show_all_rows)
+                    if note is not None:
+                        outputs.append(note)
+
+                    result.update(outputs=outputs, df=result_df) # Kept for download
+                else:
+                    result.update(outputs=[CellOutput('markdown', f"**SQL Error:** {message}")], error='SQL')
+
+            elif cell_type == 'Python':
+                stdout = StreamingOutput(self.working_directory / STDOUT_LOG_DIR, cell['id'])
+                if job is not None:
+                    job.stdout = stdout # Streamed to attached pages while the cell runs
+                success, py_outputs, last_df = await self.execute_python(code, show_all_rows, stdout)
+                result.update(success=success, outputs=py_outputs)
+                if success:
+                    if isinstance(last_df, pd.DataFrame):
+                        result['df'] = last_df # Kept for download
+                else:
+                    result.update(outputs=[CellOutput('markdown', '**Python Error:**'), *py_outputs], error='Python')
 
+            used_names = referenced_names(code) | {cell['df_name']}
+            self.variables.bump(used_names)
+            await self.enforce_memory_budget(used_names)
+
+        except Exception as e:
+            result['success'] = False
+            logger.error(f"[{cell['id']}] execute_cell error: {e}", exc_info=True)
+            result.update(outputs=[CellOutput('markdown', f"**Unexpected Error:** {str(e)}"), CellOutput('text', traceback.format_exc())],
+                          error='Unexpected')
+
+        finally:
+            run_metrics.status = 'ok' if result['success'] else 'error'
+            metrics.record_payload_size(sum(output.size() for output in result['outputs']))
+            metrics.finish(run_metrics, metrics_token, self.run_history)
+            result['metrics'] = run_metrics
+            self.record_cell_run(cell, result['success'])
+        return result
+
+    def display_object(self, obj, level: int = 1, handle: Optional[str] = None) -> CellOutput:
+        """Rich or bounded repr of an object for a cell output. A truncated repr keeps a handle to the object,
+        so the page can ask for more with expand_repr."""
+        output, truncated = rich_output(obj, level)
+        if not truncated:
+            return output
+        handle = handle or uuid.uuid4().hex[:8]
+        self.repr_handles.pop(handle, None)
+        self.repr_handles[handle] = obj
+        while len(self.repr_handles) > REPR_HANDLES_PER_SESSION:
+            del self.repr_handles[next(iter(self.repr_handles))]
+        return CellOutput('repr', {'text': output.data, 'handle': handle, 'level': level})
+
+    def expand_repr(self, handle: str, level: int) -> Optional[CellOutput]:
+        if handle not in self.repr_handles:
+            return None
+        output = self.display_object(self.repr_handles[handle], level, handle)
+        if output.kind != 'repr':
+            del self.repr_handles[handle] # Fully shown
+        return output
+
+    async def profile_result(self, job: CellJob, on_batch=None) -> Optional[ResultProfile]:
+        """Profiles a job's result DataFrame batch by batch in a worker thread and keeps the profile with the result.
+        on_batch(profile) runs between batches, never while one is being added, so a page can show the profile
+        while it grows. Requests made while a profile is being built wait for it and get its batches too."""
+        listeners = job.result.setdefault('profile_listeners', [])
+        if on_batch is not None:
+            listeners.append(on_batch)
+        task = job.result.get('profile_task')
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)): # Retry after a failure
+            task = job.result['profile_task'] = asyncio.create_task(self._build_profile(job, listeners))
+        try:
+            return await asyncio.shield(task) # A closed page doesn't cancel the profile for the others
+        finally:
+            if on_batch in listeners:
+                listeners.remove(on_batch)
+
+    async def _build_profile(self, job: CellJob, listeners: List[Any]) -> Optional[ResultProfile]:
+        df = job.result.get('df')
+        if isinstance(df, SpilledFrame):
+            df = await asyncio.to_thread(df.load) # Read for profiling only; the frame stays spilled
+        if not isinstance(df, pd.DataFrame):
+            return None
+        profile = ResultProfile(df)
+        for start in range(0, len(df), PROFILE_BATCH_ROWS):
+            await asyncio.to_thread(profile.update, df.iloc[start:start + PROFILE_BATCH_ROWS])
+            if profile.complete:
+                break
+            for listener in list(listeners):
+                try:
+                    listener(profile)
+                except Exception as e: # e.g. the page showing it was closed
+                    logger.warning(f"Dropping a profile listener for job {job.id}: {e}")
+                    listeners.remove(listener)
+        return profile
+
+    async def restore_spilled(self, code: str):
+        """Reloads spilled DataFrames that the code refers to, so cells see them as ordinary frames."""
+        for name in referenced_names(code):
+            spilled = self.python_globals.get(name)
+            if isinstance(spilled, SpilledFrame):
+                df = await asyncio.to_thread(self.memory.restore, spilled)
+                self._replace_frame(spilled, df)
+
+    async def enforce_memory_budget(self, used_names=()):
+        """Updates the memory accounting after a run and spills least recently used frames if over budget."""
+        used_names = [name for name in used_names if name in self.python_globals]
+        self.memory.touch(used_names)
+        await self.account_memory(refresh_names=used_names)
+        if not PYARROW_AVAILABLE:
+            return
+        for name in self.memory.select_victims(self.python_globals, protected=used_names):
+            df = self.python_globals[name]
+            spilled = await asyncio.to_thread(self.memory.spill, name, df)
+            if spilled is not None:
+                self._replace_frame(df, spilled)
+                self.memory.frame_names[id(spilled)] = name
+                if self.local_sql_engine:
+                    await asyncio.to_thread(self.local_sql_engine.unregister_dataframe, df) # Otherwise DuckDB keeps it alive
+
+    async def connect_to_database(self, config: Dict[str, Any]):
+        """Registers the config as a named profile, (re)connects it and makes it the active profile."""
+        self.connection_config = config
+        profile_name = config.get('profile_name') or DEFAULT_PROFILE_NAME
+        self.connections.profiles[profile_name] = config
+        try:
+            await self.connections.connect(profile_name)
+            use_ssh = profile_name in self.connections.tunneled
+            self.active_profile = profile_name
             self.last_successful_config = config.copy()
             return True, f"Connected successfully {'via SSH tunnel' if use_ssh else 'directly'}"
-
         except Exception as e:
             logger.error(f"Connection error: {e}", exc_info=True)
-            if self.ssh_tunnel and hasattr(self.ssh_tunnel, 'is_active') and self.ssh_tunnel.is_active:
-                try:
-                    await asyncio.to_thread(self.ssh_tunnel.stop)
-                except Exception:
-                    pass
-            self.ssh_tunnel = None
-            if self.db_connection:
-                try:
-                    await self.db_connection.close()  # asyncpg close is async
-                except Exception:
-                    pass
-                self.db_connection = None
+            if self.active_profile == profile_name:
+                self.active_profile = None
             return False, str(e)
 
-    async def execute_sql(self, query: str, save_to_df: Optional[str] = None) -> Tuple[Optional[pd.DataFrame], Optional[str], Optional[str]]:
-        if not self.db_connection:
-            return None, "Not connected to database", None
+    async def get_driver(self, profile: Optional[str] = None) -> Optional[DatabaseDriver]:
+        """Resolves the driver for a cell's profile, reconnecting idle profiles on demand."""
+        name = profile or self.active_profile
+        if name is None or name not in self.connections.profiles:
+            return None
+        with metrics.stage('connect'):
+            return await self.connections.get(name)
+
+    async def compact_result(self, df: pd.DataFrame) -> pd.DataFrame:
+        with metrics.stage('conversion'):
+            return await asyncio.to_thread(compact_dataframe, df)
+
+    async def execute_sql(self, query: str, save_to_df: Optional[str] = None, profile: Optional[str] = None, compact: bool = False) -> Tuple[Optional[pd.DataFrame], Optional[str], Optional[str]]:
         try:
-            # asyncpg requires different approach - fetch records then convert to DataFrame
-            records = await self.db_connection.fetch(query)
-
-            if records:
-                # Convert asyncpg records to DataFrame
-                # Get column names from the first record
-                columns = list(records[0].keys())
-                # Convert records to list of tuples
-                data = [tuple(record.values()) for record in records]
-                df = pd.DataFrame(data, columns=columns)
-            else:
-                # Handle empty result set
-                df = pd.DataFrame()
+            driver = await self.get_driver(profile)
+            if driver is None:
+                return None, "Not connected to database", None
+            df = await driver.fetch_dataframe(query)
+            if compact:
+                df = await self.compact_result(df)
 
             if save_to_df:
                 self.dataframes[save_to_df] = df
@@ -1738,15 +4116,68 @@ class NotebookApp:
             logger.error(f"Query execution error: {e}", exc_info=True)
             return None, str(e), None
 
+    async def execute_local_sql(self, query: str, save_to_df: Optional[str] = None, compact: bool = False) -> Tuple[Optional[pd.DataFrame], Optional[str], Optional[str]]:
+        """Runs SQL in-process over the notebook's DataFrames and the CSV/Parquet files in the working directory."""
+        if not DUCKDB_AVAILABLE:
+            return None, "Local SQL requires the 'duckdb' package (pip install duckdb).", None
+        try:
+            if self.local_sql_engine is None:
+                self.local_sql_engine = DuckDBDriver(self.working_directory)
+                await self.local_sql_engine.connect({})
+            else:
+                await self.local_sql_engine.on_working_directory_change(self.working_directory)
+
+            await self.restore_spilled(query)
+            frames = {name: value for name, value in self.python_globals.items() if isinstance(value, pd.DataFrame)}
+            frames.update(self.dataframes)
+            await asyncio.to_thread(self.local_sql_engine.register_dataframes, frames) # Waits for any running query
+
+            df = await self.local_sql_engine.fetch_dataframe(query)
+            if compact:
+                df = await self.compact_result(df)
+
+            if save_to_df:
+                self.dataframes[save_to_df] = df
+                self.python_globals[save_to_df] = df
+                return df, f"Query successful. DataFrame saved as '{save_to_df}'.", save_to_df
+            return df, "Query successful.", None
+        except Exception as e:
+            logger.error(f"Local SQL execution error: {e}", exc_info=True)
+            return None, str(e), None
+
+    async def estimate_query_rows(self, query: str, profile: Optional[str] = None) -> Optional[int]:
+        """Asks the planner for the total row count of a query without running it."""
+        try:
+            driver = await self.get_driver(profile)
+            if driver is None:
+                return None
+            plan_rows = await driver.fetch_values(f"EXPLAIN {strip_sql_statement(query)}")
+            return parse_explain_row_estimate([' '.join(str(value) for value in row) for row in plan_rows])
+        except Exception as e:
+            logger.warning(f"Could not estimate row count: {e}")
+            return None
+
+    async def preview_sql(self, query: str, limit: int, profile: Optional[str] = None) -> Tuple[Optional[pd.DataFrame], Optional[str], Optional[int]]:
+        """Runs a bounded version of the query for exploratory display. Nothing is saved to a DataFrame name."""
+        if not is_previewable_query(query):
+            df, message, _ = await self.execute_sql(query, profile=profile)
+            return df, message, None
+
+        estimated_rows = await self.estimate_query_rows(query, profile)
+        df, message, _ = await self.execute_sql(build_preview_query(query, limit), profile=profile)
+        if df is not None:
+            message = "Preview successful."
+        return df, message, estimated_rows
+
     def mark_modified(self):
         self.is_modified = True
-        if hasattr(self, 'title_label'):
+        if self.title_label is not None:
             filename = self.current_filename or "Untitled"
             self.title_label.text = f"{filename}*"
 
     def mark_saved(self):
         self.is_modified = False
-        if hasattr(self, 'title_label'):
+        if self.title_label is not None:
             filename = self.current_filename or "Untitled"
             self.title_label.text = f"{filename}"
 
@@ -1756,6 +4187,7 @@ class NotebookApp:
             'created_at': datetime.now().isoformat(),
             'working_directory': str(self.working_directory),
             'is_dark_mode': self.is_dark_mode,
+            'compact_results': self.compact_results,
             'cells': [],
             'connection_config': self.last_successful_config.copy() if self.last_successful_config else {}
         }
@@ -1771,7 +4203,10 @@ class NotebookApp:
                 'code': cell_data['code'].value,
                 'df_name': cell_data['df_name'].value,
                 'is_collapsed': cell_data['is_collapsed'](),
-                'show_all_rows': cell_data['show_all_rows']
+                'show_all_rows': cell_data['show_all_rows'],
+                'preview_mode': cell_data['preview_mode'],
+                'connection_profile': cell_data['connection_profile'],
+                'compact_results': cell_data['compact_results']
             }
             notebook_data['cells'].append(cell_info)
 
@@ -1823,16 +4258,9 @@ class NotebookApp:
             if 'connection_config' in notebook_data and notebook_data['connection_config']:
                 self.last_successful_config = notebook_data['connection_config'].copy()
 
-            for cell_info in notebook_data['cells']:
-                await add_cell(cell_info['type'].lower(), initial_show_all_rows=cell_info.get('show_all_rows', False))
+            self.compact_results = notebook_data.get('compact_results', False)
 
-                if self.cells:
-                    cell_data = self.cells[-1]
-                    cell_data['code'].set_value(cell_info.get('code', ''))
-                    cell_data['df_name'].set_value(cell_info.get('df_name', ''))
-
-                    if cell_info.get('is_collapsed', False):
-                        cell_data['toggle_collapse']()
+            await self.restore_cells(notebook_data['cells'])
 
             self.current_filename = Path(filepath).name
             self.mark_saved()
@@ -1850,6 +4278,43 @@ class NotebookApp:
         self.cells.clear()
         self.dataframes.clear()
         self.python_globals.clear()
+        self.memory.clear()
+        self.variables.clear()
+        self.dataflow.clear()
+        self.jobs.clear()
+        self.repr_handles.clear()
+        if self.local_sql_engine:
+            await asyncio.to_thread(self.local_sql_engine.register_dataframes, {}) # Release the engine's references to cleared frames
+
+    async def restore_cells(self, cell_infos: List[Dict[str, Any]], keep_ids: bool = False):
+        """Adds cells from serialized cell dicts. keep_ids keeps the cells attached to their jobs and run history."""
+        for cell_info in cell_infos:
+            await add_cell(cell_info['type'].lower(),
+                           initial_show_all_rows=cell_info.get('show_all_rows', False),
+                           initial_preview_mode=cell_info.get('preview_mode', False),
+                           initial_connection_profile=cell_info.get('connection_profile', ''),
+                           initial_compact_results=cell_info.get('compact_results'),
+                           initial_cell_id=cell_info.get('id') if keep_ids else None)
+
+            if self.cells:
+                cell_data = self.cells[-1]
+                cell_data['code'].set_value(cell_info.get('code', ''))
+                cell_data['df_name'].set_value(cell_info.get('df_name', ''))
+
+                if cell_info.get('is_collapsed', False):
+                    cell_data['toggle_collapse']()
+
+    async def close(self):
+        """Releases what the session holds: jobs, connection pools and tunnels, the local SQL engine and spill files."""
+        self.jobs.clear()
+        await self.connections.close_all()
+        if self.local_sql_engine:
+            await self.local_sql_engine.close()
+            self.local_sql_engine = None
+        self.memory.clear()
+        self.python_globals.clear()
+        self.dataframes.clear()
+        self.repr_handles.clear()
 
     async def new_notebook(self):
         await self.clear_all_cells()
@@ -1857,169 +4322,223 @@ class NotebookApp:
         self.mark_saved()
         await add_cell('sql')
 
-    async def execute_python(self, code: str, show_all_rows_in_cell: bool) -> Tuple[bool, str, str, Optional[pd.DataFrame]]:
-        old_stdout = sys.stdout
-        sys.stdout = captured_output = StringIO()
+    async def execute_python(self, code: str, show_all_rows_in_cell: bool, captured_output: Optional[StreamingOutput] = None) -> Tuple[bool, List[CellOutput], Optional[pd.DataFrame]]:
+        if captured_output is None:
+            captured_output = StreamingOutput(self.working_directory / STDOUT_LOG_DIR)
+        stdout_token = _cell_stdout.set(captured_output)
+        cwd_token = None
 
-        application_process_cwd = Path.cwd()
-
-        output_type = 'text/plain'
-        final_result_representation_parts = []
+        display_outputs: List[CellOutput] = []
         figure_explicitly_handled = False
         last_displayed_or_returned_df: Optional[pd.DataFrame] = None
 
         try:
             user_working_dir = self.working_directory.resolve()
             if user_working_dir.is_dir():
-                os.chdir(user_working_dir)
-                logger.info(f"Changed CWD to: {user_working_dir} for Python execution.")
+                cwd_token = _cell_working_directory.set(user_working_dir)
+                install_cell_path_hooks()
             else:
                 logger.warning(f"User working directory '{user_working_dir}' is not a valid directory. "
-                               f"Executing Python code in application CWD: '{application_process_cwd}'.")
+                               f"Relative paths in Python code resolve against the application CWD: '{Path.cwd()}'.")
 
-            plt.close('all')
+            if is_module_loaded('matplotlib.pyplot'): # Only touch matplotlib once a cell has used it
+                plt.close('all')
 
+            await self.restore_spilled(code)
             exec_globals = {'pd': pd, 'np': np, 'asyncio': asyncio, 'plt': plt, **self.python_globals}
+            exec_globals['__builtins__'] = {**builtins.__dict__, 'open': cell_open, '__import__': cell_import}
+            exec_globals['wd'] = user_working_dir # For paths the hooks don't cover, e.g. subprocess.run(..., cwd=wd)
+            exec_globals['chart'] = chart
+            exec_globals['plot_series'] = plot_series
 
             def custom_display_func(obj):
-                nonlocal final_result_representation_parts, output_type, figure_explicitly_handled, last_displayed_or_returned_df
+                nonlocal figure_explicitly_handled, last_displayed_or_returned_df
                 if isinstance(obj, pd.DataFrame):
                     if show_all_rows_in_cell:
                         max_rows_to_display = 200
                     else:
                         max_rows_to_display = 20
 
-                    html_table = obj.to_html(classes='dataframe', border=0, max_rows=max_rows_to_display, escape=False)
-
-                    message_suffix = ""
-                    if not show_all_rows_in_cell and len(obj) > 20:
-                        message_suffix = f"<p>*Showing first 20 of {len(obj)} rows. To see 200 rows, toggle 'Show all rows' in this cell's header.*</p>"
-                    elif show_all_rows_in_cell and len(obj) > 200:
-                        message_suffix = f"<p>*Showing first 200 of {len(obj)} rows due to display limit. Full DataFrame is available in memory.*</p>"
-                    elif show_all_rows_in_cell and len(obj) > 20:
-                        message_suffix = f"<p>*Showing all {len(obj)} rows.*</p>"
-
-                    final_result_representation_parts.append(f"{html_table}{message_suffix}")
-                    output_type = 'text/html'
+                    display_outputs.append(table_output(obj, max_rows_to_display))
+                    note = row_limit_note(len(obj), show_all_rows_in_cell)
+                    if note is not None:
+                        display_outputs.append(note)
                     last_displayed_or_returned_df = obj # Capture DataFrame
 
-                elif isinstance(obj, matplotlib.figure.Figure):
-                    buffer = io.BytesIO()
-                    obj.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0.1)
+                elif is_module_loaded('matplotlib.figure') and isinstance(obj, sys.modules['matplotlib.figure'].Figure):
+                    with metrics.stage('render'):
+                        buffer = io.BytesIO()
+                        obj.savefig(buffer, format='png', bbox_inches='tight', pad_inches=0.1)
+                        image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
 
-                    image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-                    final_result_representation_parts.append(
-                        f'<img src="data:image/png;base64,{image_base64}" style="max-width: 100%; height: auto; display: block; margin: 10px 0;"/>'
-                    )
-                    output_type = 'text/html'
+                    display_outputs.append(CellOutput('image', f'data:image/png;base64,{image_base64}'))
+                    if getattr(obj, 'dnb_note', None): # Set by plot_series
+                        display_outputs.append(CellOutput('markdown', obj.dnb_note))
                     plt.close(obj)
                     figure_explicitly_handled = True
                     last_displayed_or_returned_df = None # Clear if a figure is displayed
 
+                elif isinstance(obj, ChartSpec):
+                    display_outputs.append(CellOutput('chart', obj))
+                    if obj.note:
+                        display_outputs.append(CellOutput('markdown', obj.note))
+                    last_displayed_or_returned_df = None
+
                 elif obj is not None:
-                    final_result_representation_parts.append(repr(obj))
-                    if output_type != 'text/html':
-                         output_type = 'text/plain'
+                    display_outputs.append(self.display_object(obj))
                     last_displayed_or_returned_df = None # Clear for other types
 
             exec_globals['display'] = custom_display_func
 
-            modified_code = code.replace('time.sleep(', 'await asyncio.sleep(')
-            needs_async = ('await ' in modified_code or 'async def' in code)
-
-            if needs_async:
-                exec_code = f"async def __async_exec():\n{chr(10).join('    ' + line for line in modified_code.split(chr(10)))}\n\n__async_result = __async_exec()"
-                exec(exec_code, exec_globals, exec_globals)
-                await exec_globals['__async_result']
-            else:
-                exec(code, exec_globals, exec_globals)
+            with metrics.stage('python_exec', exclude=('render', 'db_roundtrip', 'conversion', 'connect')):
+                last_value = await python_compiler.run(code, exec_globals)
 
             self.python_globals.update({
                 k: v for k, v in exec_globals.items()
-                if not k.startswith('__') and k not in ['pd', 'np', 'display', 'asyncio', 'plt', 'matplotlib', 'io', 'base64']
+                if not k.startswith('__') and k not in ['pd', 'np', 'display', 'asyncio', 'plt', 'matplotlib', 'io', 'base64', 'wd', 'chart', 'plot_series']
             })
 
             std_out_content = captured_output.getvalue()
 
-            if plt.get_fignums() and not figure_explicitly_handled:
+            if is_module_loaded('matplotlib.pyplot') and plt.get_fignums() and not figure_explicitly_handled:
                 for fig_num in plt.get_fignums():
                     fig = plt.figure(fig_num)
                     custom_display_func(fig) # This will clear last_displayed_or_returned_df
 
-            if not final_result_representation_parts and code.strip():
-                lines = code.strip().split('\n')
-                if lines:
-                    last_line = lines[-1].strip()
-                    is_simple_expression = (last_line and not any(
-                        last_line.startswith(kw) for kw in
-                        ['import ', 'from ', 'def ', 'class ', 'if ', 'for ', 'while ',
-                         'with ', 'try ', 'print(', '#', '@']
-                    ) and '=' not in last_line)
-
-                    if is_simple_expression:
-                        try:
-                            evaluated_result = eval(last_line, exec_globals)
-                            # If the result is a DataFrame, custom_display_func will capture it
-                            # in last_displayed_or_returned_df.
-                            custom_display_func(evaluated_result)
-                        except Exception:
-                            pass
-
-            final_result_representation = "\n".join(final_result_representation_parts)
-
-            combined_output = ""
-            if std_out_content:
-                combined_output = f"<pre>{std_out_content.strip()}</pre>"
-                if final_result_representation and output_type == 'text/html':
-                    combined_output += f"\n{final_result_representation}"
-                elif final_result_representation:
-                    combined_output += f"\n<pre>{final_result_representation}</pre>"
-                output_type = 'text/html' if (final_result_representation and output_type == 'text/html') or std_out_content else 'text/plain'
-            elif final_result_representation:
-                combined_output = final_result_representation
-
-            if not combined_output.strip():
-                combined_output = "Code executed successfully (no output)."
-                output_type = 'text/plain'
+            if not display_outputs:
+                # If the result is a DataFrame, custom_display_func will capture it in last_displayed_or_returned_df.
+                custom_display_func(last_value)
+
+            outputs = [CellOutput('text', std_out_content.strip())] if std_out_content.strip() else []
+            outputs.extend(display_outputs)
+            if not outputs:
+                outputs = [CellOutput('text', "Code executed successfully (no output).")]
 
             self.mark_modified()
-            return True, combined_output, output_type, last_displayed_or_returned_df
+            return True, outputs, last_displayed_or_returned_df
 
         except Exception as e:
             error_message = f"Error: {str(e)}\n{traceback.format_exc()}"
             std_out_content = captured_output.getvalue()
             if std_out_content:
                 error_message = f"{std_out_content}\n{error_message}"
-            return False, error_message, 'text/plain', None
+            return False, [CellOutput('text', error_message)], None
         finally:
-            sys.stdout = old_stdout
-            os.chdir(application_process_cwd)
-            plt.close('all')
-            logger.info(f"Restored CWD to: {application_process_cwd} after Python execution.")
-
-notebook = NotebookApp()
-ui.add_head_html(custom_css)
-ui.add_head_html(DB_EXPLORER_CSS)
-ui.add_body_html(DB_EXPLORER_JS)
-ui.on('js_notify', lambda e: ui.notify(e.args[0], type=e.args[1]))
-
-
-left_drawer_instance: Optional[ui.left_drawer] = None
-right_drawer_instance: Optional[ui.right_drawer] = None
-file_tree: Optional[ui.tree] = None
-tree_container: Optional[ui.scroll_area] = None
-cell_container: Optional[ui.column] = None
-status_indicator: Optional[ui.html] = None
-status_label: Optional[ui.label] = None
-reconnect_btn: Optional[ui.button] = None
-title_label: Optional[ui.label] = None
-working_dir_input: Optional[ui.input] = None
-current_working_dir_label: Optional[ui.label] = None
-working_dir_display: Optional[ui.label] = None
-schema_container: Optional[ui.scroll_area] = None
-schema_explorer_div: Optional[ui.html] = None
-active_tab: Optional[ui.tabs] = None
+            _cell_stdout.reset(stdout_token)
+            captured_output.close()
+            if cwd_token is not None:
+                _cell_working_directory.reset(cwd_token)
+            if is_module_loaded('matplotlib.pyplot'):
+                plt.close('all')
+
+# --- Sessions ---
+MAX_SESSIONS = int(os.environ.get('DNB_MAX_SESSIONS', '50'))
+SESSION_IDLE_TIMEOUT_SECONDS = int(os.environ.get('DNB_SESSION_IDLE_TIMEOUT', '3600'))
+SESSION_MAX_CONCURRENT_JOBS = int(os.environ.get('DNB_SESSION_MAX_JOBS', '2'))
+SESSION_MAINTENANCE_INTERVAL_SECONDS = 60
+
+_current_notebook: contextvars.ContextVar[Optional[NotebookApp]] = contextvars.ContextVar('current_notebook', default=None)
+
+class SessionRegistry:
+    """One NotebookApp per browser (NiceGUI browser storage id), each with its own kernel, connection pools and jobs.
+    Sessions without an open page or running job are closed after the idle timeout."""
+
+    def __init__(self, max_sessions: int, idle_timeout: float):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions: Dict[str, NotebookApp] = {}
+        self.last_seen: Dict[str, float] = {}
+        self.client_sessions: Dict[str, str] = {} # NiceGUI client id -> session id
+
+    def open(self, session_id: str, client_id: str) -> Optional[NotebookApp]:
+        """Returns the browser's notebook, creating it if the server has room, and binds the page's client to it."""
+        if session_id not in self.sessions:
+            if len(self.sessions) >= self.max_sessions:
+                return None
+            self.sessions[session_id] = NotebookApp()
+            logger.info(f"Opened session {session_id[:8]} ({len(self.sessions)}/{self.max_sessions})")
+        self.client_sessions[client_id] = session_id
+        self.last_seen[session_id] = time.time()
+        return self.sessions[session_id]
+
+    def get(self, session_id: Optional[str]) -> Optional[NotebookApp]:
+        return self.sessions.get(session_id) if session_id else None
+
+    def for_client(self, client_id: str) -> Optional[NotebookApp]:
+        session_id = self.client_sessions.get(client_id)
+        if session_id in self.sessions:
+            self.last_seen[session_id] = time.time()
+        return self.get(session_id)
+
+    def is_busy(self, session_id: str) -> bool:
+        """True while a page is connected or a job is running; such sessions are never reaped."""
+        if any(not job.done.is_set() for job in self.sessions[session_id].jobs.jobs.values()):
+            return True
+        return any(sid == session_id and client_id in Client.instances and Client.instances[client_id].has_socket_connection
+                   for client_id, sid in self.client_sessions.items())
+
+    async def maintain(self):
+        """Closes idle connection profiles in every session and reaps sessions idle for longer than the timeout."""
+        self.client_sessions = {client_id: sid for client_id, sid in self.client_sessions.items() if client_id in Client.instances}
+        now = time.time()
+        for session_id, session_notebook in list(self.sessions.items()):
+            if self.is_busy(session_id):
+                self.last_seen[session_id] = now
+                await session_notebook.connections.close_idle(keep=session_notebook.active_profile)
+            elif now - self.last_seen.get(session_id, now) > self.idle_timeout:
+                logger.info(f"Closing idle session {session_id[:8]}")
+                await self.close(session_id)
+            else:
+                await session_notebook.connections.close_idle(keep=session_notebook.active_profile)
+
+    async def close(self, session_id: str):
+        session_notebook = self.sessions.pop(session_id, None)
+        self.last_seen.pop(session_id, None)
+        if session_notebook is not None:
+            await session_notebook.close()
+
+    async def close_all(self):
+        for session_id in list(self.sessions):
+            await self.close(session_id)
+
+class SessionNotebook:
+    """Stands in for the notebook of the session in scope, so page code can keep using `notebook`.
+    Resolves through the current NiceGUI client, or the session bound to the current task (jobs, page build)."""
+
+    def _resolve(self) -> NotebookApp:
+        try:
+            client = context.client
+        except RuntimeError: # No slot on this task, e.g. a task started with asyncio.create_task
+            client = None
+        session_notebook = sessions.for_client(client.id) if client is not None else None
+        if session_notebook is not None:
+            _current_notebook.set(session_notebook) # Inherited by tasks started from here
+            return session_notebook
+        session_notebook = _current_notebook.get()
+        if session_notebook is None:
+            raise RuntimeError("No notebook session is bound to the current context.")
+        return session_notebook
+
+    def __getattr__(self, name: str):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        setattr(self._resolve(), name, value)
+
+def notebook_for_request(request: Request) -> Optional[NotebookApp]:
+    """Session of an HTTP request, from the browser storage cookie."""
+    session_id = request.session.get('id') if 'session' in request.scope else None
+    return sessions.get(session_id)
+
+sessions = SessionRegistry(MAX_SESSIONS, SESSION_IDLE_TIMEOUT_SECONDS)
+notebook = SessionNotebook()
+
+def session_task(coro) -> asyncio.Task:
+    """asyncio.create_task for page handlers. The task keeps the handler's session even though it has no page slot."""
+    _current_notebook.set(notebook._resolve())
+    return asyncio.create_task(coro)
+
+
 
 
 
@@ -2136,6 +4655,31 @@ async def _do_load_notebook():
         else:
             ui.notify("Failed to load notebook", type='negative')
 
+async def reattach_jobs():
+    """Re-attaches the cells on the page to their latest jobs: running ones resume their progress display,
+    finished ones that this page has not shown yet are rendered."""
+    for cell_data in notebook.cells:
+        job = notebook.jobs.latest_for_cell(cell_data['id'])
+        if job is None:
+            continue
+        if not job.done.is_set():
+            if cell_data['attached_job_id'] != job.id:
+                session_task(cell_data['attach_job'](job))
+        elif cell_data['rendered_job_id'] != job.id:
+            cell_data['render_job_result'](job)
+
+async def run_stale_cells():
+    """Re-runs, in dependency order, only the cells whose code or input variables changed since their last successful run."""
+    ran = 0
+    for cell_data in notebook.stale_execution_order():
+        if not notebook.is_cell_stale(cell_data): # Checked as we go, so re-runs upstream invalidate cells downstream
+            continue
+        ran += 1
+        if not await cell_data['run_cell']():
+            ui.notify(f"Stopped at cell {cell_data['id']} after an error. {ran - 1} stale cell(s) re-ran before it.", type='negative')
+            return
+    ui.notify(f"Re-ran {ran} stale cell(s)." if ran else "All cells are up to date.", type='positive' if ran else 'info')
+
 async def handle_new_notebook():
     if notebook.is_modified:
         with ui.dialog() as confirm_dialog:
@@ -2161,7 +4705,7 @@ async def save_cell_code(cell_data: Dict[str, Any]):
         ui.notify("Cell is empty. Nothing to save.", type='warning')
         return
 
-    if cell_type == 'sql':
+    if cell_type in ('sql', 'local sql'):
         file_extension = '.sql'
     elif cell_type == 'python':
         file_extension = '.py'
@@ -2195,27 +4739,60 @@ async def save_cell_code(cell_data: Dict[str, Any]):
         logger.error(f"Failed to save cell code to {actual_filepath}: {e}", exc_info=True)
         ui.notify(f"Failed to save cell code: {e}", type='negative')
 
+async def open_result_profile(cell_data: Dict[str, Any]):
+    """Shows an approximate profile of the cell's result: null rate, distinct count, quantiles and frequent values."""
+    job = notebook.jobs.jobs.get(cell_data.get('rendered_job_id'))
+    if job is None or not isinstance(job.result.get('df'), (pd.DataFrame, SpilledFrame)):
+        ui.notify("No result available to profile for this cell.", type='warning')
+        return
+    columns = [{'name': key, 'label': label, 'field': key, 'align': 'left'} for key, label in
+               [('column', 'Column'), ('dtype', 'Dtype'), ('nulls', 'Nulls'), ('distinct', 'Distinct'), ('min', 'Min'),
+                ('p25', 'P25'), ('p50', 'Median'), ('p75', 'P75'), ('p99', 'P99'), ('max', 'Max'), ('top', 'Frequent values')]]
+
+    with ui.dialog() as profile_dialog, ui.card().style('max-width: 95vw; width: 1200px'):
+        with ui.row().classes('w-full items-center'):
+            ui.label(f"Profile of cell {cell_data['id']} result").classes('text-lg font-semibold')
+            ui.space()
+            ui.button(icon='close', on_click=profile_dialog.close).props('flat round dense')
+        progress_label = ui.label('Profiling...').classes('text-sm')
+        profile_table = ui.table(columns=columns, rows=[], row_key='column', pagination=15).props('dense flat').classes('w-full')
+    profile_dialog.open()
+
+    def show(profile: ResultProfile):
+        profile_table.rows = profile.summary()
+        profile_table.update()
+        if profile.complete:
+            progress_label.text = (f"{profile.total_rows:,} rows. Distinct counts are HyperLogLog estimates (about ±1%), "
+                                   "quantiles come from a t-digest and frequent-value counts are lower bounds.")
+        else:
+            progress_label.text = f"Profiled {profile.rows_profiled:,} of {profile.total_rows:,} rows..."
+
+    try:
+        profile = await notebook.profile_result(job, on_batch=show)
+    except Exception as e:
+        logger.error(f"[{cell_data['id']}] Profiling failed: {e}", exc_info=True)
+        progress_label.text = f"Profiling failed: {e}"
+        return
+    if profile is not None:
+        show(profile)
+
 async def handle_download_csv(cell_data: Dict[str, Any]):
     """Handles downloading the DataFrame from a cell as CSV."""
     df_to_download = cell_data.get('df_to_download')
     cell_id = cell_data['id']
-    cell_type_value = cell_data['type'].value # 'SQL' or 'Python'
+    cell_type_value = cell_data['type'].value # 'SQL', 'Local SQL' or 'Python'
 
-    if df_to_download is None or not isinstance(df_to_download, pd.DataFrame):
+    if not isinstance(df_to_download, (pd.DataFrame, SpilledFrame)):
         ui.notify("No DataFrame available to download for this cell.", type='warning')
         return
 
     base_filename_stem = "table_export"
-    if cell_type_value == 'SQL':
+    if cell_type_value in SQL_CELL_TYPES:
         df_name_from_input = cell_data['df_name'].value.strip()
         base_filename_stem = df_name_from_input if df_name_from_input else f"sql_result_{cell_id}"
     elif cell_type_value == 'Python':
-        py_df_var_name = None
-        for name, var_instance in notebook.python_globals.items():
-            if var_instance is df_to_download:
-                py_df_var_name = name
-                break
-        if py_df_var_name:
+        py_df_var_name = notebook.memory.frame_names.get(id(df_to_download))
+        if py_df_var_name and notebook.python_globals.get(py_df_var_name) is df_to_download:
             base_filename_stem = py_df_var_name
         else:
             base_filename_stem = f"python_output_{cell_id}"
@@ -2236,6 +4813,8 @@ async def handle_download_csv(cell_data: Dict[str, Any]):
         counter += 1
 
     try:
+        if isinstance(df_to_download, SpilledFrame): # Export straight from disk without pulling it back into the namespace
+            df_to_download = await asyncio.to_thread(df_to_download.load)
         await asyncio.to_thread(df_to_download.to_csv, filepath, index=False)
         ui.notify(f"Table saved as '{filename}' in working directory.", type='positive')
         await refresh_trees_ui()
@@ -2245,21 +4824,21 @@ async def handle_download_csv(cell_data: Dict[str, Any]):
 
 async def refresh_schema_explorer():
     """Refreshes the new JavaScript-based schema explorer."""
-    global schema_container
-    if not schema_container:
+    if not notebook.schema_container:
         return
 
-    with schema_container:
+    with notebook.schema_container:
         if not notebook.db_connection:
-            schema_container.clear()
-            with schema_container:
+            notebook.schema_container.clear()
+            with notebook.schema_container:
                 ui.label("Not connected to database").classes('text-gray-500 p-4 text-center')
             return
 
+        run_metrics, metrics_token = metrics.begin('schema_load', notebook.active_profile or '')
         try:
             # Show a loading state
-            schema_container.clear()
-            with schema_container:
+            notebook.schema_container.clear()
+            with notebook.schema_container:
                 ui.spinner(size='md').classes('mx-auto my-8')
                 ui.label("Loading schema...").classes('text-center text-gray-500')
 
@@ -2272,53 +4851,63 @@ async def refresh_schema_explorer():
             schema_names = sorted(list(schema_data.keys()))
 
             # Clear loading state and initialize JS component
-            schema_container.clear()
-            with schema_container:
-                ui.html('<div id="db-explorer-container" style="margin: 0; padding: 0;"></div>')
-                ui.run_javascript(f'''
-                    new DbExplorer('db-explorer-container', {{ schemas: {json.dumps(schema_names)} }});
-                ''')
+            with metrics.stage('render'):
+                schema_payload = json.dumps(schema_names)
+                metrics.record_payload(schema_payload)
+                notebook.schema_container.clear()
+                with notebook.schema_container:
+                    ui.html('<div id="db-explorer-container" style="margin: 0; padding: 0;"></div>')
+                    ui.run_javascript(f'''
+                        new DbExplorer('db-explorer-container', {{ schemas: {schema_payload} }});
+                    ''')
 
         except Exception as e:
+            run_metrics.status = 'error'
             logger.error(f"Error refreshing schema explorer: {e}", exc_info=True)
-            schema_container.clear()
-            with schema_container:
+            notebook.schema_container.clear()
+            with notebook.schema_container:
                 ui.label(f"Error loading schema: {e}").classes('text-red-500 p-4')
+        finally:
+            metrics.finish(run_metrics, metrics_token, notebook.run_history)
 
 
 async def refresh_trees_ui():
     """Refresh both file tree and schema tree if needed."""
-    global file_tree, tree_container, notebook
 
-    if active_tab.value == 'files':
-        if not tree_container:
+    if notebook.active_tab.value == 'files':
+        if not notebook.tree_container:
             return
 
-        new_tree_nodes, new_state_snapshot = create_file_tree(path=notebook.working_directory, max_depth=3)
-
-        if new_state_snapshot != notebook.last_tree_state:
-            logger.info("File tree changed. Updating UI...")
-            notebook.last_tree_state = new_state_snapshot
-            tree_container.clear()
+        run_metrics, metrics_token = metrics.begin('file_tree', notebook.working_directory.name)
+        try:
+            with metrics.stage('scan'):
+                new_tree_nodes, new_state_snapshot = create_file_tree(path=notebook.working_directory, max_depth=3)
 
-            with tree_container:
-                if new_tree_nodes:
-                    file_tree = ui.tree(new_tree_nodes, label_key='label', children_key='children', node_key='id').classes('w-full').style('margin-left: -10px; margin-top: -10px;')
+            if new_state_snapshot != notebook.last_tree_state:
+                logger.info("File tree changed. Updating UI...")
+                notebook.last_tree_state = new_state_snapshot
+                with metrics.stage('render'):
+                    metrics.record_payload(json.dumps(new_tree_nodes))
+                    notebook.tree_container.clear()
 
-                    def on_tree_double_click(event):
-                        if event.args and event.args.get('node') and event.args['node'].get('is_file') and event.args['node'].get('path', '').endswith('.dnb'):
-                            asyncio.create_task(load_notebook_from_path(event.args['node']['path']))
+                    with notebook.tree_container:
+                        if new_tree_nodes:
+                            notebook.file_tree = ui.tree(new_tree_nodes, label_key='label', children_key='children', node_key='id').classes('w-full').style('margin-left: -10px; margin-top: -10px;')
 
-                    file_tree.on('dblclick', on_tree_double_click, ['node'])
+                            def on_tree_double_click(event):
+                                if event.args and event.args.get('node') and event.args['node'].get('is_file') and event.args['node'].get('path', '').endswith('.dnb'):
+                                    session_task(load_notebook_from_path(event.args['node']['path']))
 
-                    expand_ids = [node['id'] for node in new_tree_nodes if not node.get('is_file', True) and 'children' in node]
-                    if expand_ids:
-                        file_tree.expand(expand_ids)
+                            notebook.file_tree.on('dblclick', on_tree_double_click, ['node'])
 
-                    ui.timer(0.2, lambda: ui.run_javascript('colorizeDnbFiles()'), once=True)
-                else:
-                    ui.label("Directory is empty or inaccessible.").classes('q-pa-md text-caption text-[var(--text-secondary)]')
-    elif active_tab.value == 'schema':
+                            expand_ids = [node['id'] for node in new_tree_nodes if not node.get('is_file', True) and 'children' in node]
+                            if expand_ids:
+                                notebook.file_tree.expand(expand_ids)
+                        else:
+                            ui.label("Directory is empty or inaccessible.").classes('q-pa-md text-caption text-[var(--text-secondary)]')
+        finally:
+            metrics.finish(run_metrics, metrics_token, notebook.run_history)
+    elif notebook.active_tab.value == 'schema':
         # The schema explorer is now refreshed on its own schedule (on connect, on tab switch)
         pass
 
@@ -2354,20 +4943,19 @@ async def handle_browse_working_directory():
     selected_path_str = await pick_directory_native()
     if selected_path_str:
         logger.info(f"Native directory picker returned: {selected_path_str}")
-        if working_dir_input:
-            working_dir_input.set_value(selected_path_str)
+        if notebook.working_dir_input:
+            notebook.working_dir_input.set_value(selected_path_str)
         await update_working_directory_and_tree(selected_path_str)
     else:
         logger.info("Native directory picker cancelled or returned no path.")
         ui.notify("Directory selection cancelled or failed.", type='info')
 
 async def update_working_directory_and_tree(new_path_str: str):
-    global file_tree, working_dir_display
 
     if not new_path_str.strip():
         ui.notify("Working directory path cannot be empty.", type='warning')
-        if working_dir_input:
-            working_dir_input.set_value(str(notebook.working_directory))
+        if notebook.working_dir_input:
+            notebook.working_dir_input.set_value(str(notebook.working_directory))
         return
 
     prospective_path = Path(new_path_str.strip())
@@ -2377,25 +4965,26 @@ async def update_working_directory_and_tree(new_path_str: str):
         new_resolved_path = prospective_path.resolve()
 
     if new_resolved_path == notebook.working_directory:
-        if working_dir_input:
-            working_dir_input.set_value(str(notebook.working_directory))
+        if notebook.working_dir_input:
+            notebook.working_dir_input.set_value(str(notebook.working_directory))
         await refresh_trees_ui()
         return
 
     if not new_resolved_path.is_dir():
         ui.notify(f"Invalid or inaccessible directory: {new_resolved_path}", type='negative')
-        if working_dir_input:
-            working_dir_input.set_value(str(notebook.working_directory))
+        if notebook.working_dir_input:
+            notebook.working_dir_input.set_value(str(notebook.working_directory))
         return
 
     notebook.working_directory = new_resolved_path
+    await notebook.connections.on_working_directory_change(new_resolved_path)
 
-    if working_dir_input:
-        working_dir_input.set_value(str(notebook.working_directory))
+    if notebook.working_dir_input:
+        notebook.working_dir_input.set_value(str(notebook.working_directory))
 
-    if working_dir_display:
+    if notebook.working_dir_display:
         display_path = get_last_n_path_parts(str(notebook.working_directory), 2)
-        working_dir_display.text = display_path
+        notebook.working_dir_display.text = display_path
 
     await refresh_trees_ui()
 
@@ -2439,34 +5028,205 @@ def delete_bottom_most_cell():
         logger.error("Could not delete the last cell: 'delete_func' not found in cell data.")
         ui.notify("An error occurred while trying to delete the cell.", type='negative')
 
-async def add_cell(cell_type='sql', initial_show_all_rows=False):
-    cell_id = notebook.generate_cell_id()
+def profile_select_options() -> Dict[str, str]:
+    options = {'': 'Active connection'}
+    options.update({name: name for name in notebook.connections.profile_names()})
+    return options
+
+def refresh_profile_selects():
+    """Updates every cell's connection picker after profiles are added."""
+    options = profile_select_options()
+    for cell_data in notebook.cells:
+        profile_select = cell_data.get('profile_select')
+        if profile_select is not None:
+            profile_select.options = options
+            profile_select.update()
+
+# --- Cell Virtualization ---
+OFFSCREEN_OUTPUT_CHARS = 20_000 # Outputs larger than this are dropped from the page while their cell is off-screen
+
+def editor_height(code: str) -> int:
+    """Height of an auto-expanded editor for this code, so placeholders keep the page from jumping."""
+    lines = max(4, min(25, code.count('\n') + 2))
+    return lines * 24 + 16
+
+class LazyCodeEditor:
+    """A cell's code editor that only exists as a ui.codemirror while the cell is near the viewport.
+    Otherwise a static <pre> of the code stands in, and the value, language and theme are kept here."""
+
+    def __init__(self, container: ui.column, cell_id: str, language: str, theme: str):
+        self.container = container
+        self.cell_id = cell_id
+        self._value = ''
+        self._language = language
+        self._theme = theme
+        self.handlers = []
+        self.editor: Optional[ui.codemirror] = None
+        self.placeholder: Optional[ui.html] = None
+        self._show_placeholder()
+
+    def _show_placeholder(self):
+        with self.container:
+            self.placeholder = ui.html('').classes('w-full code-editor-placeholder')
+        self.placeholder.move(target_index=0)
+        self.placeholder.on('click', self.mount) # In case the page never reports the cell in view
+        self._update_placeholder()
+
+    def _update_placeholder(self):
+        self.placeholder.style(f'height: {editor_height(self._value)}px')
+        self.placeholder.set_content(f'<pre>{html.escape(self._value)}</pre>')
+
+    @property
+    def value(self) -> str:
+        return self.editor.value if self.editor is not None else self._value
+
+    def set_value(self, value: str):
+        self._value = value
+        if self.editor is not None:
+            self.editor.set_value(value) # Fires the editor's own change handlers
+            return
+        self._update_placeholder()
+        for handler in self.handlers:
+            handler()
+
+    def on_value_change(self, handler):
+        self.handlers.append(handler)
+        if self.editor is not None:
+            self.editor.on_value_change(handler)
+
+    @property
+    def language(self) -> str:
+        return self._language
+
+    @language.setter
+    def language(self, language: str):
+        self._language = language
+        if self.editor is not None:
+            self.editor.language = language
+
+    @property
+    def theme(self) -> str:
+        return self._theme
+
+    @theme.setter
+    def theme(self, theme: str):
+        self._theme = theme
+        if self.editor is not None:
+            self.editor.theme = theme
+
+    def mount(self):
+        if self.editor is not None:
+            return
+        self.placeholder.delete()
+        self.placeholder = None
+        with self.container:
+            self.editor = ui.codemirror(value=self._value, language=self._language, theme=self._theme).classes('w-full code-editor')
+        self.editor.props(f'data-cell-id="{self.cell_id}"')
+        self.editor.move(target_index=0)
+        for handler in self.handlers:
+            self.editor.on_value_change(handler)
+        ui.run_javascript(f'dnbSetupEditor("c{self.editor.id}")')
+
+    def unmount(self):
+        if self.editor is None:
+            return
+        self._value = self.editor.value
+        self.editor.delete()
+        self.editor = None
+        self._show_placeholder()
+
+def render_output_placeholder(container, height: float):
+    """Keeps the space of outputs dropped from the page while their cell is off-screen."""
+    container.clear()
+    with container:
+        ui.element('div').style(f'height: {max(0, height - 24)}px') # Minus the output area's padding
+
+def set_cell_in_view(event):
+    cell_id, in_view = event.args.get('id'), event.args.get('visible')
+    for cell_data in notebook.cells:
+        if cell_data['id'] == cell_id:
+            cell_data['set_in_view'](bool(in_view), event.args.get('output_height') or 0)
+            break
+
+def expand_repr_output(container, output: CellOutput):
+    expanded = notebook.expand_repr(output.data['handle'], output.data['level'] + 1)
+    if expanded is None:
+        ui.notify('This value is no longer available. Re-run the cell to show it again.', type='warning')
+        return
+    render_cell_outputs(container, [expanded])
+
+def render_cell_outputs(container, outputs: List[CellOutput]):
+    """Replaces a cell's output elements, one per typed output. Only markdown outputs are parsed on the server."""
+    container.clear()
+    with container:
+        for output in outputs:
+            if output.kind == 'markdown':
+                ui.markdown(output.data).classes('w-full')
+            elif output.kind == 'text':
+                ui.html(f'<pre>{html.escape(output.data)}</pre>').classes('w-full')
+            elif output.kind == 'image':
+                ui.html(f'<img src="{output.data}" style="max-width: 100%; height: auto; display: block; margin: 10px 0;"/>')
+            elif output.kind == 'table':
+                ui.html(output.data['html']).classes('w-full')
+            elif output.kind == 'chart':
+                ui.echart(output.data.options).classes('w-full').style(f'height: {CHART_HEIGHT_PX}px')
+            elif output.kind == 'repr':
+                with ui.column().classes('w-full gap-0') as repr_box:
+                    ui.html(f'<pre>{html.escape(output.data["text"])}</pre>').classes('w-full')
+                    ui.button('Show more', icon='unfold_more', on_click=functools.partial(expand_repr_output, repr_box, output)) \
+                        .props('dense flat size=sm color=primary')
+            else:
+                ui.html(output.data).classes('w-full')
+
+async def add_cell(cell_type='sql', initial_show_all_rows=False, initial_preview_mode=False, initial_connection_profile='', initial_compact_results=None, initial_cell_id=None):
+    cell_id = initial_cell_id or notebook.generate_cell_id()
 
     cell_data_dict = {
         'id': cell_id,
         'show_all_rows': initial_show_all_rows,
+        'preview_mode': initial_preview_mode,
+        'connection_profile': initial_connection_profile,
+        'compact_results': initial_compact_results, # None follows the notebook default
+        'profile_select': None,
+        'last_run_metrics': None,
+        'attached_job_id': None, 'rendered_job_id': None,
+        'outputs': [], 'in_view': None, 'outputs_dropped': False, # in_view is None until the page reports it
         'type': None, 'code': None, 'df_name': None, 'container': None,
         'execution_status': None, 'timer_label': None, 'spinner': None,
         'execution_result': None, 'result_icon': None, 'result_time': None,
         'is_collapsed': lambda: False, 'toggle_collapse': None,
         'output_container': None,
-        'output_area_markdown': None,
+        'output_area': None,
         'download_button_row': None,
+        'materialize_button': None,
         'df_to_download': None,
         'delete_func': None,  # Placeholder for the delete function
     }
 
-    with cell_container:
-        cell_element = ui.column().classes('code-cell w-full cell-with-gutter')
+    with notebook.cell_container:
+        cell_element = ui.column().classes('code-cell w-full cell-with-gutter').props(f'data-cell-id="{cell_id}"')
         is_collapsed = False
 
         with cell_element:
             with ui.row().classes('code-cell-header w-full'):
                 collapse_btn = ui.html('<button class="collapse-button"><span class="collapse-icon">🠉</span></button>')
-                initial_select_value = 'Python' if cell_type == 'python' else cell_type.upper()
-                cell_type_select = ui.select(options=['SQL', 'Python'], value=initial_select_value).classes('w-25 header-control-padding')
+                initial_select_value = normalize_cell_type(cell_type)
+                cell_type_select = ui.select(options=CELL_TYPE_OPTIONS, value=initial_select_value).classes('w-25 header-control-padding')
                 df_name_input = ui.input(placeholder='Save to Dataframe', value='').style('width: 120px')
-                df_name_input.visible = cell_type.upper() == 'SQL'
+                df_name_input.visible = initial_select_value in SQL_CELL_TYPES
+
+                cell_profile_options = profile_select_options()
+                if initial_connection_profile not in cell_profile_options:
+                    cell_profile_options[initial_connection_profile] = initial_connection_profile
+                profile_select = ui.select(options=cell_profile_options, value=initial_connection_profile) \
+                                    .classes('header-control-padding').style('min-width: 110px') \
+                                    .tooltip('Connection profile for this cell')
+                profile_select.visible = initial_select_value == 'SQL'
+
+                def on_profile_change(e):
+                    cell_data_dict['connection_profile'] = e.value or ''
+                    notebook.mark_modified()
+                profile_select.on_value_change(on_profile_change)
 
                 show_all_rows_switch = ui.switch('Show all rows', value=cell_data_dict['show_all_rows']) \
                                         .classes('text-sm mr-2').props('dense color=primary')
@@ -2476,6 +5236,26 @@ async def add_cell(cell_type='sql', initial_show_all_rows=False):
                     notebook.mark_modified()
                 show_all_rows_switch.on_value_change(on_show_all_rows_change)
 
+                preview_switch = ui.switch('Preview', value=cell_data_dict['preview_mode']) \
+                                    .classes('text-sm mr-2').props('dense color=primary') \
+                                    .tooltip(f'Fetch only the displayed rows (LIMIT {PREVIEW_ROW_LIMIT}/{PREVIEW_ROW_LIMIT_ALL_ROWS}) and show the estimated total')
+                preview_switch.visible = initial_select_value == 'SQL'
+
+                def on_preview_change(e):
+                    cell_data_dict['preview_mode'] = e.value
+                    notebook.mark_modified()
+                preview_switch.on_value_change(on_preview_change)
+
+                compact_switch = ui.switch('Compact', value=cell_data_dict['compact_results']) \
+                                    .classes('text-sm mr-2').props('dense color=primary toggle-indeterminate') \
+                                    .tooltip('Downcast numbers and compress text columns of the result. Indeterminate follows the notebook setting in the Variables panel')
+                compact_switch.visible = initial_select_value in SQL_CELL_TYPES
+
+                def on_compact_change(e):
+                    cell_data_dict['compact_results'] = e.value
+                    notebook.mark_modified()
+                compact_switch.on_value_change(on_compact_change)
+
                 cell_preview = ui.label('').classes('cell-preview')
                 cell_preview.visible = False
 
@@ -2484,23 +5264,33 @@ async def add_cell(cell_type='sql', initial_show_all_rows=False):
                 delete_btn = ui.button('✖', color='red').classes('delete-button').props('round')
 
             with ui.column().classes('code-cell-content w-full') as cell_content:
-                cm_language = cell_type.lower()
+                cm_language = CELL_TYPE_LANGUAGES[initial_select_value]
                 current_cm_theme = 'vscodeDark' if notebook.is_dark_mode else 'vscodeLight'
-                code_editor = ui.codemirror(value='', language=cm_language, theme=current_cm_theme).classes('w-full code-editor')
-                code_editor.props(f'data-cell-id="{cell_id}"')
+                code_editor = LazyCodeEditor(cell_content, cell_id, cm_language, current_cm_theme) # Mounted when scrolled into view
 
                 download_button_row_el = ui.row().classes('w-full justify-start pl-2 pt-1 pb-1 -mt-5 -mb-5') # Adjusted padding for placement
                 with download_button_row_el:
                     download_csv_button = ui.button('Download Table as CSV', icon='download',
-                                                    on_click=lambda: asyncio.create_task(handle_download_csv(cell_data_dict))) \
+                                                    on_click=lambda: session_task(handle_download_csv(cell_data_dict))) \
+                                            .props('dense flat color=primary text-color=primary') \
+                                            .style('font-size: 0.75rem; padding: 2px 6px;')
+                    profile_button = ui.button('Profile Result', icon='query_stats',
+                                               on_click=lambda: session_task(open_result_profile(cell_data_dict))) \
                                             .props('dense flat color=primary text-color=primary') \
                                             .style('font-size: 0.75rem; padding: 2px 6px;')
+                    materialize_button = ui.button('Materialize Full Result', icon='all_inclusive',
+                                                   on_click=lambda: session_task(run_cell(force_full=True))) \
+                                            .props('dense flat color=primary text-color=primary') \
+                                            .style('font-size: 0.75rem; padding: 2px 6px;')
+                    materialize_button.visible = False
                 download_button_row_el.visible = False
                 # Output area structure
                 output_container_el = ui.column().classes('output-container w-full')
                 output_container_el.visible = False # Initially hidden
                 with output_container_el:
-                    output_area_markdown_el = ui.markdown('').classes('output-area-content w-full')
+                    output_stream_el = ui.html('').classes('output-area-content w-full') # Live stdout while running
+                    output_stream_el.visible = False
+                    output_area_el = ui.column().classes('output-area-content w-full gap-1')
                     # Removed download_button_row_el from here
 
             with ui.column().classes('cell-gutter') as cell_gutter:
@@ -2514,106 +5304,112 @@ async def add_cell(cell_type='sql', initial_show_all_rows=False):
                     result_time = ui.label('').classes('gutter-timer-text')
                 execution_result.visible = False
 
-        async def run_cell():
+        async def run_cell(force_full=False):
             nonlocal is_collapsed
             if is_collapsed:
                 toggle_collapse()
-            code = code_editor.value
-            cell_type_val = cell_type_select.value
-            current_show_all_rows = cell_data_dict['show_all_rows']
+            cell = notebook.cell_snapshot(cell_data_dict)
+            logger.info(f"[{cell_id}] Run: {cell['type']}, Code: {cell['code'][:50]!r}, Show All Rows: {cell['show_all_rows']}")
+            if not cell['code'].strip():
+                cell_data_dict['download_button_row'].visible = False
+                cell_data_dict['df_to_download'] = None
+                show_outputs([CellOutput('text', 'No code to execute.')])
+                cell_data_dict['output_container'].visible = True
+                return
 
-            # Reset output state for the cell before running
-            cell_data_dict['output_container'].visible = False
-            cell_data_dict['download_button_row'].visible = False # Keep this line
-            cell_data_dict['df_to_download'] = None
-            cell_data_dict['output_area_markdown'].set_content('')
+            job = notebook.jobs.submit(cell_id, lambda job: notebook.execute_cell(cell, force_full, job))
+            return await attach_job(job)
 
+        async def attach_job(job: CellJob) -> bool:
+            """Shows a job's progress in this cell and renders its result once it finishes."""
+            cell_data_dict['attached_job_id'] = job.id
 
-            logger.info(f"[{cell_id}] Run: {cell_type_val}, Code: {code[:50]!r}, Show All Rows: {current_show_all_rows}")
-            if not code.strip():
-                cell_data_dict['output_area_markdown'].set_content('No code to execute.')
-                cell_data_dict['output_container'].visible = True
-                return
+            # Reset output state for the cell while it runs
+            cell_data_dict['download_button_row'].visible = False
+            cell_data_dict['materialize_button'].visible = False
+            cell_data_dict['df_to_download'] = None
+            show_outputs([CellOutput('text', 'Running...')])
+            cell_data_dict['output_container'].visible = True # Show "Running..."
 
             execution_status.visible = True
             execution_result.visible = False
-            start_time = time.time()
-            timer_active = True
-            execution_success = False
 
+            streamed = {'version': 0, 'at': 0.0}
             def update_timer():
-                if timer_active:
-                    elapsed_time = time.time() - start_time
-                    timer_label.text = f'{elapsed_time:.1f}s'
-            timer = ui.timer(0.1, update_timer)
+                timer_label.text = f'{job.elapsed:.1f}s'
+                stdout = job.stdout
+                if (stdout is not None and stdout.version != streamed['version']
+                        and time.monotonic() - streamed['at'] >= STDOUT_STREAM_INTERVAL_SECONDS):
+                    streamed.update(version=stdout.version, at=time.monotonic())
+                    output_stream_el.set_content(f'<pre>{html.escape(stdout.getvalue())}</pre>')
+                    output_stream_el.visible = True
+                    output_area_el.visible = False
+            with cell_element: # Re-attached jobs run in their own task, outside any page slot
+                timer = ui.timer(0.1, update_timer)
             run_btn.disable()
-
             try:
-                cell_data_dict['output_area_markdown'].set_content('Running...')
-                cell_data_dict['output_container'].visible = True # Show "Running..."
-                await asyncio.sleep(0.1)
-
-                if cell_type_val == 'SQL':
-                    df_name = df_name_input.value.strip()
-                    result_df, message, saved_name = await notebook.execute_sql(code, df_name or None)
-                    if result_df is not None:
-                        execution_success = True
-                        if current_show_all_rows: max_rows_to_display = 200
-                        else: max_rows_to_display = 20
-
-                        output_text = f"Shape: {result_df.shape}\n\n{result_df.to_html(classes='dataframe', border=0, max_rows=max_rows_to_display, escape=False)}"
-
-                        if not current_show_all_rows and len(result_df) > 20:
-                            output_text += f"\n\n*Showing first 20 of {len(result_df)} rows. To see 200 rows, toggle 'Show all rows' in this cell's header.*"
-                        elif current_show_all_rows and len(result_df) > 200:
-                            output_text += f"\n\n*Showing first 200 of {len(result_df)} rows due to display limit. Full DataFrame is available in memory.*"
-                        elif current_show_all_rows and len(result_df) > 20:
-                            output_text += f"\n\n*Showing all {len(result_df)} rows.*"
-
-                        cell_data_dict['output_area_markdown'].set_content(output_text)
-                        cell_data_dict['df_to_download'] = result_df # Store DF for download
-                        cell_data_dict['download_button_row'].visible = True # Show download button
-                        notebook.mark_modified()
-                    else:
-                        execution_success = False
-                        cell_data_dict['output_area_markdown'].set_content(f"**SQL Error:** {message}")
-                        ui.notify(f"Cell {cell_id}: SQL error.", type='negative')
-
-                elif cell_type_val == 'Python':
-                    success, py_output, py_output_type, last_df = await notebook.execute_python(code, current_show_all_rows)
-                    execution_success = success
-                    if success:
-                        cell_data_dict['output_area_markdown'].set_content(py_output if py_output_type == 'text/html' else f"```\n{py_output}\n```")
-                        if isinstance(last_df, pd.DataFrame):
-                            cell_data_dict['df_to_download'] = last_df # Store DF for download
-                            cell_data_dict['download_button_row'].visible = True # Show download button
-                    else:
-                        cell_data_dict['output_area_markdown'].set_content(f"**Python Error:**\n```\n{py_output}\n```")
-                        ui.notify(f"Cell {cell_id}: Python error.", type='negative')
-
-            except Exception as e:
-                execution_success = False
-                logger.error(f"[{cell_id}] run_cell error: {e}", exc_info=True)
-                cell_data_dict['output_area_markdown'].set_content(f"**Unexpected Error:** {str(e)}\n{traceback.format_exc()}")
-                ui.notify(f"Cell {cell_id}: Unexpected error.", type='error')
-
+                await job.done.wait()
             finally:
-                timer_active = False
                 timer.cancel()
-                final_time = time.time() - start_time
                 execution_status.visible = False
-                execution_result.visible = True
-                result_icon.text = '✓' if execution_success else '☓'
-                result_icon.classes('result-success' if execution_success else 'result-error',
-                                    remove='result-error' if execution_success else 'result-success')
-                result_time.text = f'{final_time:.2f}s' if final_time < 1 else f'{final_time:.1f}s'
+                output_stream_el.visible = False
+                output_area_el.visible = True
                 run_btn.enable()
-                # Ensure output container is visible if there's content OR download button is visible
-                if cell_data_dict['output_area_markdown'].content or cell_data_dict['output_area_markdown']._props.get('innerHTML') or cell_data_dict['download_button_row'].visible:
-                    cell_data_dict['output_container'].visible = True
-                else:
-                    cell_data_dict['output_container'].visible = False
-            logger.info(f"[{cell_id}] End run_cell. Output container visible: {cell_data_dict['output_container'].visible}")
+            if cell_data_dict['attached_job_id'] == job.id: # A newer run owns the output otherwise
+                with cell_element:
+                    render_job_result(job)
+            return job.result.get('success', False)
+
+        def render_job_result(job: CellJob):
+            result = job.result
+            execution_success = result.get('success', False)
+            cell_data_dict['rendered_job_id'] = job.id
+            cell_data_dict['last_run_metrics'] = result.get('metrics')
+            show_outputs(result.get('outputs', []))
+            cell_data_dict['df_to_download'] = result.get('df')
+            cell_data_dict['materialize_button'].visible = result.get('materializable', False)
+            download_csv_button.visible = result.get('df') is not None
+            profile_button.visible = result.get('df') is not None
+            cell_data_dict['download_button_row'].visible = result.get('df') is not None or result.get('materializable', False)
+            if execution_success and result.get('df') is not None and cell_data_dict['type'].value in SQL_CELL_TYPES:
+                notebook.mark_modified()
+            if result.get('error') == 'Unexpected':
+                ui.notify(f"Cell {cell_id}: Unexpected error.", type='error')
+            elif result.get('error'):
+                ui.notify(f"Cell {cell_id}: {result['error']} error.", type='negative')
+
+            execution_result.visible = True
+            result_icon.text = '✓' if execution_success else '☓'
+            result_icon.classes('result-success' if execution_success else 'result-error',
+                                remove='result-error' if execution_success else 'result-success')
+            final_time = job.elapsed
+            result_time.text = f'{final_time:.2f}s' if final_time < 1 else f'{final_time:.1f}s'
+            # Ensure output container is visible if there's content OR download button is visible
+            if result.get('outputs') or cell_data_dict['download_button_row'].visible:
+                cell_data_dict['output_container'].visible = True
+            else:
+                cell_data_dict['output_container'].visible = False
+            logger.info(f"[{cell_id}] Rendered job {job.id} ({job.status}). Output container visible: {cell_data_dict['output_container'].visible}")
+
+        def show_outputs(outputs: List[CellOutput]):
+            cell_data_dict['outputs'] = outputs
+            cell_data_dict['outputs_dropped'] = False
+            render_cell_outputs(output_area_el, outputs)
+
+        def set_in_view(in_view: bool, output_height: float = 0):
+            """Mounts the editor and restores dropped outputs when the cell nears the viewport; drops both when it leaves."""
+            if cell_data_dict['in_view'] == in_view:
+                return
+            cell_data_dict['in_view'] = in_view
+            if in_view:
+                code_editor.mount()
+                if cell_data_dict['outputs_dropped']:
+                    show_outputs(cell_data_dict['outputs'])
+            else:
+                code_editor.unmount()
+                if sum(output.size() for output in cell_data_dict['outputs']) > OFFSCREEN_OUTPUT_CHARS:
+                    render_output_placeholder(output_area_el, output_height)
+                    cell_data_dict['outputs_dropped'] = True
 
         def toggle_collapse():
             nonlocal is_collapsed
@@ -2634,8 +5430,11 @@ async def add_cell(cell_type='sql', initial_show_all_rows=False):
         collapse_btn.on('click', toggle_collapse)
 
         def on_cell_type_change():
-            df_name_input.visible = cell_type_select.value == 'SQL'
-            code_editor.language = cell_type_select.value.lower()
+            df_name_input.visible = cell_type_select.value in SQL_CELL_TYPES
+            preview_switch.visible = cell_type_select.value == 'SQL'
+            compact_switch.visible = cell_type_select.value in SQL_CELL_TYPES
+            profile_select.visible = cell_type_select.value == 'SQL'
+            code_editor.language = CELL_TYPE_LANGUAGES[cell_type_select.value]
             notebook.mark_modified()
         cell_type_select.on_value_change(on_cell_type_change)
 
@@ -2650,6 +5449,8 @@ async def add_cell(cell_type='sql', initial_show_all_rows=False):
     # Define the delete function for this specific cell
     def delete_cell():
         notebook.cells.remove(cell_data_dict)
+        notebook.dataflow.forget(cell_id)
+        notebook.jobs.discard_cell(cell_id)
         cell_element.delete()
         notebook.mark_modified()
         
@@ -2671,16 +5472,22 @@ async def add_cell(cell_type='sql', initial_show_all_rows=False):
         'result_icon': result_icon,
         'result_time': result_time,
         'output_container': output_container_el,
-        'output_area_markdown': output_area_markdown_el,
+        'output_area': output_area_el,
         'download_button_row': download_button_row_el,
+        'materialize_button': materialize_button,
+        'profile_select': profile_select,
+        'run_cell': run_cell,
+        'attach_job': attach_job,
+        'render_job_result': render_job_result,
+        'set_in_view': set_in_view,
     })
     notebook.cells.append(cell_data_dict)
     
     run_btn.on_click(run_cell)
     save_cell_btn.on_click(functools.partial(save_cell_code, cell_data_dict))
 
-    if hasattr(cell_container, '_add_cell_button'):
-        cell_container._add_cell_button.move(target_index=-1)
+    if hasattr(notebook.cell_container, '_add_cell_button'):
+        notebook.cell_container._add_cell_button.move(target_index=-1)
 
 async def add_cell_and_mark_modified(cell_type='sql'):
     await add_cell(cell_type)
@@ -2695,18 +5502,18 @@ def handle_keyboard_shortcut(event):
         if event.modifiers.alt:
             # File/Notebook shortcuts
             if event.key.name == 's':
-                asyncio.create_task(handle_save_notebook())
+                session_task(handle_save_notebook())
             elif event.key.name == 'o':
-                asyncio.create_task(handle_load_notebook())
+                session_task(handle_load_notebook())
             elif event.key.name == 'n':
-                asyncio.create_task(handle_new_notebook())
+                session_task(handle_new_notebook())
             # Drawer shortcuts
             elif event.key.name == 'ArrowLeft':
-                if left_drawer_instance:
-                    left_drawer_instance.toggle()
+                if notebook.left_drawer_instance:
+                    notebook.left_drawer_instance.toggle()
             elif event.key.name == 'ArrowRight':
-                if right_drawer_instance:
-                    right_drawer_instance.toggle()
+                if notebook.right_drawer_instance:
+                    notebook.right_drawer_instance.toggle()
             # Cell shortcuts
             elif event.key.name == 'ArrowUp':
                 delete_bottom_most_cell()
@@ -2718,7 +5525,7 @@ def toggle_dark_mode():
     else:
         ui.query('body').classes(remove='dark-mode')
 
-    dark_mode_btn.props('icon=light_mode' if notebook.is_dark_mode else 'icon=dark_mode')
+    notebook.dark_mode_btn.props('icon=light_mode' if notebook.is_dark_mode else 'icon=dark_mode')
 
     new_theme = 'vscodeDark' if notebook.is_dark_mode else 'vscodeLight'
     for cell_data in notebook.cells:
@@ -2727,157 +5534,145 @@ def toggle_dark_mode():
 
     notebook.mark_modified()
 
+def open_performance_panel():
+    """Shows the stage breakdown of this notebook's recent runs, newest first."""
+    columns = [{'name': key, 'label': label, 'field': key, 'align': 'left'} for key, label in
+               [('time', 'Time'), ('kind', 'Kind'), ('label', 'Cell / Target'), ('status', 'Status'), ('total', 'Total ms')]]
+    columns += [{'name': stage, 'label': f"{stage.replace('_', ' ').title()} ms", 'field': stage, 'align': 'right'} for stage in METRIC_STAGES]
+    columns.append({'name': 'payload', 'label': 'Payload KB', 'field': 'payload', 'align': 'right'})
+    rows = [run.as_row() for run in reversed(notebook.run_history)]
+
+    with ui.dialog() as performance_dialog, ui.card().style('max-width: 95vw; width: 1200px'):
+        with ui.row().classes('w-full items-center'):
+            ui.label('Performance').classes('text-lg font-semibold')
+            ui.space()
+            ui.link('Prometheus metrics', '/metrics', new_tab=True).classes('text-sm')
+            ui.button(icon='close', on_click=performance_dialog.close).props('flat round dense')
+        if rows:
+            ui.table(columns=columns, rows=rows, pagination=20).props('dense flat').classes('w-full')
+        else:
+            ui.label('No runs recorded yet.').classes('text-gray-500')
+    performance_dialog.open()
+
+async def open_variables_panel():
+    """Lists every notebook variable with its type, shape and memory. Selecting a DataFrame shows its column statistics."""
+    frame_sizes = await notebook.account_memory()
+    rows = sorted(notebook.variables.summarize(notebook.python_globals, frame_sizes), key=lambda row: row['memory'], reverse=True)
+    in_memory_mb = sum(frame_sizes.values()) / 1e6
+    columns = [{'name': key, 'label': label, 'field': key, 'align': 'right' if key == 'memory' else 'left', 'sortable': True}
+               for key, label in [('name', 'Name'), ('type', 'Type'), ('shape', 'Shape'), ('memory', 'Memory MB')]]
+    stats_columns = [{'name': key, 'label': label, 'field': key, 'align': 'left'} for key, label in
+                     [('column', 'Column'), ('dtype', 'Dtype'), ('non_null', 'Non-null'), ('unique', 'Distinct'),
+                      ('min', 'Min'), ('max', 'Max'), ('mean', 'Mean'), ('top', 'Most frequent')]]
+    frame_names = [row['name'] for row in rows if isinstance(notebook.python_globals.get(row['name']), (pd.DataFrame, SpilledFrame))]
+
+    with ui.dialog() as variables_dialog, ui.card().style('max-width: 95vw; width: 1000px'):
+        with ui.row().classes('w-full items-center'):
+            ui.label('Variables').classes('text-lg font-semibold')
+            ui.space()
+            ui.button(icon='close', on_click=variables_dialog.close).props('flat round dense')
+        with ui.row().classes('w-full items-center'):
+            ui.label(f"{in_memory_mb:,.1f} MB of DataFrames in memory").classes('text-sm')
+            ui.space()
+            ui.number('Memory budget (MB)', value=notebook.memory.budget_bytes / (1024 * 1024), min=64, step=256,
+                      on_change=lambda e: e.value and notebook.set_memory_budget(e.value)).props('dense')
+        if not PYARROW_AVAILABLE:
+            ui.label("Spilling to disk requires the 'pyarrow' package.").classes('text-sm text-orange-500')
+
+        def on_compact_default_change(e):
+            notebook.compact_results = e.value
+            notebook.mark_modified()
+        ui.switch('Compact SQL results by default in this notebook', value=notebook.compact_results,
+                  on_change=on_compact_default_change).props('dense color=primary').classes('text-sm')
+
+        if not rows:
+            ui.label('No variables yet.').classes('text-gray-500')
+            variables_dialog.open()
+            return
+
+        variables_table = ui.table(columns=columns, rows=rows, row_key='name', pagination=15).props('dense flat').classes('w-full')
+        stats_container = ui.column().classes('w-full')
+
+        async def show_column_stats(name: str):
+            stats_container.clear()
+            value = notebook.python_globals.get(name)
+            if not isinstance(value, (pd.DataFrame, SpilledFrame)):
+                return
+            with stats_container:
+                ui.label(f"Columns of '{name}'").classes('text-sm font-semibold')
+                if isinstance(value, SpilledFrame):
+                    ui.label('This DataFrame is spilled to disk. Run a cell that uses it to reload it.').classes('text-sm text-gray-500')
+                    return
+                if len(value) > VARIABLE_STATS_SAMPLE_ROWS:
+                    ui.label(f"Computed on a sample of {VARIABLE_STATS_SAMPLE_ROWS:,} rows.").classes('text-xs text-gray-500')
+                loading = ui.spinner(size='sm')
+            stats = await notebook.variables.get_column_stats(name, value)
+            loading.delete()
+            with stats_container:
+                ui.table(columns=stats_columns, rows=stats, row_key='column', pagination=10).props('dense flat').classes('w-full')
+        variables_table.on('rowClick', lambda e: show_column_stats(e.args[1]['name']))
+
+        if frame_names:
+            async def compact_selected():
+                name = compact_select.value
+                if not name:
+                    return
+                try:
+                    compacted = await notebook.compact_stored_dataframe(name)
+                    ui.notify(f"'{name}': {describe_compaction(compacted)}", type='positive')
+                    variables_dialog.close()
+                    await open_variables_panel()
+                except Exception as e:
+                    logger.error(f"Failed to compact '{name}': {e}", exc_info=True)
+                    ui.notify(f"Could not compact '{name}': {e}", type='negative')
+            with ui.row().classes('w-full items-center'):
+                compact_select = ui.select(frame_names, label='DataFrame').props('dense').style('min-width: 200px')
+                ui.button('Compact', icon='compress', on_click=compact_selected).props('flat dense color=primary')
+    variables_dialog.open()
+
 def get_last_n_path_parts(path, n=2):
     parts = Path(path).parts
     if len(parts) <= n:
         return str(path)
     return str(Path(*parts[-n:]))
 
-main_container = ui.element('div').classes('w-full main-container')
-ui.query('body').classes(add='dark-mode')
-
-with main_container:
-    with ui.column().classes('w-full h-full'):
-        with ui.row().classes('toolbar w-full'):
-            ui.button(on_click=lambda: left_drawer_instance.toggle(), icon='menu').props('flat round color=primary').classes('drawer-button-hover-effect').style('margin-left: -6px;').tooltip('Toggle File/Schema Browser (Alt+Left Arrow)')
-
-            title_label = ui.label('Untitled').classes('text-2xl font-bold')
-            notebook.title_label = title_label
-            for _ in range(6):
-                ui.row()
-
-            with ui.row().classes('notebook-controls ml-15'):
-                dark_mode_btn = ui.button(icon='light_mode', on_click=toggle_dark_mode).props('flat round')
-                ui.button('New', on_click=handle_new_notebook).classes('save-load-button').tooltip('New Notebook')
-                ui.button('Open', on_click=handle_load_notebook).classes('save-load-button').tooltip('Open Notebook')
-                ui.button('Save', on_click=handle_save_notebook).classes('save-load-button').tooltip('Save Notebook (Alt+S)')
-
-            with ui.row().classes('connection-status'):
-                async def handle_reconnect():
-                    if not notebook.last_successful_config:
-                        ui.notify('No previous connection.', type='warning')
-                        return
-                    reconnect_btn.disable()
-                    ui.notify('Reconnecting...', type='info')
-                    reconnect_config = notebook.last_successful_config.copy()
-                    if 'db_password' not in reconnect_config:
-                        loaded_creds = notebook.load_credentials()
-                        if loaded_creds.get('db_password'):
-                            reconnect_config['db_password'] = loaded_creds['db_password']
-
-                    success, message = await notebook.connect_to_database(reconnect_config)
-                    status_indicator.content = f'<div class="status-indicator status_{"connected" if success else "disconnected"}"></div>'
-                    status_label.text = "Connected" if success else "Disconnected"
-                    ui.notify(f'Reconnection {"successful" if success else "failed"}: {message}', type='positive' if success else 'negative')
-                    reconnect_btn.enable()
-
-                    if success and active_tab.value == 'schema':
-                        await refresh_schema_explorer()
+def build_notebook_page():
+    """Builds the notebook page for the session in scope. Element handles are stored on the session's NotebookApp."""
+    ui.add_head_html(custom_css)
+    ui.add_head_html(DB_EXPLORER_CSS)
+    ui.add_body_html(DB_EXPLORER_JS)
+    ui.on('js_notify', lambda e: ui.notify(e.args[0], type=e.args[1]))
+    ui.on('dnb_cell_visibility', set_cell_in_view)
 
-                # reconnect_btn = ui.button(icon='refresh', on_click=handle_reconnect).props('flat round dense').tooltip('Reconnect')
-                # reconnect_btn.visible = False
-                connect_btn = ui.button('Connect', on_click=lambda: connection_dialog.open()).classes('connect-button').tooltip('Configure DB Connection')
-                status_indicator = ui.html('<div class="status-indicator status-disconnected"></div>')
-                status_label = ui.label('Disconnected')
-
-            ui.button(icon='auto_awesome', on_click=lambda: right_drawer_instance.toggle()) \
-                .props('flat round color=orange').classes('drawer-button-hover-effect') \
-                .tooltip('Toggle AI Assistant (Alt+Right Arrow)')
-
-        cell_container = ui.column().classes('w-full cell-container')
-        with cell_container:
-            cell_container._add_cell_button = ui.button('+ Add Cell', on_click=lambda: asyncio.create_task(add_cell_and_mark_modified('sql'))).classes('add-cell-button').props('id=add-cell-button').tooltip('Add new cell below (Alt+Down Arrow)')
-
-with ui.left_drawer(value=False, elevated=False, top_corner=False, bordered=True) \
-        .props('width=240 behavior=desktop') \
-        .classes('bg-[var(--bg-primary)]') \
-        .style('padding: 0; margin: 0') as drawer:
-    left_drawer_instance = drawer
-
-    with ui.column().classes('w-full h-full no-wrap'):
-        # Tabs for Files and Schema
-        with ui.tabs().classes('w-full bg-primary').props('dense align=justify').style('height: 45px;') as tabs:
-            active_tab = tabs
-            files_tab = ui.tab('files', label='Files', icon='folder').style('height: 44px; min-height: 44px;').classes('small-tab-label')
-            schema_tab = ui.tab('schema', label='Schema', icon='lan').style('height: 44px; min-height: 44px;').classes('small-tab-label')
-
-        with ui.tab_panels(tabs, value='files').classes('w-full flex-grow p-0 m-0'):
-            # Files Tab Panel
-            with ui.tab_panel('files').classes('p-0'):
-                with ui.column().classes('w-full h-full no-wrap'):
-                    # Working directory controls
-                    with ui.row().classes('items-center w-full px-2 py-1'):
-                        browse_wd_button = ui.button(icon='folder_open', on_click=handle_browse_working_directory) \
-                            .classes('browse-wd-button-hover-effect') \
-                            .style('width: 24px; height: 24px; font-size: 12px; flex-shrink: 0; margin-right: -9px;').props('round')
-
-                        if not TKINTER_AVAILABLE:
-                            browse_wd_button.disable()
-                            browse_wd_button.tooltip("Native directory picker unavailable (tkinter missing)")
-
-                        display_path = get_last_n_path_parts(str(notebook.working_directory), 2)
-                        working_dir_display = ui.label(display_path).style('font-size: 14px;')
-
-                    # File tree
-                    with ui.scroll_area().classes('flex-grow min-h-0 w-full') as tc_instance:
-                        tree_container = tc_instance
-                        initial_tree_nodes, initial_state_snapshot = create_file_tree(path=notebook.working_directory, max_depth=3)
-                        notebook.last_tree_state = initial_state_snapshot
-
-                        file_tree = ui.tree(initial_tree_nodes, label_key='label', children_key='children', node_key='id').classes('w-full').style('margin-left: -10px; margin-top: -10px;')
-
-                        def on_tree_double_click(event):
-                             if event.args and event.args.get('node') and event.args['node'].get('is_file') and event.args['node'].get('path', '').endswith('.dnb'):
-                                asyncio.create_task(load_notebook_from_path(event.args['node']['path']))
-
-                        file_tree.on('dblclick', on_tree_double_click, ['node'])
-
-                        if initial_tree_nodes:
-                            expand_ids = [node['id'] for node in initial_tree_nodes if not node.get('is_file', True) and 'children' in node]
-                            if expand_ids:
-                                file_tree.expand(expand_ids)
-                        else:
-                            ui.label("Directory is empty or inaccessible.").classes('q-pa-md text-caption text-[var(--text-secondary)]')
+    main_container = ui.element('div').classes('w-full main-container')
+    if notebook.is_dark_mode:
+        ui.query('body').classes(add='dark-mode')
 
-                        ui.timer(0.2, lambda: ui.run_javascript('colorizeDnbFiles()'), once=True)
-
-            # Schema Tab Panel
-            with ui.tab_panel('schema').classes('-mt-4'):
-                # NEW: Search bar for tables
-                with ui.row().classes('w-full items-center px-2 pt-1 pb-2'):
-                    # CORRECTED: Removed the incorrect type hint 'ui.events.GenericEventArguments'
-                    def handle_schema_search(e):
-                        # The logic here remains correct: the value is in e.args
-                        search_term = e.args or ''
-                        # Escape characters for safe insertion into JS string
-                        js_term = search_term.replace('\\', '\\\\').replace("'", "\\'")
-                        ui.run_javascript(f"""
-                            const explorerDiv = document.getElementById('db-explorer-container');
-                            if (explorerDiv && explorerDiv.dbExplorerInstance) {{
-                                explorerDiv.dbExplorerInstance.filterTables('{js_term}');
-                            }}
-                        """)
-
-                    schema_search_input = ui.input(placeholder='Search loaded tables...') \
-                        .props('dense clearable input-class="pl-2"') \
-                        .classes('w-full') \
-                        .style('font-size: 0.8rem; background-color: var(--bg-tertiary); border-radius: 4px;')
-
-                    schema_search_input.on('update:model-value', handle_schema_search, throttle=0.3)
-
-                    def clear_and_reset_search():
-                        # This simplified logic is correct.
-                        schema_search_input.set_value(None)
-
-                    schema_search_input.on('keydown.escape', clear_and_reset_search, [])
-
-                with ui.row().classes('ml-3 gap-2 -mt-3'):  # Added gap-2 for spacing between buttons
-                    # Move the reconnect button here
+    with main_container:
+        with ui.column().classes('w-full h-full'):
+            with ui.row().classes('toolbar w-full'):
+                ui.button(on_click=lambda: notebook.left_drawer_instance.toggle(), icon='menu').props('flat round color=primary').classes('drawer-button-hover-effect').style('margin-left: -6px;').tooltip('Toggle File/Schema Browser (Alt+Left Arrow)')
+
+                notebook.title_label = ui.label('Untitled').classes('text-2xl font-bold')
+                for _ in range(6):
+                    ui.row()
+
+                with ui.row().classes('notebook-controls ml-15'):
+                    notebook.dark_mode_btn = ui.button(icon='light_mode' if notebook.is_dark_mode else 'dark_mode', on_click=toggle_dark_mode).props('flat round')
+                    ui.button(icon='speed', on_click=open_performance_panel).props('flat round').tooltip('Performance')
+                    ui.button(icon='memory', on_click=open_variables_panel).props('flat round').tooltip('Variables')
+                    ui.button(icon='update', on_click=run_stale_cells).props('flat round').tooltip('Run stale cells')
+                    ui.button('New', on_click=handle_new_notebook).classes('save-load-button').tooltip('New Notebook')
+                    ui.button('Open', on_click=handle_load_notebook).classes('save-load-button').tooltip('Open Notebook')
+                    ui.button('Save', on_click=handle_save_notebook).classes('save-load-button').tooltip('Save Notebook (Alt+S)')
+
+                with ui.row().classes('connection-status'):
                     async def handle_reconnect():
                         if not notebook.last_successful_config:
                             ui.notify('No previous connection.', type='warning')
                             return
-                        reconnect_btn.disable()
+                        notebook.reconnect_btn.disable()
+                        ui.notify('Reconnecting...', type='info')
                         reconnect_config = notebook.last_successful_config.copy()
                         if 'db_password' not in reconnect_config:
                             loaded_creds = notebook.load_credentials()
@@ -2885,148 +5680,364 @@ with ui.left_drawer(value=False, elevated=False, top_corner=False, bordered=True
                                 reconnect_config['db_password'] = loaded_creds['db_password']
 
                         success, message = await notebook.connect_to_database(reconnect_config)
-                        # Update status in toolbar
-                        status_indicator.content = f'<div class="status-indicator status_{"connected" if success else "disconnected"}"></div>'
-                        status_label.text = "Connected" if success else "Disconnected"
+                        notebook.status_indicator.content = f'<div class="status-indicator status_{"connected" if success else "disconnected"}"></div>'
+                        notebook.status_label.text = "Connected" if success else "Disconnected"
                         ui.notify(f'Reconnection {"successful" if success else "failed"}: {message}', type='positive' if success else 'negative')
-                        reconnect_btn.enable()
+                        notebook.reconnect_btn.enable()
 
-                        if success:
+                        if success and notebook.active_tab.value == 'schema':
                             await refresh_schema_explorer()
 
-                    def collapse_all_tables():
-                        # JavaScript to collapse all table nodes in the schema explorer
-                        ui.run_javascript('''
-                            document.querySelectorAll('#db-explorer-container .tree-node--table[aria-expanded="true"]').forEach(node => {
-                                node.setAttribute('aria-expanded', 'false');
-                            });
-                        ''')
-
-                    reconnect_btn = ui.button(icon='refresh', on_click=handle_reconnect).props('flat round=sm')
-                    reconnect_btn.visible = False
-                    
-                    collapse_btn = ui.button('Collapse All', icon='unfold_less', on_click=collapse_all_tables).props('flat').style('font-size: 0.85rem;')
-                    collapse_btn.visible = False  # Show/hide along with reconnect button
-                
-                # The scroll area will contain the JS-rendered tree
-                with ui.scroll_area().classes('flex-grow min-h-0 w-full p-0 m-0 -mt-7') as sc_instance:
-                    schema_container = sc_instance
-                    ui.label("Not connected to database").classes('text-gray-500 p-4 text-center')
-
-async def on_tab_change(e):
-    """Handle tab switching efficiently"""
-    if e.value == 'schema':
-        await refresh_schema_explorer()
-    elif e.value == 'files':
-        await refresh_trees_ui()
+                    # reconnect_btn = ui.button(icon='refresh', on_click=handle_reconnect).props('flat round dense').tooltip('Reconnect')
+                    # reconnect_btn.visible = False
+                    connect_btn = ui.button('Connect', on_click=lambda: connection_dialog.open()).classes('connect-button').tooltip('Configure DB Connection')
+                    notebook.status_indicator = ui.html('<div class="status-indicator status-disconnected"></div>')
+                    notebook.status_label = ui.label('Disconnected')
+
+                ui.button(icon='auto_awesome', on_click=lambda: notebook.right_drawer_instance.toggle()) \
+                    .props('flat round color=orange').classes('drawer-button-hover-effect') \
+                    .tooltip('Toggle AI Assistant (Alt+Right Arrow)')
+
+            notebook.cell_container = ui.column().classes('w-full cell-container')
+            with notebook.cell_container:
+                notebook.cell_container._add_cell_button = ui.button('+ Add Cell', on_click=lambda: session_task(add_cell_and_mark_modified('sql'))).classes('add-cell-button').props('id=add-cell-button').tooltip('Add new cell below (Alt+Down Arrow)')
+
+    with ui.left_drawer(value=False, elevated=False, top_corner=False, bordered=True) \
+            .props('width=240 behavior=desktop') \
+            .classes('bg-[var(--bg-primary)]') \
+            .style('padding: 0; margin: 0') as drawer:
+        notebook.left_drawer_instance = drawer
+
+        with ui.column().classes('w-full h-full no-wrap'):
+            # Tabs for Files and Schema
+            with ui.tabs().classes('w-full bg-primary').props('dense align=justify').style('height: 45px;') as tabs:
+                notebook.active_tab = tabs
+                files_tab = ui.tab('files', label='Files', icon='folder').style('height: 44px; min-height: 44px;').classes('small-tab-label')
+                schema_tab = ui.tab('schema', label='Schema', icon='lan').style('height: 44px; min-height: 44px;').classes('small-tab-label')
+
+            with ui.tab_panels(tabs, value='files').classes('w-full flex-grow p-0 m-0'):
+                # Files Tab Panel
+                with ui.tab_panel('files').classes('p-0'):
+                    with ui.column().classes('w-full h-full no-wrap'):
+                        # Working directory controls
+                        with ui.row().classes('items-center w-full px-2 py-1'):
+                            browse_wd_button = ui.button(icon='folder_open', on_click=handle_browse_working_directory) \
+                                .classes('browse-wd-button-hover-effect') \
+                                .style('width: 24px; height: 24px; font-size: 12px; flex-shrink: 0; margin-right: -9px;').props('round')
+
+                            if not TKINTER_AVAILABLE:
+                                browse_wd_button.disable()
+                                browse_wd_button.tooltip("Native directory picker unavailable (tkinter missing)")
+
+                            display_path = get_last_n_path_parts(str(notebook.working_directory), 2)
+                            notebook.working_dir_display = ui.label(display_path).style('font-size: 14px;')
+
+                        # File tree
+                        with ui.scroll_area().classes('flex-grow min-h-0 w-full') as tc_instance:
+                            notebook.tree_container = tc_instance
+                            initial_tree_nodes, initial_state_snapshot = create_file_tree(path=notebook.working_directory, max_depth=3)
+                            notebook.last_tree_state = initial_state_snapshot
+
+                            notebook.file_tree = ui.tree(initial_tree_nodes, label_key='label', children_key='children', node_key='id').classes('w-full').style('margin-left: -10px; margin-top: -10px;')
+
+                            def on_tree_double_click(event):
+                                 if event.args and event.args.get('node') and event.args['node'].get('is_file') and event.args['node'].get('path', '').endswith('.dnb'):
+                                    session_task(load_notebook_from_path(event.args['node']['path']))
+
+                            notebook.file_tree.on('dblclick', on_tree_double_click, ['node'])
+
+                            if initial_tree_nodes:
+                                expand_ids = [node['id'] for node in initial_tree_nodes if not node.get('is_file', True) and 'children' in node]
+                                if expand_ids:
+                                    notebook.file_tree.expand(expand_ids)
+                            else:
+                                ui.label("Directory is empty or inaccessible.").classes('q-pa-md text-caption text-[var(--text-secondary)]')
+
+                            ui.timer(0.2, lambda: ui.run_javascript(f'dnbWatchFileTree("c{tc_instance.id}")'), once=True)
+
+                # Schema Tab Panel
+                with ui.tab_panel('schema').classes('-mt-4'):
+                    # NEW: Search bar for tables
+                    with ui.row().classes('w-full items-center px-2 pt-1 pb-2'):
+                        # CORRECTED: Removed the incorrect type hint 'ui.events.GenericEventArguments'
+                        def handle_schema_search(e):
+                            # The logic here remains correct: the value is in e.args
+                            search_term = e.args or ''
+                            # Escape characters for safe insertion into JS string
+                            js_term = search_term.replace('\\', '\\\\').replace("'", "\\'")
+                            ui.run_javascript(f"""
+                                const explorerDiv = document.getElementById('db-explorer-container');
+                                if (explorerDiv && explorerDiv.dbExplorerInstance) {{
+                                    explorerDiv.dbExplorerInstance.filterTables('{js_term}');
+                                }}
+                            """)
+
+                        schema_search_input = ui.input(placeholder='Search loaded tables...') \
+                            .props('dense clearable input-class="pl-2"') \
+                            .classes('w-full') \
+                            .style('font-size: 0.8rem; background-color: var(--bg-tertiary); border-radius: 4px;')
+
+                        schema_search_input.on('update:model-value', handle_schema_search, throttle=0.3)
+
+                        def clear_and_reset_search():
+                            # This simplified logic is correct.
+                            schema_search_input.set_value(None)
+
+                        schema_search_input.on('keydown.escape', clear_and_reset_search, [])
+
+                    with ui.row().classes('ml-3 gap-2 -mt-3'):  # Added gap-2 for spacing between buttons
+                        # Move the reconnect button here
+                        async def handle_reconnect():
+                            if not notebook.last_successful_config:
+                                ui.notify('No previous connection.', type='warning')
+                                return
+                            notebook.reconnect_btn.disable()
+                            reconnect_config = notebook.last_successful_config.copy()
+                            if 'db_password' not in reconnect_config:
+                                loaded_creds = notebook.load_credentials()
+                                if loaded_creds.get('db_password'):
+                                    reconnect_config['db_password'] = loaded_creds['db_password']
+
+                            success, message = await notebook.connect_to_database(reconnect_config)
+                            # Update status in toolbar
+                            notebook.status_indicator.content = f'<div class="status-indicator status_{"connected" if success else "disconnected"}"></div>'
+                            notebook.status_label.text = "Connected" if success else "Disconnected"
+                            ui.notify(f'Reconnection {"successful" if success else "failed"}: {message}', type='positive' if success else 'negative')
+                            notebook.reconnect_btn.enable()
+
+                            if success:
+                                await refresh_schema_explorer()
+
+                        def collapse_all_tables():
+                            # JavaScript to collapse all table nodes in the schema explorer
+                            ui.run_javascript('''
+                                document.querySelectorAll('#db-explorer-container .tree-node--table[aria-expanded="true"]').forEach(node => {
+                                    node.setAttribute('aria-expanded', 'false');
+                                });
+                            ''')
+
+                        notebook.reconnect_btn = ui.button(icon='refresh', on_click=handle_reconnect).props('flat round=sm')
+                        notebook.reconnect_btn.visible = False
+
+                        collapse_btn = ui.button('Collapse All', icon='unfold_less', on_click=collapse_all_tables).props('flat').style('font-size: 0.85rem;')
+                        collapse_btn.visible = False  # Show/hide along with reconnect button
+
+                    # The scroll area will contain the JS-rendered tree
+                    with ui.scroll_area().classes('flex-grow min-h-0 w-full p-0 m-0 -mt-7') as sc_instance:
+                        notebook.schema_container = sc_instance
+                        ui.label("Not connected to database").classes('text-gray-500 p-4 text-center')
+
+    async def on_tab_change(e):
+        """Handle tab switching efficiently"""
+        if e.value == 'schema':
+            await refresh_schema_explorer()
+        elif e.value == 'files':
+            await refresh_trees_ui()
+
+    notebook.active_tab.on_value_change(on_tab_change)
+
+    with ui.right_drawer(value=False, elevated=False, top_corner=False, bordered=True) \
+            .props('width=450') \
+            .classes('bg-[var(--bg-primary)]') as r_drawer:
+        notebook.right_drawer_instance = r_drawer
+        with ui.column().classes('w-full h-full no-wrap pa-0'):
+            ui.html(
+                f'<iframe src="https://aistudio.google.com/prompts/new_chat" '
+                f'style="width: 100%; height: 100%; border: none; display: block;"></iframe>'
+            ).classes('w-full h-full')
+
+    # --- START: New Dynamic Drawer Width Logic ---
+    async def update_drawer_widths(_):
+        """Dynamically adjusts drawer widths based on which drawers are open."""
+        if not notebook.left_drawer_instance or not notebook.right_drawer_instance:
+            return
 
-active_tab.on_value_change(on_tab_change)
-
-with ui.right_drawer(value=False, elevated=False, top_corner=False, bordered=True) \
-        .props('width=450') \
-        .classes('bg-[var(--bg-primary)]') as r_drawer:
-    right_drawer_instance = r_drawer
-    with ui.column().classes('w-full h-full no-wrap pa-0'):
-        ui.html(
-            f'<iframe src="https://aistudio.google.com/prompts/new_chat" '
-            f'style="width: 100%; height: 100%; border: none; display: block;"></iframe>'
-        ).classes('w-full h-full')
-
-# --- START: New Dynamic Drawer Width Logic ---
-async def update_drawer_widths(_):
-    """Dynamically adjusts drawer widths based on which drawers are open."""
-    if not left_drawer_instance or not right_drawer_instance:
-        return
+        is_left_open = notebook.left_drawer_instance.value
+        is_right_open = notebook.right_drawer_instance.value
+
+        new_left_width = 310 if not is_right_open else 240
+        notebook.left_drawer_instance.props(f'width={new_left_width}')
+
+        new_right_width = 580 if not is_left_open else 450
+        notebook.right_drawer_instance.props(f'width={new_right_width}')
+
+    # Attach the same handler to both drawers.
+    notebook.left_drawer_instance.on_value_change(update_drawer_widths)
+    notebook.right_drawer_instance.on_value_change(update_drawer_widths)
+    # --- END: New Dynamic Drawer Width Logic ---
+
+
+    with ui.dialog() as connection_dialog:
+        with ui.card().classes('w-96'):
+            saved_creds = notebook.load_credentials()
+            ui.label('Database Configuration (Required)').classes('text-lg font-semibold mb-2')
+            profile_name_input = ui.input('Profile Name', value=saved_creds.get('profile_name', DEFAULT_PROFILE_NAME), placeholder='') \
+                .tooltip('Each profile keeps its own connection pool and SSH tunnel; SQL cells pick a profile')
+            driver_options = {name: driver.label for name, driver in DATABASE_DRIVERS.items() if driver.is_available()}
+            saved_driver = saved_creds.get('driver', 'postgres')
+            db_driver = ui.select(options=driver_options,
+                                  value=saved_driver if saved_driver in driver_options else 'postgres',
+                                  label='Driver').classes('w-full')
+            db_host = ui.input('Database Host', value=saved_creds.get('db_host', ''), placeholder='')
+            db_port = ui.input('Database Port', value=saved_creds.get('db_port', '5439'), placeholder='')
+            db_name = ui.input('Database Name', value=saved_creds.get('db_name', ''), placeholder='')
+            db_user = ui.input('Database User', value=saved_creds.get('db_user', ''), placeholder='')
+            db_password = ui.input('Database Password', value=saved_creds.get('db_password', ''), placeholder='').props('type=password')
+            ui.separator().classes('my-4')
+            with ui.expansion('SSH Configuration (Optional)', icon='vpn_key').classes('w-full'):
+                ui.label('Configure SSH tunnel for secure database connections').classes('text-sm text-white-500 mb-2')
+                ssh_host = ui.input('SSH Host', value=saved_creds.get('ssh_host', ''), placeholder='')
+                ssh_port = ui.input('SSH Port', value=saved_creds.get('ssh_port', '22'), placeholder='')
+                ssh_username = ui.input('SSH Username', value=saved_creds.get('ssh_username', ''), placeholder='')
+                ssh_key_path = ui.input('SSH Private Key Path', value=saved_creds.get('ssh_private_key', ''), placeholder='')
+            with ui.expansion('Redshift IAM Authentication', icon='badge').classes('w-full') as iam_expansion:
+                ui.label('Temporary credentials are requested with GetClusterCredentials; no password is stored').classes('text-sm text-white-500 mb-2')
+                redshift_cluster_id = ui.input('Cluster Identifier', value=saved_creds.get('redshift_cluster_id', ''), placeholder='')
+                aws_region = ui.input('AWS Region', value=saved_creds.get('aws_region', ''), placeholder='')
+                aws_profile = ui.input('AWS Profile (Optional)', value=saved_creds.get('aws_profile', ''), placeholder='')
+            iam_expansion.bind_visibility_from(db_driver, 'value', value='redshift_iam')
+
+            save_creds_checkbox = ui.checkbox('Save connection details (including password)', value=bool(saved_creds.get('db_password')))
+
+            with ui.row().classes('w-full justify-end mt-4'):
+                ui.button('Cancel', on_click=connection_dialog.close)
+                async def connect_action():
+                    config = {
+                        'profile_name': profile_name_input.value.strip() or DEFAULT_PROFILE_NAME,
+                        'driver': db_driver.value,
+                        'ssh_host': ssh_host.value.strip(),
+                        'ssh_port': ssh_port.value.strip() or '22',
+                        'ssh_username': ssh_username.value.strip(),
+                        'ssh_private_key': ssh_key_path.value.strip(),
+                        'db_host': db_host.value.strip(),
+                        'db_port': db_port.value.strip() or '5439',
+                        'db_name': db_name.value.strip(),
+                        'db_user': db_user.value.strip(),
+                        'db_password': db_password.value,
+                        'redshift_cluster_id': redshift_cluster_id.value.strip(),
+                        'aws_region': aws_region.value.strip(),
+                        'aws_profile': aws_profile.value.strip(),
+                    }
+                    required_db = DATABASE_DRIVERS[config['driver']].required_fields
+                    if any(not config[f] for f in required_db):
+                        ui.notify(f'Fill required DB fields: {", ".join(required_db)}', type='warning')
+                        return
 
-    is_left_open = left_drawer_instance.value
-    is_right_open = right_drawer_instance.value
-
-    new_left_width = 310 if not is_right_open else 240
-    left_drawer_instance.props(f'width={new_left_width}')
-
-    new_right_width = 580 if not is_left_open else 450
-    right_drawer_instance.props(f'width={new_right_width}')
-
-# Attach the same handler to both drawers.
-left_drawer_instance.on_value_change(update_drawer_widths)
-right_drawer_instance.on_value_change(update_drawer_widths)
-# --- END: New Dynamic Drawer Width Logic ---
-
-
-with ui.dialog() as connection_dialog:
-    with ui.card().classes('w-96'):
-        saved_creds = notebook.load_credentials()
-        ui.label('Database Configuration (Required)').classes('text-lg font-semibold mb-2')
-        db_host = ui.input('Database Host', value=saved_creds.get('db_host', ''), placeholder='')
-        db_port = ui.input('Database Port', value=saved_creds.get('db_port', '5439'), placeholder='')
-        db_name = ui.input('Database Name', value=saved_creds.get('db_name', ''), placeholder='')
-        db_user = ui.input('Database User', value=saved_creds.get('db_user', ''), placeholder='')
-        db_password = ui.input('Database Password', value=saved_creds.get('db_password', ''), placeholder='').props('type=password')
-        ui.separator().classes('my-4')
-        with ui.expansion('SSH Configuration (Optional)', icon='vpn_key').classes('w-full'):
-            ui.label('Configure SSH tunnel for secure database connections').classes('text-sm text-white-500 mb-2')
-            ssh_host = ui.input('SSH Host', value=saved_creds.get('ssh_host', ''), placeholder='')
-            ssh_port = ui.input('SSH Port', value=saved_creds.get('ssh_port', '22'), placeholder='')
-            ssh_username = ui.input('SSH Username', value=saved_creds.get('ssh_username', ''), placeholder='')
-            ssh_key_path = ui.input('SSH Private Key Path', value=saved_creds.get('ssh_private_key', ''), placeholder='')
-
-        save_creds_checkbox = ui.checkbox('Save connection details (including password)', value=bool(saved_creds.get('db_password')))
-
-        with ui.row().classes('w-full justify-end mt-4'):
-            ui.button('Cancel', on_click=connection_dialog.close)
-            async def connect_action():
-                config = {
-                    'ssh_host': ssh_host.value.strip(),
-                    'ssh_port': ssh_port.value.strip() or '22',
-                    'ssh_username': ssh_username.value.strip(),
-                    'ssh_private_key': ssh_key_path.value.strip(),
-                    'db_host': db_host.value.strip(),
-                    'db_port': db_port.value.strip() or '5439',
-                    'db_name': db_name.value.strip(),
-                    'db_user': db_user.value.strip(),
-                    'db_password': db_password.value
-                }
-                required_db = ['db_host', 'db_name', 'db_user', 'db_password']
-                if any(not config[f] for f in required_db):
-                    ui.notify(f'Fill required DB fields: {", ".join(required_db)}', type='warning')
-                    return
+                    ssh_fields = ['ssh_host', 'ssh_username', 'ssh_private_key']
+                    if any(config[f] for f in ssh_fields) and not all(config[f] for f in ssh_fields):
+                        ui.notify(f'Incomplete SSH. Missing: {", ".join(f for f in ssh_fields if not config[f])}. Will attempt direct.', type='warning')
 
-                ssh_fields = ['ssh_host', 'ssh_username', 'ssh_private_key']
-                if any(config[f] for f in ssh_fields) and not all(config[f] for f in ssh_fields):
-                    ui.notify(f'Incomplete SSH. Missing: {", ".join(f for f in ssh_fields if not config[f])}. Will attempt direct.', type='warning')
+                    success, message = await notebook.connect_to_database(config)
+                    if success:
+                        ui.notify('Connected!', type='positive')
+                        notebook.status_indicator.content = '<div class="status-indicator status-connected"></div>'
+                        notebook.status_label.text = 'Connected'
+                        notebook.reconnect_btn.visible = True
+                        collapse_btn.visible = True
 
-                success, message = await notebook.connect_to_database(config)
-                if success:
-                    ui.notify('Connected!', type='positive')
-                    status_indicator.content = '<div class="status-indicator status-connected"></div>'
-                    status_label.text = 'Connected'
-                    reconnect_btn.visible = True
-                    collapse_btn.visible = True
+                        await refresh_schema_explorer()
 
-                    await refresh_schema_explorer()
+                        refresh_profile_selects()
+                        if save_creds_checkbox.value:
+                            notebook.save_credentials(config)
+                            notebook.connections.save_profiles()
+                        else:
+                            if notebook.credentials_file.exists():
+                                notebook.credentials_file.unlink()
+                            notebook.connections.save_profiles(exclude=config['profile_name'])
+                            ui.notify("Credentials not saved.", type='info')
 
-                    if save_creds_checkbox.value:
-                        notebook.save_credentials(config)
+                        connection_dialog.close()
                     else:
-                        if notebook.credentials_file.exists():
-                            notebook.credentials_file.unlink()
-                        ui.notify("Credentials not saved.", type='info')
+                        ui.notify(f'Connection failed: {message}', type='negative')
+                ui.button('Connect', on_click=connect_action).classes('bg-blue-500')
 
-                    connection_dialog.close()
-                else:
-                    ui.notify(f'Connection failed: {message}', type='negative')
-            ui.button('Connect', on_click=connect_action).classes('bg-blue-500')
 
-async def initialize_app():
-    await add_cell('sql')
-    if notebook.cells and hasattr(notebook.cells[0]['code'], 'theme'):
-        notebook.cells[0]['code'].theme = 'vscodeDark'
+def write_startup_report():
+    """Logs per-phase startup costs and stores them next to the app config for comparison between versions."""
+    total = time.perf_counter() - _PROCESS_START
+    lines = [f"  {label:<40} {duration * 1000:8.1f} ms" for label, duration in sorted(STARTUP_TIMINGS, key=lambda t: -t[1])]
+    logger.info("Startup timing report (time to server start: %.2fs):\n%s", total, '\n'.join(lines))
+    if total > STARTUP_WARN_SECONDS:
+        logger.warning(f"Startup took {total:.2f}s, above the {STARTUP_WARN_SECONDS:.1f}s budget. See the timing report above.")
+    try:
+        report = {'recorded_at': datetime.now().isoformat(), 'total_seconds': total,
+                  'phases': [{'label': label, 'seconds': duration} for label, duration in STARTUP_TIMINGS]}
+        APP_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+        with open(APP_CONFIG_DIR / 'startup_timing.json', 'w') as f:
+            json.dump(report, f, indent=2)
+    except Exception as e:
+        logger.warning(f"Could not write startup timing report: {e}")
+
+def preload_heavy_modules():
+    for module in PRELOAD_MODULES:
+        try:
+            module._load()
+        except Exception as e:
+            logger.warning(f"Background preload of {module.__name__} failed: {e}")
+
+async def maintain_sessions():
+    while True:
+        await asyncio.sleep(SESSION_MAINTENANCE_INTERVAL_SECONDS)
+        try:
+            await sessions.maintain()
+        except Exception as e:
+            logger.error(f"Session maintenance failed: {e}", exc_info=True)
+
+_background_tasks: List[asyncio.Task] = []
+
+async def on_app_startup():
+    write_startup_report()
+    # Give the server a moment to start listening before competing for the GIL with the pandas import
+    asyncio.get_running_loop().call_later(0.5, lambda: threading.Thread(target=preload_heavy_modules, daemon=True).start())
+    _background_tasks.append(asyncio.create_task(maintain_sessions()))
+
+app.on_startup(on_app_startup)
+app.on_shutdown(sessions.close_all)
+
+async def initialize_app(previous_cells: List[Dict[str, Any]]):
+    if previous_cells: # Reopened page: rebuild the session's cells and show their jobs' results
+        was_modified = notebook.is_modified
+        await notebook.restore_cells(previous_cells, keep_ids=True)
+        if was_modified:
+            notebook.mark_modified()
+        else:
+            notebook.mark_saved()
+        await reattach_jobs()
+    else:
+        await add_cell('sql')
+        if notebook.cells and hasattr(notebook.cells[0]['code'], 'theme'):
+            notebook.cells[0]['code'].theme = 'vscodeDark' if notebook.is_dark_mode else 'vscodeLight'
+
+    if notebook.db_connection is not None:
+        notebook.status_indicator.content = '<div class="status-indicator status-connected"></div>'
+        notebook.status_label.text = 'Connected'
+        notebook.reconnect_btn.visible = True
 
     await setup_keyboard_shortcuts()
+    ui.run_javascript(f'dnbVirtualizeCells("c{notebook.cell_container.id}")')
 
     ui.timer(0.5, refresh_trees_ui, once=True)
 
-ui.timer(0.1, initialize_app, once=True)
+@ui.page('/')
+async def index_page(client: Client):
+    session_id = app.storage.browser['id']
+    session_notebook = sessions.open(session_id, client.id)
+    if session_notebook is None:
+        ui.label('The notebook server has reached its session limit. Please try again later.').classes('text-lg p-8')
+        return
+    _current_notebook.set(session_notebook)
+
+    # A page opened again for the same browser takes over the session; its cells are rebuilt from the previous page
+    previous_cells = session_notebook.serialize_notebook()['cells'] if session_notebook.cells else []
+    session_notebook.cells = []
+
+    run_metrics, metrics_token = metrics.begin('page_build', session_id[:8])
+    with metrics.stage('render'):
+        build_notebook_page()
+    metrics.finish(run_metrics, metrics_token, session_notebook.run_history)
+
+    ui.timer(0.1, lambda: initialize_app(previous_cells), once=True)
 
 reload_dir = str(Path(__file__).resolve().parent)
 app_source_dir = str(Path(__file__).resolve().parent)